@@ -1,17 +1,28 @@
 import os
+import gc
+import asyncio
 import logging
 from contextlib import asynccontextmanager
 from pathlib import Path
 from fastapi import FastAPI, Request
-from fastapi.responses import HTMLResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import FileResponse, HTMLResponse
 from fastapi.templating import Jinja2Templates
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
-from app.routers import api, settings, admin_actions, system
-from app.services.notion_sync import sync_notion_data
-from app.services import calendar_service
+from app.routers import api, settings, admin_actions, system, telemetry
+from app.services.sync_jobs import sync_runner
+from app.services import calendar_service, executors, image_processing
 from app.services.settings_manager import settings_manager
+from app.services.schedule import slide_schedule
+from app.services.events import event_hub
+from app.services.video_transcoder import video_transcoder
+from app.services.notion_sync import rebuild_playlist
+from app.services.media_server import CachedStaticFiles, CompressedPage, precompress
+from app.services.notion_api import notion_api
+from app.services.metrics import MetricsMiddleware, metrics_response
+from app.services.watchdog import loop_watchdog
+from app.services.shared_state import shared_state
+from app.services.telemetry import fleet
 
 # Configure Logging
 logging.basicConfig(level=logging.INFO)
@@ -21,36 +32,68 @@ logger = logging.getLogger("main")
 Path("/app/data/media").mkdir(parents=True, exist_ok=True)
 Path("app/static").mkdir(parents=True, exist_ok=True)
 
+# .br/.gz copies of CSS/JS; refreshed here because updates are a `git pull` + restart
+precompress("app/static")
+
+_published_playlist_etags = {}
+
+def publish_playlist_change():
+    """Schedule listener: tells players when the active playlist of a channel actually changed."""
+    global _published_playlist_etags
+    etags = {
+        channel or "": slide_schedule.snapshot_at(channel=channel).etag
+        for channel in [None] + slide_schedule.channels()
+    }
+    changed = [channel for channel, etag in etags.items() if _published_playlist_etags.get(channel) != etag]
+    _published_playlist_etags = etags
+    if changed:
+        event_hub.publish("playlist-changed", {"channels": changed})
+
 async def run_calendar_sync():
-    """Fetches calendar data and updates settings cache."""
+    """Refreshes all calendar feeds concurrently and updates the cached views."""
     try:
         current_settings = settings_manager.get_settings()
+        agenda_feeds = current_settings.get("calendar_feeds") or []
+        await calendar_service.calendar_agenda.configure(
+            agenda_feeds if current_settings.get("agenda_enabled") else [],
+            days=int(current_settings.get("agenda_days") or 14),
+            limit=int(current_settings.get("agenda_limit") or 8),
+        )
+
+        feeds = list(agenda_feeds) if current_settings.get("agenda_enabled") else []
+        ical_url = None
         if current_settings.get("countdown_mode") == "calendar":
             ical_url = current_settings.get("calendar_url")
-            keyword = current_settings.get("calendar_filter")
-            
             if ical_url:
-                logger.info("Syncing Calendar...")
-                title, start_time = await calendar_service.fetch_next_event(ical_url, keyword)
-                if title and start_time:
-                    settings_manager.update_calendar_cache(title, start_time.isoformat())
-                else:
-                    logger.info("No matching future event found in calendar.")
-                    # Optionally clear cache or keep old? 
-                    # Keeping old is safer vs blinking, but might show old stuff.
-                    # Let's keep old for now or clear if specifically desired.
+                feeds.append({"url": ical_url})
+        if not feeds:
+            return
+
+        logger.info(f"Syncing {len(feeds)} calendar feed(s)...")
+        await calendar_service.refresh_feeds(feeds)
+
+        if ical_url:
+            keyword = current_settings.get("calendar_filter")
+            title, start_time = calendar_service.next_event(ical_url, keyword)
+            if title and start_time:
+                await settings_manager.update_calendar_cache(title, start_time.isoformat())
+            else:
+                logger.info("No matching future event found in calendar.")
+                # Keeping the old value is safer vs blinking
     except Exception as e:
         logger.error(f"Calendar sync failed: {e}")
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    logger.info("Starting up Digital Signage Middleware...")
+async def lead():
+    """Background jobs that run in exactly one worker (the leader): syncs, calendar, transcoding."""
+    # Optional video normalization; switch the playlist over when a video is ready
+    video_transcoder.add_listener(rebuild_playlist)
+    video_transcoder.start()
     
     # Start Scheduler
     scheduler = AsyncIOScheduler()
     interval = int(os.getenv("SYNC_INTERVAL", 300)) # Default 5 mins
     
-    scheduler.add_job(sync_notion_data, 'interval', seconds=interval)
+    scheduler.add_job(sync_runner.run, 'interval', seconds=interval) # Joins a running sync instead of overlapping
     scheduler.add_job(run_calendar_sync, 'interval', seconds=300) # Sync calendar every 5 mins
     
     scheduler.start()
@@ -58,31 +101,84 @@ async def lifespan(app: FastAPI):
 
     # Initial Sync
     try:
-        await sync_notion_data()
+        await sync_runner.run()
         await run_calendar_sync() # Initial calendar check
     except Exception as e:
         logger.warning(f"Initial sync failed: {e}")
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    logger.info("Starting up Digital Signage Middleware...")
+    loop_watchdog.start()
+
+    # Serve the last synced playlist right away; switch slides at their Start/End
+    slide_schedule.load_file()
+    publish_playlist_change()
+    slide_schedule.add_listener(publish_playlist_change)
+    schedule_task = asyncio.create_task(slide_schedule.run())
+
+    # Picks up the state of the other workers; runs lead() if this one is the leader
+    shared_state.on_leader(lead)
+    await shared_state.start()
+    fleet_task = asyncio.create_task(fleet.publish_loop()) if shared_state.shared else None
+
+    # Everything loaded so far lives until shutdown: keep it out of the full GC passes
+    gc.collect()
+    gc.freeze()
+
     yield
     logger.info("Shutting down...")
+    schedule_task.cancel()
+    if fleet_task is not None:
+        fleet_task.cancel()
+    shared_state.stop()
+    loop_watchdog.stop()
+    video_transcoder.stop()
+    image_processing.shutdown()
+    await calendar_service.close()
+    await notion_api.close()
+    await settings_manager.flush()
+    executors.shutdown()
 
 app = FastAPI(lifespan=lifespan)
+app.add_middleware(MetricsMiddleware)
 
 # Mounts
-app.mount("/media", StaticFiles(directory="/app/data/media"), name="media")
-app.mount("/static", StaticFiles(directory="app/static"), name="static")
+app.mount("/media", CachedStaticFiles(directory="/app/data/media"), name="media")
+app.mount("/static", CachedStaticFiles(directory="app/static", precompressed=True), name="static")
 
 app.include_router(api.router, prefix="/api")
 app.include_router(settings.router, prefix="/api/settings")
 app.include_router(admin_actions.router)
 app.include_router(system.router)
+app.include_router(telemetry.router)
 
 templates = Jinja2Templates(directory="app/templates")
 
+# The pages don't depend on the request: render and compress them once per process
+_pages = {}
+
+def render_page(request: Request, name: str):
+    page = _pages.get(name)
+    if page is None:
+        body = templates.get_template(name).render({"request": request}).encode("utf-8")
+        page = _pages[name] = CompressedPage(body)
+    return page.response(request)
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Prometheus scrape endpoint."""
+    return metrics_response()
+
+@app.get("/sw.js")
+async def service_worker():
+    # Served from the root so the worker's scope covers the player and /media
+    return FileResponse("app/static/sw.js", media_type="text/javascript", headers={"Cache-Control": "no-cache"})
+
 @app.get("/", response_class=HTMLResponse)
 async def read_root(request: Request):
-    return templates.TemplateResponse("index.html", {"request": request})
+    return render_page(request, "index.html")
 
 @app.get("/admin", response_class=HTMLResponse)
 async def admin_panel(request: Request):
-    return templates.TemplateResponse("admin.html", {"request": request})
+    return render_page(request, "admin.html")
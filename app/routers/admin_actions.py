@@ -1,31 +1,42 @@
-from fastapi import APIRouter, HTTPException
-from fastapi.responses import FileResponse
-from app.services import notion_sync
-from app.services.settings_manager import SETTINGS_FILE
+from fastapi import APIRouter, HTTPException, Response
+from app.services.sync_jobs import sync_runner
+from app.services.settings_manager import settings_manager
 import logging
 
 router = APIRouter(prefix="/api", tags=["admin"])
 logger = logging.getLogger(__name__)
 
 @router.post("/trigger_sync")
-async def trigger_sync():
-    """Manually triggers the Notion sync process."""
+async def trigger_sync(full: bool = True):
+    """
+    Starts the Notion sync in the background and returns its job id right away.
+    Defaults to a full resync; pass ?full=false for an incremental one.
+    If a sync is already running, the request joins it. With several workers
+    the leader runs it, whichever worker got the request.
+    """
     try:
-        logger.info("Manual sync triggered via Admin API")
-        await notion_sync.sync_notion_data()
-        return {"status": "ok", "message": "Sync triggered successfully"}
+        logger.info(f"Manual {'full' if full else 'incremental'} sync triggered via Admin API")
+        job = await sync_runner.request(full=full)
     except Exception as e:
         logger.error(f"Manual sync failed: {e}")
         raise HTTPException(status_code=500, detail=str(e))
+    if job is None:
+        raise HTTPException(status_code=503, detail="No worker took on the sync (leader unavailable)")
+    return {"status": "ok", "message": "Sync started", **job}
+
+@router.get("/sync_status")
+async def sync_status(job_id: str = None):
+    """Progress of a sync job (default: the most recent one), plus Notion API counters."""
+    status = sync_runner.status(job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Sync job not found")
+    return status
 
 @router.get("/backup")
 async def download_backup():
-    """Downloads the current settings.json file."""
-    if not SETTINGS_FILE.exists():
-        raise HTTPException(status_code=404, detail="Settings file not found")
-    
-    return FileResponse(
-        path=SETTINGS_FILE, 
-        filename="settings_backup.json", 
-        media_type="application/json"
+    """Downloads the current settings (as in settings.json, served from memory)."""
+    return Response(
+        content=settings_manager.export(),
+        media_type="application/json",
+        headers={"Content-Disposition": 'attachment; filename="settings_backup.json"'},
     )
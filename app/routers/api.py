@@ -1,17 +1,65 @@
-import json
-from pathlib import Path
-from fastapi import APIRouter
+import time
+from typing import List, Optional
+from fastapi import APIRouter, Body, Request
+from fastapi.responses import StreamingResponse
+from app.services.schedule import slide_schedule
+from app.services.snapshot import snapshot_response
+from app.services.events import event_hub
+from app.services.calendar_service import calendar_agenda
+from app.services.prefetch import manifest_cache
+from app.services.bundle import Bundle, bundle_response
 
 router = APIRouter()
-PLAYLIST_FILE = Path("/app/data/playlist.json")
 
 @router.get("/playlist")
-async def get_playlist():
-    if not PLAYLIST_FILE.exists():
-        return []
-    
-    try:
-        with open(PLAYLIST_FILE, "r") as f:
-            return json.load(f)
-    except Exception:
-        return []
+async def get_playlist(request: Request, channel: Optional[str] = None):
+    """
+    Slides active right now, picked from the synced candidates by time window.
+    With `channel`, only that screen's slides (plus the untagged ones).
+    """
+    return snapshot_response(request, slide_schedule.snapshot_at(time.time(), channel))
+
+@router.get("/prefetch")
+async def get_prefetch_manifest(request: Request, channel: Optional[str] = None):
+    """
+    Media of the current playlist in slide order, with sizes, hashes and
+    planned timing, so players can warm their cache ahead of time.
+    """
+    playlist = slide_schedule.snapshot_at(time.time(), channel)
+    return snapshot_response(request, await manifest_cache.get(playlist))
+
+async def _bundle(request: Request, channel: Optional[str], have: List[str]):
+    playlist = slide_schedule.snapshot_at(time.time(), channel)
+    manifest = await manifest_cache.get(playlist)
+    return bundle_response(request, Bundle(playlist, manifest, have))
+
+@router.get("/bundle")
+async def get_bundle(request: Request, channel: Optional[str] = None, have: str = ""):
+    """
+    Cold start for new screens: current playlist, prefetch manifest and all
+    its media as one tar (resumable with Range / If-Range). `have` is a comma
+    separated list of sha256 prefixes (>= 12 chars) the player already has.
+    """
+    return await _bundle(request, channel, have.split(","))
+
+@router.post("/bundle")
+async def post_bundle(request: Request, channel: Optional[str] = None, have: List[str] = Body([], embed=True)):
+    """Like GET /api/bundle, for `have` lists too long for a URL."""
+    return await _bundle(request, channel, have)
+
+@router.get("/calendar/upcoming")
+async def get_upcoming_events(request: Request):
+    """Merged upcoming events of the agenda feeds (cached, no network I/O)."""
+    return snapshot_response(request, calendar_agenda.snapshot())
+
+@router.get("/events")
+async def events():
+    """
+    Server-Sent Events stream for players: playlist-changed, settings-changed
+    and reload are pushed the moment they happen.
+    """
+    return StreamingResponse(
+        event_hub.stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -1,11 +1,14 @@
-from fastapi import APIRouter, HTTPException, Body
+from typing import Optional
+from fastapi import APIRouter, HTTPException, Body, Request
 from app.services.settings_manager import settings_manager
+from app.services.snapshot import snapshot_response
 
 router = APIRouter()
 
 @router.get("/")
-async def get_settings():
-    return settings_manager.get_settings()
+async def get_settings(request: Request, channel: Optional[str] = None):
+    """Settings, with the overrides of `channel` applied if given."""
+    return snapshot_response(request, settings_manager.snapshot(channel))
 
 @router.post("/")
 async def update_settings(settings: dict = Body(...)):
@@ -14,3 +17,23 @@ async def update_settings(settings: dict = Body(...)):
         return updated
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/history")
+async def get_settings_history():
+    """Stored versions of the settings, newest first."""
+    return await settings_manager.history()
+
+@router.get("/history/{version}")
+async def get_settings_version(version: int):
+    settings = await settings_manager.get_version(version)
+    if settings is None:
+        raise HTTPException(status_code=404, detail="Settings version not found")
+    return settings
+
+@router.post("/rollback/{version}")
+async def rollback_settings(version: int):
+    """Restores an older version (saved as a new version, so it can be undone)."""
+    settings = await settings_manager.rollback(version)
+    if settings is None:
+        raise HTTPException(status_code=404, detail="Settings version not found")
+    return settings
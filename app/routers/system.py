@@ -1,15 +1,35 @@
 from fastapi import APIRouter, HTTPException
 import subprocess
 import sys
+import os
 import time
 import logging
 from pathlib import Path
+from app.services.events import event_hub
+from app.services.shared_state import shared_state
 
 router = APIRouter(prefix="/api/system", tags=["system"])
 logger = logging.getLogger(__name__)
 
+def _server_started() -> int:
+    """
+    Start time of the server. With several workers it is the start of their
+    supervisor (uvicorn), so all workers report the same version and a
+    respawned worker doesn't make every player reload.
+    """
+    if shared_state.shared:
+        try:
+            with open(f"/proc/{os.getppid()}/stat") as f:
+                ticks = int(f.read().rsplit(")", 1)[1].split()[19]) # starttime, in clock ticks after boot
+            with open("/proc/stat") as f:
+                boot = next(int(line.split()[1]) for line in f if line.startswith("btime"))
+            return boot + ticks // os.sysconf("SC_CLK_TCK")
+        except (OSError, ValueError, IndexError, StopIteration) as e:
+            logger.warning(f"Supervisor start time unavailable, using the worker's: {e}")
+    return int(time.time())
+
 # Store startup time as logical "version"
-STARTUP_TIME = int(time.time())
+STARTUP_TIME = _server_started()
 # Refresh Token (force reload for clients)
 REFRESH_TOKEN = int(time.time())
 
@@ -39,8 +59,23 @@ async def trigger_refresh():
     global REFRESH_TOKEN
     REFRESH_TOKEN = int(time.time())
     logger.info(f"Broadcast refresh triggered. New token: {REFRESH_TOKEN}")
+    event_hub.publish("reload", {"refresh_token": REFRESH_TOKEN})
+    # The players connected to the other workers get it from there
+    await shared_state.set("refresh-token", REFRESH_TOKEN)
     return {"status": "success", "message": "Reload command sent to clients."}
 
+def _refresh_changed(key: str, token: int):
+    global REFRESH_TOKEN
+    if token == REFRESH_TOKEN:
+        return
+    REFRESH_TOKEN = token
+    event_hub.publish("reload", {"refresh_token": REFRESH_TOKEN})
+
+# Workers import this module in different seconds (and respawn later): all of
+# them take over the stored token at start, the first one's if none is stored
+shared_state.default("refresh-token", REFRESH_TOKEN)
+shared_state.watch("refresh-token", _refresh_changed, initial=True)
+
 @router.post("/update")
 async def trigger_update():
     """
@@ -0,0 +1,46 @@
+from fastapi import APIRouter, Body, HTTPException, Request
+from app.services.telemetry import TELEMETRY_INTERVAL, fleet
+from app.services.snapshot import snapshot_response
+from app.services.metrics import TELEMETRY_REPORTS
+import logging
+
+router = APIRouter(prefix="/api/telemetry", tags=["telemetry"])
+logger = logging.getLogger(__name__)
+
+@router.post("")
+async def report_heartbeat(request: Request, report: dict = Body(...)):
+    """
+    Heartbeat of a player with the events collected since the last one:
+    {"screen", "channel", "playlist" (ETag), "slide": {"id", "index", "type"},
+     "uptime", "events": [{"type": "media_load", "url", "ms"} |
+     {"type": "media_error" | "error", "url"?, "message"} |
+     {"type": "frames", "dropped", "total"}]}
+    Only updates memory; the answer tells the player when to report next.
+    """
+    screen_id = report.get("screen")
+    if not screen_id:
+        raise HTTPException(status_code=400, detail="screen is required")
+    address = request.client.host if request.client else None
+    fleet.report(screen_id, report, address, request.headers.get("user-agent"))
+    TELEMETRY_REPORTS.inc()
+    return {"interval": TELEMETRY_INTERVAL}
+
+@router.get("/fleet")
+async def fleet_overview(request: Request):
+    """All known screens with status, current slide and media statistics."""
+    return snapshot_response(request, fleet.overview())
+
+@router.get("/screens/{screen_id}")
+async def screen_detail(screen_id: str):
+    """One screen including its recent heartbeats and errors."""
+    detail = fleet.detail(screen_id)
+    if detail is None:
+        raise HTTPException(status_code=404, detail="Screen not found")
+    return detail
+
+@router.delete("/screens/{screen_id}")
+async def forget_screen(screen_id: str):
+    """Removes a decommissioned screen from the overview."""
+    if not await fleet.forget(screen_id):
+        raise HTTPException(status_code=404, detail="Screen not found")
+    return {"status": "ok"}
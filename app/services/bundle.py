@@ -0,0 +1,171 @@
+import os
+import hashlib
+import logging
+import tarfile
+from typing import Iterable, List, Optional, Set, Tuple, Union
+import anyio
+from fastapi import Request, Response
+from app.services import file_manager
+from app.services.media_server import parse_range
+from app.services.snapshot import Snapshot
+
+logger = logging.getLogger(__name__)
+
+BLOCK = 512
+CHUNK_SIZE = 64 * 1024
+# Shortest accepted prefix of a sha256 in the `have` list
+MIN_HASH_PREFIX = 12
+
+# A segment is literal bytes, or (path, size) of a file to stream
+Segment = Union[bytes, Tuple[str, int]]
+
+def _header(name: str, size: int) -> bytes:
+    # Fixed metadata so the same content always gives the same bytes (ETag + Range resume)
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = 0
+    info.mode = 0o644
+    info.uid = info.gid = 0
+    info.uname = info.gname = ""
+    return info.tobuf(format=tarfile.USTAR_FORMAT)
+
+def _padding(size: int) -> bytes:
+    return b"\0" * (-size % BLOCK)
+
+class Bundle:
+    """
+    Uncompressed tar of a playlist and its media with a deterministic layout:
+        playlist.json, manifest.json, media/<filename>...  (in slide order)
+    Only the headers are built up front; file contents are streamed from disk
+    when sent. Size and ETag are known before the first byte, so the download
+    can be resumed with Range.
+    """
+    def __init__(self, playlist: Snapshot, manifest: Snapshot, have: Iterable[str] = ()):
+        prefixes = {h.strip().lower() for h in have if len(h.strip()) >= MIN_HASH_PREFIX}
+        self.segments: List[Segment] = []
+        self.files = 0
+        self.skipped = 0
+
+        self._add_bytes("playlist.json", playlist.body)
+        self._add_bytes("manifest.json", manifest.body)
+
+        seen: Set[str] = set()
+        for slide in manifest.data["slides"]:
+            for media in slide["media"]:
+                if media["url"] in seen:
+                    continue
+                seen.add(media["url"])
+                if any(media["hash"].startswith(prefix) for prefix in prefixes):
+                    self.skipped += 1
+                    continue
+                filename = media["url"][len("/media/"):]
+                self._add_file(f"media/{filename}", str(file_manager.MEDIA_DIR / filename), media["size"])
+        self.segments.append(b"\0" * (2 * BLOCK)) # end of archive
+
+        self.size = sum(len(s) if isinstance(s, bytes) else s[1] for s in self.segments)
+        key = f"{playlist.etag}|{manifest.etag}|{','.join(sorted(prefixes))}"
+        self.etag = '"' + hashlib.sha256(key.encode()).hexdigest()[:32] + '"'
+
+    def _add_bytes(self, name: str, data: bytes):
+        self.segments.append(_header(name, len(data)) + data + _padding(len(data)))
+
+    def _add_file(self, name: str, path: str, size: int):
+        self.segments.append(_header(name, size))
+        self.segments.append((path, size))
+        if _padding(size):
+            self.segments.append(_padding(size))
+        self.files += 1
+
+    def slices(self, start: int, end: int):
+        """Yields (segment, offset, length) covering bytes start..end (inclusive)."""
+        position = 0
+        for segment in self.segments:
+            length = len(segment) if isinstance(segment, bytes) else segment[1]
+            seg_start, seg_end = position, position + length - 1
+            position += length
+            if seg_end < start:
+                continue
+            if seg_start > end:
+                break
+            offset = max(start, seg_start) - seg_start
+            yield segment, offset, min(end, seg_end) - seg_start - offset + 1
+
+class BundleResponse(Response):
+    """
+    Streams a Bundle (or one byte range of it). File members go out through
+    the ASGI zero-copy extension (sendfile) when the server offers it, and as
+    chunked reads in a worker thread otherwise.
+    """
+    media_type = "application/x-tar"
+
+    def __init__(self, bundle: Bundle, start: int = 0, end: Optional[int] = None, headers: dict = None):
+        end = bundle.size - 1 if end is None else end
+        partial = (start, end) != (0, bundle.size - 1)
+        super().__init__(status_code=206 if partial else 200, headers=headers, media_type=self.media_type)
+        self.bundle = bundle
+        self.start = start
+        self.end = end
+        self.headers["content-length"] = str(end - start + 1)
+        if partial:
+            self.headers["content-range"] = f"bytes {start}-{end}/{bundle.size}"
+
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if scope["method"].upper() == "HEAD" or self.end < self.start:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+
+        zerocopy = "http.response.zerocopysend" in scope.get("extensions", {})
+        for segment, offset, length in self.bundle.slices(self.start, self.end):
+            if isinstance(segment, bytes):
+                await send({"type": "http.response.body", "body": segment[offset:offset + length], "more_body": True})
+            else:
+                await self._send_file(send, segment[0], offset, length, zerocopy)
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+    async def _send_file(self, send, path: str, offset: int, length: int, zerocopy: bool):
+        remaining = length
+        try:
+            if zerocopy and os.stat(path).st_size >= offset + length:
+                with open(path, "rb") as f:
+                    await send({
+                        "type": "http.response.zerocopysend",
+                        "file": f.fileno(), "offset": offset, "count": length, "more_body": True,
+                    })
+                return
+            async with await anyio.open_file(path, "rb") as f:
+                await f.seek(offset)
+                while remaining > 0:
+                    chunk = await f.read(min(CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        except OSError as e:
+            logger.warning(f"Bundle member {os.path.basename(path)} unreadable: {e}")
+        if remaining > 0:
+            # Deleted or truncated since the bundle was planned: keep the tar framing intact
+            logger.warning(f"Bundle member {os.path.basename(path)} shorter than planned, padding.")
+            while remaining > 0:
+                size = min(CHUNK_SIZE, remaining)
+                await send({"type": "http.response.body", "body": b"\0" * size, "more_body": True})
+                remaining -= size
+
+def bundle_response(request: Request, bundle: Bundle) -> Response:
+    """Full bundle, one byte range of it (206) or 416; If-Range guards resumes."""
+    headers = {
+        "ETag": bundle.etag,
+        "Accept-Ranges": "bytes",
+        "Cache-Control": "no-cache",
+        "Content-Disposition": 'attachment; filename="bundle.tar"',
+    }
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (if_range is None or if_range == bundle.etag):
+        try:
+            byte_range = parse_range(range_header, bundle.size)
+        except ValueError:
+            return Response(status_code=416, headers={"Content-Range": f"bytes */{bundle.size}"})
+        if byte_range:
+            return BundleResponse(bundle, *byte_range, headers=headers)
+    return BundleResponse(bundle, headers=headers)
@@ -1,71 +1,407 @@
+import os
+import time
+import heapq
+import asyncio
+import hashlib
 import httpx
 import logging
-from datetime import datetime, timezone
+from bisect import bisect_right
+from datetime import datetime, timedelta, timezone
 import icalendar
-from typing import Optional, Tuple
+from dateutil.rrule import rrulestr
+from typing import Any, Dict, List, Optional, Tuple
+from app.services.snapshot import Snapshot
+from app.services.metrics import CALENDAR_FETCHES, CALENDAR_SECONDS
+from app.services.executors import run_io, run_parse
+from app.services.shared_state import shared_state
 
 logger = logging.getLogger(__name__)
 
+# Recurring events are expanded this far into the future
+CALENDAR_HORIZON_DAYS = int(os.getenv("CALENDAR_HORIZON_DAYS", 365))
+CALENDAR_TIMEOUT = float(os.getenv("CALENDAR_TIMEOUT", 10))
+
+def _to_utc(value) -> datetime:
+    """DTSTART/EXDATE value -> aware UTC datetime (all-day = midnight, naive = UTC)."""
+    if not isinstance(value, datetime):
+        value = datetime(value.year, value.month, value.day)
+    if value.tzinfo is None:
+        # Floating time; assume UTC like before
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+def _dates(component, name: str) -> List:
+    """All values of a (possibly repeated) EXDATE/RDATE property."""
+    prop = component.get(name)
+    if prop is None:
+        return []
+    values = []
+    for item in prop if isinstance(prop, list) else [prop]:
+        values.extend(d.dt for d in getattr(item, "dts", []))
+    return values
+
+def _occurrences(component, start, window_start: datetime, window_end: datetime) -> List[datetime]:
+    """UTC start times of a VEVENT inside [window_start, window_end]."""
+    rule = component.get("rrule")
+    if rule is None:
+        occurrence = _to_utc(start)
+        return [occurrence] if window_start <= occurrence <= window_end else []
+
+    # Expand in the event's local wall-clock time, then attach its zone again,
+    # so a weekly 10:00 event stays at 10:00 across DST changes
+    tz = start.tzinfo if isinstance(start, datetime) else None
+    if not isinstance(start, datetime):
+        start = datetime(start.year, start.month, start.day)
+    frame_start = start.replace(tzinfo=None)
+    lower = (window_start.astimezone(tz) if tz else window_start).replace(tzinfo=None) - timedelta(days=1)
+    upper = (window_end.astimezone(tz) if tz else window_end).replace(tzinfo=None) + timedelta(days=1)
+
+    try:
+        rules = rrulestr(rule.to_ical().decode(), dtstart=frame_start, ignoretz=True, forceset=True)
+        local = rules.between(lower, upper, inc=True)
+    except (ValueError, TypeError) as e:
+        logger.debug(f"Unsupported RRULE {rule.to_ical()!r}: {e}")
+        local = [frame_start]
+
+    if tz is None:
+        occurrences = [_to_utc(o) for o in local]
+    elif hasattr(tz, "localize"):
+        # pytz zones need localize() to pick the right offset
+        occurrences = [_to_utc(tz.localize(o)) for o in local]
+    else:
+        occurrences = [_to_utc(o.replace(tzinfo=tz)) for o in local]
+    occurrences = [o for o in occurrences if window_start <= o <= window_end]
+    occurrences.extend(
+        o for o in map(_to_utc, _dates(component, "rdate")) if window_start <= o <= window_end
+    )
+    excluded = {_to_utc(d) for d in _dates(component, "exdate")}
+    return [o for o in occurrences if o not in excluded]
+
+def build_index(cal, now: datetime, horizon: datetime) -> List[Tuple[datetime, str, bool]]:
+    """Sorted (start_utc, summary, all_day) of all occurrences between now and horizon."""
+    events = []
+    overridden = set()
+    components = [c for c in cal.walk() if c.name == "VEVENT" and c.get("dtstart")]
+
+    # Modified instances (RECURRENCE-ID) replace the matching occurrence of their series
+    for component in components:
+        recurrence_id = component.get("recurrence-id")
+        if recurrence_id is not None:
+            overridden.add((str(component.get("uid", "")), _to_utc(recurrence_id.dt)))
+
+    for component in components:
+        summary = str(component.get("summary", ""))
+        uid = str(component.get("uid", ""))
+        dtstart = component.get("dtstart").dt
+        all_day = not isinstance(dtstart, datetime)
+        try:
+            starts = _occurrences(component, dtstart, now, horizon)
+        except Exception as e:
+            logger.debug(f"Skipping calendar event {summary!r}: {e}")
+            continue
+        is_series = component.get("rrule") is not None
+        for start in starts:
+            if is_series and (uid, start) in overridden:
+                continue
+            events.append((start, summary, all_day))
+
+    events.sort(key=lambda event: event[0])
+    return events
+
+def parse_feed(body: bytes, now: datetime, horizon: datetime) -> List[Tuple[datetime, str, bool]]:
+    """Parses a feed and builds its index. Pure Python and slow for big feeds: runs in the parse pool."""
+    return build_index(icalendar.Calendar.from_ical(body), now, horizon)
+
+class CalendarFeed:
+    """
+    Cached state of one iCal feed: HTTP validators, a fingerprint of the last
+    body and the sorted index of upcoming occurrences. Fetches are conditional
+    (If-None-Match / If-Modified-Since) and an unchanged body is not parsed
+    again, so next_event() is a bisect on the index between fetches.
+    Only the leader worker fetches; the others restore the state it shares
+    (see share_feeds).
+    """
+    def __init__(self, url: str):
+        self.url = url
+        self.etag: Optional[str] = None
+        self.last_modified: Optional[str] = None
+        self.fingerprint: Optional[str] = None
+        self.events: List[Tuple[datetime, str, bool]] = []
+        self._starts: List[datetime] = []
+        self.horizon: Optional[datetime] = None
+        self.fetched_at: Optional[float] = None
+        self.error: Optional[str] = None
+        self.shared_horizon: Optional[datetime] = None # index last handed to the other workers
+
+    def _needs_expansion(self, now: datetime) -> bool:
+        # Re-expand recurrences once half of the horizon has been used up
+        horizon_days = timedelta(days=CALENDAR_HORIZON_DAYS)
+        return self.horizon is None or self.horizon - now < horizon_days / 2
+
+    async def refresh(self, client: httpx.AsyncClient) -> str:
+        """
+        Fetches the feed if it changed and rebuilds the index if needed.
+        Returns "not_modified" (304), "unchanged" (same body) or "parsed".
+        """
+        now = datetime.now(timezone.utc)
+        headers = {}
+        if not self._needs_expansion(now):
+            # Only a conditional request when the cached index is still usable
+            if self.etag:
+                headers["If-None-Match"] = self.etag
+            if self.last_modified:
+                headers["If-Modified-Since"] = self.last_modified
+
+        response = await client.get(self.url, headers=headers)
+        self.fetched_at = time.time()
+        if response.status_code == 304:
+            logger.debug(f"Calendar feed unchanged (304): {self.url}")
+            return "not_modified"
+        response.raise_for_status()
+
+        self.etag = response.headers.get("etag")
+        self.last_modified = response.headers.get("last-modified")
+        body = response.content
+        fingerprint = hashlib.sha256(body).hexdigest()
+        if fingerprint == self.fingerprint and not self._needs_expansion(now):
+            logger.debug(f"Calendar feed body unchanged, skipping parse: {self.url}")
+            return "unchanged"
+
+        horizon = now + timedelta(days=CALENDAR_HORIZON_DAYS)
+        events = await run_parse(parse_feed, body, now, horizon)
+        self.events = events
+        self._starts = [event[0] for event in events]
+        self.horizon = horizon
+        self.fingerprint = fingerprint
+        logger.info(f"Calendar feed indexed: {len(events)} upcoming occurrences ({len(body)} bytes).")
+        return "parsed"
+
+    def export_status(self) -> Dict[str, Any]:
+        return {
+            "url": self.url, "etag": self.etag, "last_modified": self.last_modified,
+            "fetched_at": self.fetched_at, "error": self.error,
+        }
+
+    def export_index(self) -> Dict[str, Any]:
+        """The index as plain data (blocking for big feeds: run it in a thread)."""
+        return {
+            "url": self.url,
+            "fingerprint": self.fingerprint,
+            "horizon": self.horizon.timestamp() if self.horizon else None,
+            "events": [(start.timestamp(), summary, all_day) for start, summary, all_day in self.events],
+        }
+
+    def restore_status(self, data: Dict[str, Any]):
+        self.etag, self.last_modified = data.get("etag"), data.get("last_modified")
+        self.fetched_at, self.error = data.get("fetched_at"), data.get("error")
+
+    def restore_index(self, data: Dict[str, Any], events: List[Tuple[datetime, str, bool]]):
+        """Takes over an exported index; `events` are its decoded events (see decode_events)."""
+        self.events = events
+        self._starts = [event[0] for event in events]
+        self.horizon = datetime.fromtimestamp(data["horizon"], timezone.utc) if data.get("horizon") else None
+        self.fingerprint = data.get("fingerprint")
+
+    def upcoming(self, filter_keyword: str = None, now: datetime = None):
+        """Yields (start_utc, summary, all_day) of future occurrences in order."""
+        now = now or datetime.now(timezone.utc)
+        keyword = filter_keyword.lower() if filter_keyword else None
+        for index in range(bisect_right(self._starts, now), len(self.events)):
+            event = self.events[index]
+            if keyword and keyword not in event[1].lower():
+                continue
+            yield event
+
+    def next_event(self, filter_keyword: str = None, now: datetime = None) -> Tuple[Optional[str], Optional[datetime]]:
+        for start, summary, _ in self.upcoming(filter_keyword, now):
+            return summary, start
+        return None, None
+
+_feeds: Dict[str, CalendarFeed] = {}
+_client: Optional[httpx.AsyncClient] = None
+
+def get_feed(ical_url: str) -> CalendarFeed:
+    feed = _feeds.get(ical_url)
+    if feed is None:
+        feed = _feeds[ical_url] = CalendarFeed(ical_url)
+    return feed
+
+def get_client() -> httpx.AsyncClient:
+    """Pooled client shared by all feeds (keep-alive across ticks)."""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            timeout=CALENDAR_TIMEOUT,
+            follow_redirects=True,
+            limits=httpx.Limits(max_connections=10, max_keepalive_connections=5),
+        )
+    return _client
+
+async def close():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+async def _refresh_feed(feed: CalendarFeed, timeout: float) -> bool:
+    started = time.perf_counter()
+    try:
+        result = await asyncio.wait_for(feed.refresh(get_client()), timeout)
+        CALENDAR_FETCHES.labels(result).inc()
+        feed.error = None
+        return True
+    except Exception as e:
+        CALENDAR_FETCHES.labels("error").inc()
+        # Keep answering from the last good index
+        feed.error = str(e).splitlines()[0] if str(e) else e.__class__.__name__
+        logger.error(f"Error fetching calendar {feed.url}: {feed.error}")
+        return False
+    finally:
+        CALENDAR_SECONDS.observe(time.perf_counter() - started)
+        # Right away, not after the slowest of the feeds refreshed together
+        calendar_agenda.invalidate()
+
+async def refresh_feeds(feeds: List[Dict[str, Any]]):
+    """
+    Refreshes several feeds ({"url", "timeout"?}) concurrently, each bounded by
+    its own timeout. A feed's new index is visible as soon as that feed is done,
+    so one slow feed never holds back the others.
+    """
+    timeouts: Dict[str, float] = {}
+    for config in feeds:
+        url = (config.get("url") or "").strip()
+        if url:
+            timeouts[url] = max(timeouts.get(url, 0), float(config.get("timeout") or CALENDAR_TIMEOUT))
+    await asyncio.gather(*(_refresh_feed(get_feed(url), timeout) for url, timeout in timeouts.items()))
+    await share_feeds(list(timeouts))
+
+def decode_events(rows: List) -> List[Tuple[datetime, str, bool]]:
+    return [(datetime.fromtimestamp(start, timezone.utc), summary, all_day) for start, summary, all_day in rows]
+
+def _shared_key(url: str) -> str:
+    return hashlib.sha1(url.encode("utf-8")).hexdigest()[:16]
+
+async def share_feeds(urls: List[str]):
+    """
+    Hands the refreshed feeds to the other workers: the fetch status every
+    time, the index only when it was rebuilt (it can be large).
+    """
+    if not shared_state.shared:
+        return
+    for url in urls:
+        feed = _feeds.get(url)
+        if feed is None:
+            continue
+        if feed.horizon is not None and feed.horizon != feed.shared_horizon:
+            await shared_state.set(f"calendar-index:{_shared_key(url)}", await run_io(feed.export_index))
+            feed.shared_horizon = feed.horizon
+        await shared_state.set(f"calendar-feed:{_shared_key(url)}", feed.export_status())
+
+def _feed_changed(key: str, status: Dict[str, Any]):
+    get_feed(status["url"]).restore_status(status)
+    calendar_agenda.invalidate()
+
+async def _index_changed(key: str, index: Dict[str, Any]):
+    # Converting thousands of occurrences back to datetimes: off the loop
+    events = await run_io(decode_events, index.get("events") or [])
+    feed = get_feed(index["url"])
+    feed.restore_index(index, events)
+    feed.shared_horizon = feed.horizon
+    calendar_agenda.invalidate()
+
+def next_event(ical_url: str, filter_keyword: str = None) -> Tuple[Optional[str], Optional[datetime]]:
+    """Next matching event from the cached index, without network I/O."""
+    feed = _feeds.get(ical_url)
+    return feed.next_event(filter_keyword) if feed else (None, None)
+
 async def fetch_next_event(ical_url: str, filter_keyword: str = None) -> Tuple[Optional[str], Optional[datetime]]:
     """
-    Fetches an iCal feed and returns the Title and Start Time of the next future event.
+    Refreshes the iCal feed (conditionally) and returns the Title and Start Time
+    of the next future event, recurring events included.
     Optionally filters events by a keyword in the summary.
-    
+
     Returns:
         (title, start_time_utc) or (None, None)
     """
     if not ical_url:
         return None, None
 
-    try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            response = await client.get(ical_url)
-            response.raise_for_status()
-            
-            cal_data = response.text
-            cal = icalendar.Calendar.from_ical(cal_data)
-            
-            now = datetime.now(timezone.utc)
-            next_event = None
-            min_diff = None
-
-            for component in cal.walk():
-                if component.name == "VEVENT":
-                    summary = str(component.get('summary', ''))
-                    
-                    # Filter logic
-                    if filter_keyword and filter_keyword.lower() not in summary.lower():
-                        continue
-                        
-                    dtstart = component.get('dtstart')
-                    if not dtstart:
-                        continue
-                        
-                    start = dtstart.dt
-                    
-                    # Normalize to UTC
-                    if hasattr(start, 'tzinfo') and start.tzinfo is not None:
-                        start = start.astimezone(timezone.utc)
-                    else:
-                        # If naive, assume UTC or ignore? Naive usually implies floating time. 
-                        # Let's assume UTC for simplicity or server local time.
-                        # Ideally assume server timezone.
-                        start = start.replace(tzinfo=timezone.utc)
-
-                    # Check if in future
-                    if start > now:
-                        diff = (start - now).total_seconds()
-                        if min_diff is None or diff < min_diff:
-                            min_diff = diff
-                            next_event = (summary, start)
-
-            if next_event:
-                logger.info(f"Found next calendar event: {next_event[0]} at {next_event[1]}")
-                return next_event
-            else:
-                logger.info("No future events found in calendar matching criteria.")
-                return None, None
+    await _refresh_feed(get_feed(ical_url), CALENDAR_TIMEOUT)
+    result = next_event(ical_url, filter_keyword)
+    if result[0]:
+        logger.info(f"Found next calendar event: {result[0]} at {result[1]}")
+    else:
+        logger.info("No future events found in calendar matching criteria.")
+    return result
 
-    except Exception as e:
-        logger.error(f"Error fetching calendar: {e}")
-        return None, None
+def _labelled(events, name: str):
+    for start, summary, all_day in events:
+        yield start, summary, all_day, name
+
+class CalendarAgenda:
+    """
+    Merged upcoming-events list of the configured agenda feeds, served from a
+    pre-serialized snapshot. It is rebuilt only when a feed was refreshed, the
+    configuration changed, or the first listed event has started.
+    """
+    def __init__(self):
+        self._feeds: List[Dict[str, Any]] = []
+        self._days = 14
+        self._limit = 8
+        self._snapshot: Optional[Snapshot] = None
+        self._expires: float = 0
+
+    async def configure(self, feeds: List[Dict[str, Any]], days: int = 14, limit: int = 8):
+        feeds = [f for f in feeds if (f.get("url") or "").strip()]
+        if (feeds, days, limit) != (self._feeds, self._days, self._limit):
+            self._configured("calendar-agenda", {"feeds": feeds, "days": days, "limit": limit})
+            await shared_state.set("calendar-agenda", {"feeds": feeds, "days": days, "limit": limit})
+
+    def _configured(self, key: str, config: Dict[str, Any]):
+        self._feeds, self._days, self._limit = config["feeds"], config["days"], config["limit"]
+        self.invalidate()
+
+    def invalidate(self):
+        self._snapshot = None
+
+    def _build(self, now: datetime) -> Snapshot:
+        until = now + timedelta(days=self._days)
+        streams = []
+        for position, config in enumerate(self._feeds):
+            feed = _feeds.get(config["url"].strip())
+            if feed is None:
+                continue
+            name = config.get("name") or f"Kalender {position + 1}"
+            streams.append(_labelled(feed.upcoming(config.get("filter"), now), name))
+
+        events = []
+        for start, summary, all_day, name in heapq.merge(*streams, key=lambda event: event[0]):
+            if start > until or len(events) >= self._limit:
+                break
+            events.append({"title": summary, "start": start.isoformat(), "all_day": all_day, "feed": name})
+
+        feeds = []
+        for position, config in enumerate(self._feeds):
+            feed = _feeds.get(config["url"].strip())
+            feeds.append({
+                "name": config.get("name") or f"Kalender {position + 1}",
+                "events": len(feed.events) if feed else 0,
+                "fetched_at": feed.fetched_at if feed else None,
+                "error": feed.error if feed else None,
+            })
+
+        # Valid until the first listed event starts (it must drop off the list)
+        first = datetime.fromisoformat(events[0]["start"]).timestamp() if events else float("inf")
+        self._expires = min(first, now.timestamp() + 3600)
+        return Snapshot({"events": events, "feeds": feeds})
+
+    def snapshot(self) -> Snapshot:
+        now = datetime.now(timezone.utc)
+        if self._snapshot is None or now.timestamp() >= self._expires:
+            self._snapshot = self._build(now)
+        return self._snapshot
+
+calendar_agenda = CalendarAgenda()
+shared_state.watch("calendar-agenda", calendar_agenda._configured, initial=True)
+shared_state.watch("calendar-feed:*", _feed_changed, initial=True)
+shared_state.watch("calendar-index:*", _index_changed, initial=True)
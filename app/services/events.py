@@ -0,0 +1,53 @@
+import json
+import asyncio
+import logging
+from typing import Any, AsyncIterator, Dict, Set
+from app.services.metrics import CONNECTED_PLAYERS
+
+logger = logging.getLogger(__name__)
+
+# Seconds between keep-alive comments (keeps proxies from closing idle streams)
+KEEPALIVE_INTERVAL = 15
+# Events buffered per connection; a stalled client drops its oldest events
+QUEUE_SIZE = 16
+
+class EventHub:
+    """
+    Broadcasts server events to connected players over Server-Sent Events.
+    Every connection has its own bounded queue, so one slow screen can't
+    hold up the others or grow memory without bound.
+    """
+    def __init__(self):
+        self._subscribers: Set[asyncio.Queue] = set()
+
+    @property
+    def connections(self) -> int:
+        return len(self._subscribers)
+
+    def publish(self, event: str, data: Dict[str, Any] = None):
+        """Queues `event` for every connected client. Safe to call from sync code on the loop."""
+        message = f"event: {event}\ndata: {json.dumps(data or {})}\n\n"
+        for queue in list(self._subscribers):
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(message)
+        logger.info(f"Event '{event}' sent to {len(self._subscribers)} clients.")
+
+    async def stream(self) -> AsyncIterator[str]:
+        """SSE body for one connection; ends when the client disconnects (task cancelled)."""
+        queue: asyncio.Queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        self._subscribers.add(queue)
+        try:
+            # Reconnect quickly after a server restart
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    message = await asyncio.wait_for(queue.get(), KEEPALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    message = ": keepalive\n\n"
+                yield message
+        finally:
+            self._subscribers.discard(queue)
+
+event_hub = EventHub()
+CONNECTED_PLAYERS.set_function(lambda: event_hub.connections)
@@ -0,0 +1,67 @@
+import os
+import asyncio
+import functools
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+# Threads for blocking file system work (media writes + fsync, directory scans,
+# state files). Bounded so a big sync can't starve the players' file reads.
+IO_WORKERS = int(os.getenv("IO_WORKERS", 4))
+# Processes for CPU-heavy pure-Python work (iCal parsing); a thread would still
+# hold the GIL against the event loop. 0 = run it in the I/O threads instead.
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", 1))
+
+_io_executor: Optional[ThreadPoolExecutor] = None
+_parse_executor: Optional[ProcessPoolExecutor] = None
+
+def process_pool(workers: int) -> ProcessPoolExecutor:
+    """
+    Process pool whose workers don't inherit this process' state: by the time
+    a pool is created the server runs threads (I/O pool, watchdog, shared
+    state), and a plain fork could copy a lock one of them holds. Workers get
+    everything through their (picklable) arguments.
+    """
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(method))
+
+def _get_io_executor() -> ThreadPoolExecutor:
+    global _io_executor
+    if _io_executor is None:
+        _io_executor = ThreadPoolExecutor(max_workers=max(1, IO_WORKERS), thread_name_prefix="io")
+    return _io_executor
+
+def _get_parse_executor() -> Optional[ProcessPoolExecutor]:
+    global _parse_executor
+    if _parse_executor is None and PARSE_WORKERS > 0:
+        _parse_executor = process_pool(PARSE_WORKERS)
+    return _parse_executor
+
+async def run_io(func: Callable, *args, **kwargs) -> Any:
+    """Runs blocking file system work in the I/O thread pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_io_executor(), functools.partial(func, *args, **kwargs))
+
+async def run_parse(func: Callable, *args) -> Any:
+    """
+    Runs a CPU-bound call in the parse process pool. `func`, its arguments and
+    its result must be picklable (module-level function, plain data).
+    """
+    loop = asyncio.get_running_loop()
+    executor = _get_parse_executor()
+    if executor is None:
+        return await run_io(func, *args)
+    return await loop.run_in_executor(executor, func, *args)
+
+def shutdown():
+    global _io_executor, _parse_executor
+    if _parse_executor is not None:
+        _parse_executor.shutdown(wait=False, cancel_futures=True)
+        _parse_executor = None
+    if _io_executor is not None:
+        # Pending writes (settings, indexes) finish before the process exits
+        _io_executor.shutdown(wait=True)
+        _io_executor = None
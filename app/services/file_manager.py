@@ -1,53 +1,432 @@
 import os
+import ssl
+import json
+import time
+import hashlib
+import tempfile
+import contextlib
+import asyncio
 import httpx
 import logging
 from pathlib import Path
-from urllib.parse import urlparse
+from typing import Dict, List, Optional, Set
+from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
+from app.services.metrics import DOWNLOAD_BYTES, DOWNLOAD_SECONDS, DOWNLOAD_THROUGHPUT, DOWNLOADS
+from app.services.executors import run_io
+from app.services.shared_state import shared_state
 
 logger = logging.getLogger(__name__)
 
 MEDIA_DIR = Path("/app/data/media")
+MEDIA_INDEX_FILE = Path("/app/data/media_index.json")
+
+# Download pipeline limits
+# DOWNLOAD_HOST_LIMITS: comma separated "host=limit" pairs, matched by domain suffix
+# (e.g. "amazonaws.com=4" covers Notion's S3 buckets).
+DOWNLOAD_CONCURRENCY = int(os.getenv("DOWNLOAD_CONCURRENCY", 6))
+DOWNLOAD_HOST_LIMITS = os.getenv("DOWNLOAD_HOST_LIMITS", "amazonaws.com=4,unsplash.com=2")
+DOWNLOAD_TIMEOUT = float(os.getenv("DOWNLOAD_TIMEOUT", 60))
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# Received chunks are collected up to this size and written in the I/O pool
+DOWNLOAD_WRITE_SIZE = 1024 * 1024
+
+_ssl_context: Optional[ssl.SSLContext] = None
+
+def ssl_context() -> ssl.SSLContext:
+    """Loading the CA bundle blocks for ~100 ms: done once per process, not per sync."""
+    global _ssl_context
+    if _ssl_context is None:
+        _ssl_context = httpx.create_ssl_context()
+    return _ssl_context
 
 def ensure_media_dir():
     if not MEDIA_DIR.exists():
         MEDIA_DIR.mkdir(parents=True, exist_ok=True)
 
-async def download_file(url: str, filename: str) -> str:
+def parse_host_limits(spec: str) -> Dict[str, int]:
+    """Parses "host=limit,host=limit" into a dict. Invalid entries are ignored."""
+    limits = {}
+    for entry in (spec or "").split(","):
+        host, _, limit = entry.strip().partition("=")
+        if not host or not limit:
+            continue
+        try:
+            limits[host.strip().lower()] = max(1, int(limit))
+        except ValueError:
+            logger.warning(f"Ignoring invalid download host limit: {entry}")
+    return limits
+
+def source_identity(url: str) -> str:
     """
-    Downloads a file from a URL to the local media directory.
-    Returns the local file path (relative to /app/data/media).
+    Stable identity of a media URL. Notion serves files from pre-signed S3 URLs
+    whose signature changes on every query, so signing parameters are dropped.
+    A replaced file in Notion gets a new path and therefore a new identity.
     """
-    ensure_media_dir()
-    filepath = MEDIA_DIR / filename
-    
-    # Simple check: if file exists, we assume it's good (for MVP).
-    # In a production app, we might check hashes or file headers.
+    parsed = urlparse(url)
+    query = [
+        (k, v) for k, v in parse_qsl(parsed.query, keep_blank_values=True)
+        if not k.lower().startswith("x-amz-") and k not in ("Expires", "Signature", "AWSAccessKeyId")
+    ]
+    return urlunparse(parsed._replace(query=urlencode(query), fragment=""))
+
+def entry_files(entry: Dict) -> Set[str]:
+    """All files in MEDIA_DIR that belong to an index entry."""
+    files = {entry["filename"]}
+    files.update(variant["filename"] for variant in entry.get("variants", []))
+    files.update(entry[field] for field in ("optimized", "poster") if entry.get(field))
+    return files
+
+class MediaIndex:
+    """
+    Persistent index of synced media, keyed by media key (page id or unsplash_<id>).
+    Each entry stores:
+        source         source_identity() of the URL it was fetched from
+        etag           ETag of the last 200 response (for If-None-Match)
+        last_modified  Last-Modified of the last 200 response (for If-Modified-Since)
+        size, sha256   of the stored content
+        filename       content-addressed file in MEDIA_DIR: <sha256[:20]><ext>
+        variants       derived files (see image_processing), named after the blob
+        optimized, poster  transcoded video and its poster frame (see video_transcoder)
+    Identical content referenced by several keys is stored once.
+    Files that an entry stopped referencing are remembered as orphans until
+    the next cleanup removes them.
+    Only the leader worker writes it; the others reload the file when a save
+    is announced in the shared state.
+    """
+    def __init__(self, path: Path = MEDIA_INDEX_FILE):
+        self.path = path
+        self.entries: Dict[str, Dict] = {}
+        self.orphans: Set[str] = set()
+        # Without an index we can't know what's on disk: do one full scan on the next cleanup
+        self.needs_sweep = True
+        self._save_lock = asyncio.Lock()
+        self.load()
+
+    @staticmethod
+    def _read(path: Path) -> Dict:
+        with open(path, "r") as f:
+            return json.load(f)
+
+    def _apply(self, data: Dict):
+        self.entries = data.get("entries", {})
+        self.orphans = set(data.get("orphans", []))
+        self.needs_sweep = False
+
+    def load(self):
+        if not self.path.exists():
+            return
+        try:
+            self._apply(self._read(self.path))
+        except Exception as e:
+            logger.error(f"Failed to read media index, starting empty: {e}")
+            self.entries = {}
+
+    async def reload(self, key: str = None, change: Dict = None):
+        """Shared state watcher: another worker saved the index."""
+        try:
+            self._apply(await run_io(self._read, self.path))
+        except Exception as e:
+            logger.error(f"Failed to reload media index: {e}")
+
+    def _snapshot(self) -> Dict:
+        # Entries are replaced on change, never mutated, so a shallow copy is consistent
+        return {"entries": dict(self.entries), "orphans": sorted(self.orphans)}
+
+    @staticmethod
+    def _write(path: Path, data: Dict):
+        tmp_path = path.with_name(path.name + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp_path, path)
+
+    def save(self):
+        self._write(self.path, self._snapshot())
+
+    async def save_async(self):
+        """save() with the JSON dump and write in the I/O pool; saves are written in call order."""
+        async with self._save_lock:
+            await run_io(self._write, self.path, self._snapshot())
+        await shared_state.set("media-index", {"saved": time.time()})
+
+    def get(self, key: str) -> Optional[Dict]:
+        return self.entries.get(key)
+
+    def put(self, key: str, entry: Dict):
+        previous = self.entries.get(key)
+        self.entries[key] = entry
+        if previous:
+            self.orphans |= entry_files(previous) - entry_files(entry)
+
+    def update(self, key: str, **fields):
+        """Sets fields on an existing entry (e.g. variants), tracking dropped files."""
+        previous = self.entries.get(key)
+        if previous is None:
+            return
+        self.put(key, {**previous, **fields})
+
+    def referenced_filenames(self) -> Set[str]:
+        files = set()
+        for entry in self.entries.values():
+            files |= entry_files(entry)
+        return files
+
+media_index = MediaIndex()
+shared_state.watch("media-index", media_index.reload)
+
+def _write_chunk(f, digest, data: bytes):
+    f.write(data)
+    digest.update(data) # hashlib releases the GIL for large buffers
+
+def _sync_and_close(f):
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
+
+def _store(tmp_path: Path, filepath: Path) -> bool:
+    """Moves the finished download to its content-addressed name; False if that content exists already."""
     if filepath.exists():
-        logger.info(f"File {filename} already exists. Skipping download.")
-        return filename
+        return False
+    os.replace(tmp_path, filepath)
+    return True
+
+async def _fetch_to_file(client: httpx.AsyncClient, url: str, ext: str, headers: Dict[str, str] = None) -> Optional[Dict]:
+    """
+    Streams the response body into a temp file in MEDIA_DIR, hashing it on the
+    way, and renames it to its content-addressed name once complete, so the
+    player never sees a half-written file. Memory use stays at one write
+    buffer regardless of file size. Writes, fsync and rename run in the I/O
+    pool, so the event loop only receives.
 
-    logger.info(f"Downloading {filename} from {url}...")
+    Returns the new index fields, or None if the server answered 304 Not Modified.
+    """
+    fd, tmp_name = await run_io(tempfile.mkstemp, dir=MEDIA_DIR, prefix=".download.", suffix=".part")
+    tmp_path = Path(tmp_name)
+    f = os.fdopen(fd, "wb")
+    digest = hashlib.sha256()
+    started = time.perf_counter()
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url, follow_redirects=True)
+        async with client.stream("GET", url, headers=headers, follow_redirects=True) as response:
+            if response.status_code == 304:
+                return None
             response.raise_for_status()
-            with open(filepath, "wb") as f:
-                f.write(response.content)
-        logger.info(f"Successfully downloaded {filename}")
-        return filename
+            expected = response.headers.get("content-length")
+            written = 0
+            buffer = bytearray()
+            async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                buffer += chunk
+                written += len(chunk)
+                if len(buffer) >= DOWNLOAD_WRITE_SIZE:
+                    data, buffer = buffer, bytearray()
+                    await run_io(_write_chunk, f, digest, data)
+            if buffer:
+                await run_io(_write_chunk, f, digest, buffer)
+            # Content-Length refers to the encoded body if the server compressed it
+            if "content-encoding" in response.headers:
+                received = response.num_bytes_downloaded
+            else:
+                received = written
+            etag = response.headers.get("etag")
+            last_modified = response.headers.get("last-modified")
+        await run_io(_sync_and_close, f)
+
+        if expected is not None and int(expected) != received:
+            raise IOError(f"Incomplete download: expected {expected} bytes, got {received}")
+
+        host = (urlparse(url).hostname or "").lower()
+        DOWNLOAD_BYTES.labels(host).inc(received)
+        elapsed = time.perf_counter() - started
+        if elapsed > 0:
+            DOWNLOAD_THROUGHPUT.labels(host).observe(received / elapsed)
+
+        sha256 = digest.hexdigest()
+        filename = f"{sha256[:20]}{ext}"
+        if not await run_io(_store, tmp_path, MEDIA_DIR / filename):
+            logger.debug("Content of %s already stored as %s. Deduplicated.", url, filename)
+
+        return {
+            "etag": etag,
+            "last_modified": last_modified,
+            "size": written,
+            "sha256": sha256,
+            "filename": filename,
+        }
+    finally:
+        f.close()
+        await run_io(tmp_path.unlink, missing_ok=True)
+
+async def download_file(url: str, key: str, ext: str, client: Optional[httpx.AsyncClient] = None, index: MediaIndex = None) -> Optional[str]:
+    """
+    Downloads the media for `key` into the local media directory, unless the
+    index shows it is unchanged. Returns the stored filename (relative to
+    /app/data/media), or None on failure.
+
+    - Same source and stored validators: conditional request (If-None-Match /
+      If-Modified-Since), 304 keeps the current file.
+    - Same source without validators: the file is trusted as-is.
+    - New source (e.g. replaced in Notion) or missing file: full download.
+    - Failed download: the previous copy for `key` is kept, if there is one.
+    If a client is passed, its connection pool is reused.
+    """
+    ensure_media_dir()
+    index = index or media_index
+    identity = source_identity(url)
+    host = (urlparse(url).hostname or "").lower()
+    entry = index.get(key)
+
+    headers = {}
+    if entry and entry.get("source") == identity and (MEDIA_DIR / entry["filename"]).exists():
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        if not headers:
+            logger.debug("Media %s unchanged (%s). Skipping download.", key, entry["filename"])
+            DOWNLOADS.labels(host, "skipped").inc()
+            return entry["filename"]
+
+    logger.debug("Downloading %s from %s...", key, url)
+    try:
+        if client is not None:
+            fetched = await _fetch_to_file(client, url, ext, headers)
+        else:
+            async with httpx.AsyncClient(timeout=DOWNLOAD_TIMEOUT, verify=ssl_context()) as own_client:
+                fetched = await _fetch_to_file(own_client, url, ext, headers)
+
+        if fetched is None:
+            logger.debug("Media %s not modified (%s).", key, entry["filename"])
+            DOWNLOADS.labels(host, "not_modified").inc()
+            return entry["filename"]
+
+        new_entry = {"source": identity, **fetched}
+        if entry and entry.get("filename") == fetched["filename"]:
+            # Same content: derived files (variants etc.) are still valid
+            new_entry = {**entry, **new_entry}
+        index.put(key, new_entry)
+        logger.debug("Successfully downloaded %s -> %s", key, fetched["filename"])
+        DOWNLOADS.labels(host, "downloaded").inc()
+        return fetched["filename"]
     except Exception as e:
-        logger.error(f"Failed to download {filename}: {e}")
+        logger.error(f"Failed to download {key}: {e}")
+        DOWNLOADS.labels(host, "failed").inc()
+        if entry and (MEDIA_DIR / entry["filename"]).exists():
+            logger.warning(f"Keeping previous copy of {key} ({entry['filename']}).")
+            return entry["filename"]
         return None
 
-def cleanup_files(active_filenames: set):
+class DownloadPool:
     """
-    Removes files in the media directory that are not in the active_filenames set.
+    Runs the downloads of one sync over a single pooled HTTP client.
+    Concurrency is bounded globally and per host (see DOWNLOAD_HOST_LIMITS),
+    so Notion's S3 and Unsplash get separate budgets.
+
+    The media index is saved when the pool closes.
+
+    Usage:
+        async with DownloadPool() as pool:
+            results = await asyncio.gather(*(pool.download(url, key, ext) for ...))
     """
-    ensure_media_dir()
-    for file in MEDIA_DIR.iterdir():
-        if file.is_file() and file.name not in active_filenames:
-            try:
-                os.remove(file)
-                logger.info(f"Removed orphaned file: {file.name}")
-            except Exception as e:
-                logger.error(f"Error removing file {file.name}: {e}")
+    def __init__(self, concurrency: int = None, host_limits: Dict[str, int] = None, index: MediaIndex = None):
+        self.concurrency = concurrency or DOWNLOAD_CONCURRENCY
+        self.host_limits = host_limits if host_limits is not None else parse_host_limits(DOWNLOAD_HOST_LIMITS)
+        self.index = index or media_index
+        self.client: Optional[httpx.AsyncClient] = None
+        self.timings: List[Dict] = []
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self._host_slots: Dict[str, asyncio.Semaphore] = {
+            host: asyncio.Semaphore(limit) for host, limit in self.host_limits.items()
+        }
+
+    async def __aenter__(self):
+        self.client = httpx.AsyncClient(
+            timeout=DOWNLOAD_TIMEOUT,
+            verify=ssl_context(),
+            limits=httpx.Limits(
+                max_connections=self.concurrency,
+                max_keepalive_connections=self.concurrency,
+            ),
+        )
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.client.aclose()
+        self.client = None
+        await self.index.save_async()
+        self.log_summary()
+
+    def _host_budget(self, host: str) -> Optional[asyncio.Semaphore]:
+        # Longest matching suffix wins ("images.unsplash.com" before "unsplash.com")
+        for suffix in sorted(self._host_slots, key=len, reverse=True):
+            if host == suffix or host.endswith("." + suffix):
+                return self._host_slots[suffix]
+        return None
+
+    async def download(self, url: str, key: str, ext: str) -> Optional[str]:
+        """Same contract as download_file, but pooled, throttled and timed."""
+        host = (urlparse(url).hostname or "").lower()
+        host_budget = self._host_budget(host)
+
+        # Host budget first: a queue for one host must not sit on the global
+        # slots while it waits, or it starves hosts that still have budget
+        async with host_budget or contextlib.nullcontext():
+            async with self._slots:
+                started = time.perf_counter()
+                result = await download_file(url, key, ext, client=self.client, index=self.index)
+                elapsed = time.perf_counter() - started
+
+        self.timings.append({
+            "key": key,
+            "host": host,
+            "seconds": round(elapsed, 3),
+            "ok": result is not None,
+        })
+        DOWNLOAD_SECONDS.labels(host).observe(elapsed)
+        logger.debug("Download timing: %s (%s) took %.2fs", key, host, elapsed)
+        return result
+
+    def log_summary(self):
+        if not self.timings:
+            return
+        total = sum(t["seconds"] for t in self.timings)
+        failed = sum(1 for t in self.timings if not t["ok"])
+        slowest = max(self.timings, key=lambda t: t["seconds"])
+        logger.info(
+            f"Downloads finished: {len(self.timings)} files, {failed} failed, "
+            f"{total:.2f}s cumulative, slowest {slowest['key']} ({slowest['seconds']:.2f}s)"
+        )
+
+def _list_media() -> Set[str]:
+    return {file.name for file in MEDIA_DIR.iterdir() if file.is_file()}
+
+def _remove_files(names: Set[str]):
+    for name in names:
+        try:
+            (MEDIA_DIR / name).unlink(missing_ok=True)
+            logger.info(f"Removed orphaned file: {name}")
+        except Exception as e:
+            logger.error(f"Error removing file {name}: {e}")
+
+async def cleanup_files(active_keys: set, index: MediaIndex = None):
+    """
+    Drops index entries whose key is not in active_keys and removes the files
+    no remaining entry references. Works from the index alone; a full directory
+    scan only happens once when no index existed yet (e.g. after an upgrade).
+    The index is updated on the loop; scan, deletes and save run in the I/O pool.
+    """
+    await run_io(ensure_media_dir)
+    index = index or media_index
+
+    before = index.referenced_filenames()
+    for key in list(index.entries):
+        if key not in active_keys:
+            del index.entries[key]
+    keep = index.referenced_filenames()
+
+    if index.needs_sweep:
+        candidates = await run_io(_list_media)
+        index.needs_sweep = False
+    else:
+        candidates = before | index.orphans
+    index.orphans = set()
+
+    await run_io(_remove_files, candidates - keep)
+    await index.save_async()
@@ -0,0 +1,119 @@
+import os
+import time
+import asyncio
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from app.services.file_manager import MEDIA_DIR
+from app.services.executors import process_pool
+from app.services.metrics import IMAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+try:
+    from PIL import Image, ImageOps
+except ImportError: # Pillow missing: the derivative stage is skipped
+    Image = None
+    logger.warning("Pillow not installed, images are served as uploaded.")
+
+# Target widths of the derived images (players pick the closest one)
+IMAGE_WIDTHS = [int(w) for w in os.getenv("IMAGE_WIDTHS", "1920,3840").split(",") if w.strip()]
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", 82))
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", 2))
+
+# Formats that are worth re-encoding (GIFs may be animated, SVGs are vectors)
+SOURCE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tif", ".tiff"}
+
+MIME_TYPES = {"avif": "image/avif", "webp": "image/webp", "jpg": "image/jpeg"}
+
+_executor: Optional[ProcessPoolExecutor] = None
+
+def is_available() -> bool:
+    return Image is not None
+
+def _output_formats() -> List[str]:
+    formats = ["webp", "jpg"]
+    Image.init()
+    if "AVIF" in Image.SAVE: # Pillow >= 11.2 built with libavif
+        formats.insert(0, "avif")
+    return formats
+
+def render_variants(source: str, widths: List[int], quality: int) -> List[Dict]:
+    """
+    Runs in a worker process: writes resized, re-encoded copies of `source`
+    next to it as <stem>_<width>.<format> and returns their descriptions.
+    Existing files are reused (names derive from the content hash).
+    Never upscales; an image narrower than all widths gets one variant at its
+    own width.
+    """
+    source_path = Path(source)
+    stem = source_path.stem
+    variants = []
+
+    with Image.open(source_path) as img:
+        img = ImageOps.exif_transpose(img)
+        has_alpha = img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info)
+        targets = sorted({w for w in widths if w < img.width} | {min(img.width, max(widths))})
+
+        for width in targets:
+            height = max(1, round(img.height * width / img.width))
+            resized = None
+            for fmt in _output_formats():
+                filename = f"{stem}_{width}.{fmt}"
+                target = source_path.parent / filename
+                if not target.exists():
+                    if resized is None:
+                        resized = img.resize((width, height), Image.LANCZOS) if width != img.width else img.copy()
+                    frame = resized
+                    if fmt == "jpg" or not has_alpha:
+                        frame = resized.convert("RGB")
+                    elif frame.mode not in ("RGBA", "RGB"):
+                        frame = frame.convert("RGBA")
+                    # Per process: identical content can be rendered by two workers at once
+                    tmp = target.with_name(f".{filename}.{os.getpid()}.part")
+                    frame.save(tmp, format="JPEG" if fmt == "jpg" else fmt.upper(), quality=quality, optimize=(fmt == "jpg"))
+                    os.replace(tmp, target)
+                variants.append({"filename": filename, "width": width, "height": height, "type": MIME_TYPES[fmt]})
+
+    return variants
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        # Not a plain fork: the server already runs threads (see process_pool)
+        _executor = process_pool(IMAGE_WORKERS)
+    return _executor
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+async def create_variants(filename: str) -> Optional[List[Dict]]:
+    """
+    Builds the derived images for a file in MEDIA_DIR in the process pool,
+    so the event loop keeps serving players. Returns None if not applicable.
+    """
+    if Image is None or Path(filename).suffix.lower() not in SOURCE_EXTENSIONS:
+        return None
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    try:
+        return await loop.run_in_executor(
+            _get_executor(), render_variants, str(MEDIA_DIR / filename), IMAGE_WIDTHS, IMAGE_QUALITY
+        )
+    except Exception as e:
+        logger.error(f"Failed to create variants for {filename}: {e}")
+        return None
+    finally:
+        IMAGE_SECONDS.observe(time.perf_counter() - started)
+
+def srcset(variants: List[Dict]) -> List[Dict]:
+    """Playlist representation of the variants: [{"src", "width", "type"}, ...]."""
+    return [
+        {"src": f"/media/{v['filename']}", "width": v["width"], "type": v["type"]}
+        for v in variants
+    ]
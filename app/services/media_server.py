@@ -0,0 +1,244 @@
+import os
+import re
+import gzip
+import hashlib
+import logging
+import anyio
+from email.utils import formatdate
+from mimetypes import guess_type
+from typing import Dict, Optional, Tuple
+from fastapi import Request, Response
+from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse
+from starlette.staticfiles import NotModifiedResponse
+from app.services.metrics import CONDITIONAL_RESPONSES, route_label
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - optional, gzip is always available
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# Synced media is stored as <sha256[:20]><ext> (plus derived _<width>/_opt/_poster
+# files): the name changes whenever the content does, so browsers may keep it forever.
+HASHED_NAME = re.compile(r"^[0-9a-f]{20}(_[A-Za-z0-9]+)?\.[A-Za-z0-9]+$")
+CACHE_IMMUTABLE = "public, max-age=31536000, immutable"
+CACHE_REVALIDATE = "no-cache"
+
+# Preferred order when the client accepts several encodings
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+COMPRESSIBLE = {".html", ".css", ".js", ".json", ".svg", ".txt", ".map", ".webmanifest"}
+MIN_COMPRESS_SIZE = 256
+
+def accepted_encodings(headers: Headers) -> set:
+    accepted = set()
+    for part in headers.get("accept-encoding", "").split(","):
+        token, _, params = part.strip().partition(";")
+        if params.strip().replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        if token:
+            accepted.add(token.strip().lower())
+    return accepted
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    Parses a single `bytes=` range into an inclusive (start, end) pair.
+    Returns None for headers we don't handle (other units, multiple ranges),
+    in which case the full file is sent. Raises ValueError if unsatisfiable.
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, sep, last = (part.strip() for part in spec.strip().partition("-"))
+    if not sep or not (first or last) or not (first + last).isdigit():
+        return None
+    if not first:
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0 or size == 0:
+            raise ValueError("empty suffix range")
+        return max(0, size - length), size - 1
+    start = int(first)
+    end = int(last) if last else size - 1
+    if start >= size:
+        raise ValueError("range not satisfiable")
+    if end < start:
+        return None
+    return start, min(end, size - 1)
+
+class RangeFileResponse(FileResponse):
+    """206 Partial Content for one byte range of a file (seeking in videos)."""
+    def __init__(self, path: str, start: int, end: int, **kwargs):
+        super().__init__(path, status_code=206, **kwargs)
+        self.start = start
+        self.end = end
+        self.headers["content-length"] = str(end - start + 1)
+        self.headers["content-range"] = f"bytes {start}-{end}/{self.stat_result.st_size}"
+
+    async def __call__(self, scope, receive, send):
+        await send({
+            "type": "http.response.start",
+            "status": self.status_code,
+            "headers": self.raw_headers,
+        })
+        if scope["method"].upper() == "HEAD":
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+
+        remaining = self.end - self.start + 1
+        # Reads in worker threads like FileResponse, so a slow disk doesn't stall the loop
+        async with await anyio.open_file(self.path, "rb") as f:
+            await f.seek(self.start)
+            while remaining > 0:
+                chunk = await f.read(min(self.chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+        if remaining > 0:
+            # File shrank underneath us; close the response cleanly
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+class CachedStaticFiles(StaticFiles):
+    """
+    StaticFiles with the caching behaviour the players need:
+    - content-hashed media names are `immutable` for a year, everything else
+      is revalidated against ETag/Last-Modified (`no-cache`),
+    - single byte ranges are answered with 206 so videos can seek without a
+      full download (If-Range is honoured),
+    - with `precompressed=True`, `<file>.br` / `<file>.gz` next to the file are
+      served when the client accepts them (see precompress()).
+    """
+    def __init__(self, *args, precompressed: bool = False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.precompressed = precompressed
+
+    def _compressed_variant(self, full_path, stat_result, request_headers: Headers):
+        accepted = accepted_encodings(request_headers)
+        for encoding, suffix in ENCODINGS:
+            if encoding not in accepted:
+                continue
+            try:
+                compressed = os.stat(full_path + suffix)
+            except OSError:
+                continue
+            # A copy older than the source is stale (e.g. after `git pull`)
+            if compressed.st_mtime >= stat_result.st_mtime:
+                return encoding, full_path + suffix, compressed
+        return None
+
+    def file_response(self, full_path, stat_result, scope, status_code: int = 200) -> Response:
+        request_headers = Headers(scope=scope)
+        name = os.path.basename(full_path)
+        media_type = guess_type(name)[0] or "text/plain"
+        headers = {
+            "Cache-Control": CACHE_IMMUTABLE if HASHED_NAME.match(name) else CACHE_REVALIDATE,
+        }
+
+        encoding = None
+        if self.precompressed and os.path.splitext(name)[1] in COMPRESSIBLE:
+            headers["Vary"] = "Accept-Encoding"
+            variant = self._compressed_variant(full_path, stat_result, request_headers)
+            if variant:
+                encoding, full_path, stat_result = variant
+                headers["Content-Encoding"] = encoding
+        if encoding is None:
+            headers["Accept-Ranges"] = "bytes"
+
+        response = FileResponse(
+            full_path, status_code=status_code, headers=headers,
+            media_type=media_type, stat_result=stat_result,
+        )
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+
+        range_header = request_headers.get("range")
+        if range_header and encoding is None and status_code == 200:
+            if_range = request_headers.get("if-range")
+            if if_range is None or if_range in (response.headers["etag"], response.headers["last-modified"]):
+                size = stat_result.st_size
+                try:
+                    byte_range = parse_range(range_header, size)
+                except ValueError:
+                    return Response(status_code=416, headers={
+                        "Content-Range": f"bytes */{size}",
+                        "Cache-Control": headers["Cache-Control"],
+                    })
+                if byte_range:
+                    start, end = byte_range
+                    return RangeFileResponse(
+                        full_path, start, end, headers=headers,
+                        media_type=media_type, stat_result=stat_result,
+                    )
+        return response
+
+def compress_file(path: str) -> int:
+    """Writes `.gz` (and `.br` if brotli is installed) next to `path`. Returns files written."""
+    with open(path, "rb") as f:
+        data = f.read()
+    written = 0
+    encoders = [(".gz", lambda d: gzip.compress(d, 9, mtime=0))]
+    if brotli is not None:
+        encoders.append((".br", lambda d: brotli.compress(d, quality=11)))
+    for suffix, encode in encoders:
+        target = path + suffix
+        try:
+            if os.stat(target).st_mtime >= os.stat(path).st_mtime:
+                continue
+        except OSError:
+            pass
+        tmp = target + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(encode(data))
+        os.replace(tmp, target)
+        written += 1
+    return written
+
+def precompress(directory: str) -> int:
+    """Creates/refreshes compressed copies of the text assets below `directory`."""
+    written = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            path = os.path.join(root, name)
+            if os.path.splitext(name)[1] not in COMPRESSIBLE:
+                continue
+            try:
+                if os.path.getsize(path) < MIN_COMPRESS_SIZE:
+                    continue
+                written += compress_file(path)
+            except OSError as e:
+                logger.warning(f"Could not precompress {path}: {e}")
+    if written:
+        logger.info(f"Precompressed {written} static asset copies in {directory}.")
+    return written
+
+class CompressedPage:
+    """A rendered page kept in memory in identity/gzip/br form, with an ETag."""
+    def __init__(self, body: bytes, media_type: str = "text/html"):
+        self.media_type = media_type
+        self.etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+        self.last_modified = formatdate(usegmt=True)
+        self.bodies: Dict[str, bytes] = {"identity": body, "gzip": gzip.compress(body, 9, mtime=0)}
+        if brotli is not None:
+            self.bodies["br"] = brotli.compress(body, quality=11)
+
+    def response(self, request: Request) -> Response:
+        headers = {
+            "ETag": self.etag,
+            "Cache-Control": CACHE_REVALIDATE,
+            "Vary": "Accept-Encoding",
+        }
+        if_none_match = request.headers.get("if-none-match", "")
+        if self.etag in [tag.strip() for tag in if_none_match.split(",")]:
+            CONDITIONAL_RESPONSES.labels(route_label(request.scope), "not_modified").inc()
+            return Response(status_code=304, headers=headers)
+        CONDITIONAL_RESPONSES.labels(route_label(request.scope), "full").inc()
+
+        accepted = accepted_encodings(request.headers)
+        for encoding, _ in ENCODINGS:
+            if encoding in accepted and encoding in self.bodies:
+                headers["Content-Encoding"] = encoding
+                return Response(self.bodies[encoding], headers=headers, media_type=self.media_type)
+        return Response(self.bodies["identity"], headers=headers, media_type=self.media_type)
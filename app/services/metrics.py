@@ -0,0 +1,127 @@
+import time
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+from fastapi import Response
+
+# All metric names share this prefix
+PREFIX = "signage"
+
+# Buckets (seconds) for network calls and sync stages
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+# Buckets (bytes/s) for download throughput: 100 kB/s .. 1 GB/s
+THROUGHPUT_BUCKETS = (1e5, 5e5, 1e6, 5e6, 1e7, 5e7, 1e8, 5e8, 1e9)
+# Buckets (seconds) for event-loop lag
+LAG_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+# --- Sync ---
+SYNC_RUNS = Counter(f"{PREFIX}_sync_runs_total", "Notion sync runs.", ["mode", "state"])
+SYNC_PHASE_SECONDS = Histogram(
+    f"{PREFIX}_sync_phase_seconds", "Duration of the sync phases (query, parse, download, images, write, cleanup).",
+    ["phase"], buckets=LATENCY_BUCKETS,
+)
+SYNC_PAGES = Counter(f"{PREFIX}_sync_pages_total", "Notion pages processed by syncs.", ["source"])
+
+# --- Media downloads ---
+DOWNLOADS = Counter(
+    f"{PREFIX}_downloads_total", "Media downloads by result (downloaded, not_modified, skipped, failed).",
+    ["host", "result"],
+)
+DOWNLOAD_SECONDS = Histogram(
+    f"{PREFIX}_download_seconds", "Duration of one media download (once it got a connection slot).",
+    ["host"], buckets=LATENCY_BUCKETS,
+)
+DOWNLOAD_BYTES = Counter(f"{PREFIX}_download_bytes_total", "Media bytes downloaded.", ["host"])
+DOWNLOAD_THROUGHPUT = Histogram(
+    f"{PREFIX}_download_throughput_bytes_per_second", "Transfer rate of completed media downloads.",
+    ["host"], buckets=THROUGHPUT_BUCKETS,
+)
+IMAGE_SECONDS = Histogram(
+    f"{PREFIX}_image_variants_seconds", "Time to render the variants of one image (process pool).",
+    buckets=LATENCY_BUCKETS,
+)
+
+# --- External APIs ---
+NOTION_REQUESTS = Counter(
+    f"{PREFIX}_notion_requests_total", "Notion API calls by endpoint and outcome (ok or HTTP status / error class).",
+    ["endpoint", "status"],
+)
+NOTION_SECONDS = Histogram(
+    f"{PREFIX}_notion_request_seconds", "Latency of single Notion API calls (without throttling).",
+    ["endpoint"], buckets=LATENCY_BUCKETS,
+)
+NOTION_THROTTLE_SECONDS = Histogram(
+    f"{PREFIX}_notion_throttle_seconds", "Time calls waited for a token of the rate limiter.",
+    buckets=LATENCY_BUCKETS,
+)
+CALENDAR_FETCHES = Counter(
+    f"{PREFIX}_calendar_fetches_total", "Calendar feed refreshes (parsed, unchanged, not_modified, error).",
+    ["result"],
+)
+CALENDAR_SECONDS = Histogram(
+    f"{PREFIX}_calendar_fetch_seconds", "Duration of one calendar feed refresh (fetch + parse).",
+    buckets=LATENCY_BUCKETS,
+)
+
+# --- Serving ---
+HTTP_REQUESTS = Histogram(
+    f"{PREFIX}_http_request_seconds", "Request duration by route template and status.",
+    ["route", "method", "status"], buckets=LATENCY_BUCKETS,
+)
+CONDITIONAL_RESPONSES = Counter(
+    f"{PREFIX}_conditional_responses_total", "Snapshot/page responses: not_modified (304, client cache hit) or full.",
+    ["route", "result"],
+)
+CACHE_LOOKUPS = Counter(
+    f"{PREFIX}_cache_lookups_total", "Server-side cache lookups (schedule, manifest) by result (hit, miss).",
+    ["cache", "result"],
+)
+CONNECTED_PLAYERS = Gauge(f"{PREFIX}_connected_players", "Players connected to the event stream.")
+TELEMETRY_REPORTS = Counter(f"{PREFIX}_telemetry_reports_total", "Player heartbeats received.")
+SCREENS_ONLINE = Gauge(f"{PREFIX}_screens_online", "Screens that sent a heartbeat recently.")
+EVENT_LOOP_LAG = Histogram(
+    f"{PREFIX}_event_loop_lag_seconds", "How late the event-loop probe woke up, i.e. how long the loop was blocked.",
+    buckets=LAG_BUCKETS,
+)
+EVENT_LOOP_LAG_MAX = Gauge(f"{PREFIX}_event_loop_lag_max_seconds", "Largest event-loop lag since startup.")
+EVENT_LOOP_STALLS = Counter(f"{PREFIX}_event_loop_stalls_total", "Times the event loop was blocked longer than LOOP_WATCHDOG_THRESHOLD.")
+
+# Not timed: long-lived streams and the scrape itself
+UNTIMED_ROUTES = {"/api/events", "/metrics"}
+
+def route_label(scope) -> str:
+    """Route template (e.g. "/api/playlist"), so paths with IDs don't explode the label set."""
+    route = scope.get("route")
+    if route is not None:
+        return route.path
+    path = scope.get("path", "")
+    for mount in ("/media", "/static"):
+        if path.startswith(mount + "/"):
+            return mount
+    return "unmatched"
+
+class MetricsMiddleware:
+    """ASGI middleware timing every HTTP request by route template."""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        started = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = route_label(scope)
+            if route not in UNTIMED_ROUTES:
+                HTTP_REQUESTS.labels(route, scope["method"], str(status)).observe(time.perf_counter() - started)
+
+def metrics_response() -> Response:
+    return Response(generate_latest(), headers={"Content-Type": CONTENT_TYPE_LATEST})
@@ -0,0 +1,195 @@
+import os
+import time
+import random
+import asyncio
+import logging
+from operator import attrgetter
+from typing import Any, Dict, List, Optional
+import httpx
+from notion_client import AsyncClient
+from notion_client.errors import HTTPResponseError, RequestTimeoutError
+from app.services.metrics import NOTION_REQUESTS, NOTION_SECONDS, NOTION_THROTTLE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Notion allows about 3 requests/s per integration (token)
+NOTION_RATE = float(os.getenv("NOTION_RATE", 3))
+NOTION_BURST = int(os.getenv("NOTION_BURST", 3))
+# Retries of a rate limited (429), unavailable or timed out call, with exponential backoff
+NOTION_RETRIES = int(os.getenv("NOTION_RETRIES", 5))
+NOTION_BACKOFF = float(os.getenv("NOTION_BACKOFF", 1.0))
+NOTION_TIMEOUT = float(os.getenv("NOTION_TIMEOUT", 60))
+# Alternative API root, e.g. a fake server for benchmarks
+NOTION_BASE_URL = os.getenv("NOTION_BASE_URL")
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+class TokenBucket:
+    """
+    Classic token bucket: `rate` tokens per second, at most `burst` stored.
+    Waiters are served in order. pause() empties the bucket until a point in
+    time (Retry-After of a 429).
+    """
+    def __init__(self, rate: float = NOTION_RATE, burst: int = NOTION_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0.0
+
+    async def acquire(self) -> float:
+        """Takes one token; returns the seconds spent waiting for it."""
+        waited = 0.0
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if self.paused_until > now:
+                    delay = self.paused_until - now
+                else:
+                    self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return waited
+                    delay = (1 - self.tokens) / self.rate
+                await asyncio.sleep(delay)
+                waited += delay
+
+class RateLimit:
+    """
+    Backoff state of one source. A failed call pauses all calls of that
+    source until its backoff has passed; other sources keep going (unless
+    they share the token, whose bucket is paused on 429 as well).
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self.resume_at = 0.0
+        self.retries = 0
+
+class NotionAPI:
+    """
+    Shared access layer for all Notion calls: one long-lived client (the token
+    is passed per request), a token bucket per integration token and retries
+    that honour Retry-After. Counters show how close we run to the limit.
+    """
+    def __init__(self):
+        self._client: Optional[AsyncClient] = None
+        self._buckets: Dict[str, TokenBucket] = {}
+        self.requests = 0
+        self.retries = 0
+        self.rate_limited = 0 # 429 responses
+        self.errors = 0
+        self.throttle_waits = 0
+        self.throttle_wait_seconds = 0.0
+
+    @property
+    def client(self) -> AsyncClient:
+        if self._client is None:
+            options = {"timeout_ms": int(NOTION_TIMEOUT * 1000)}
+            if NOTION_BASE_URL:
+                options["base_url"] = NOTION_BASE_URL
+            self._client = AsyncClient(options, client=httpx.AsyncClient(
+                timeout=NOTION_TIMEOUT,
+                limits=httpx.Limits(max_connections=10, max_keepalive_connections=5),
+            ))
+        return self._client
+
+    def bucket(self, token: str) -> TokenBucket:
+        bucket = self._buckets.get(token)
+        if bucket is None:
+            bucket = self._buckets[token] = TokenBucket()
+        return bucket
+
+    async def call(self, token: str, endpoint: str, rate_limit: RateLimit = None, **kwargs) -> Any:
+        """Calls e.g. endpoint="databases.query" with throttling and retries."""
+        func = attrgetter(endpoint)(self.client)
+        bucket = self.bucket(token)
+        attempt = 0
+        while True:
+            if rate_limit is not None:
+                delay = rate_limit.resume_at - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+            waited = await bucket.acquire()
+            NOTION_THROTTLE_SECONDS.observe(waited)
+            if waited > 0:
+                self.throttle_waits += 1
+                self.throttle_wait_seconds += waited
+
+            self.requests += 1
+            started = time.perf_counter()
+            try:
+                result = await func(auth=token, **kwargs)
+                NOTION_SECONDS.labels(endpoint).observe(time.perf_counter() - started)
+                NOTION_REQUESTS.labels(endpoint, "ok").inc()
+                return result
+            except (HTTPResponseError, RequestTimeoutError, httpx.TransportError) as e:
+                NOTION_SECONDS.labels(endpoint).observe(time.perf_counter() - started)
+                status = getattr(e, "status", None)
+                NOTION_REQUESTS.labels(endpoint, str(status or e.__class__.__name__)).inc()
+                if status == 429:
+                    self.rate_limited += 1
+                retryable = status is None or status in RETRY_STATUSES
+                if not retryable or attempt >= NOTION_RETRIES:
+                    self.errors += 1
+                    raise
+
+                retry_after = e.headers.get("retry-after") if isinstance(e, HTTPResponseError) else None
+                try:
+                    wait = float(retry_after)
+                except (TypeError, ValueError):
+                    wait = NOTION_BACKOFF * 2 ** attempt
+                wait += random.uniform(0, NOTION_BACKOFF / 2)
+                if status == 429:
+                    # The limit is per integration: everyone using this token waits
+                    bucket.pause(wait)
+                if rate_limit is not None:
+                    rate_limit.resume_at = max(rate_limit.resume_at, time.monotonic() + wait)
+                    rate_limit.retries += 1
+                attempt += 1
+                self.retries += 1
+                name = f"'{rate_limit.name}' " if rate_limit else ""
+                logger.warning(f"Notion {endpoint} {name}failed ({status or e.__class__.__name__}), retry {attempt}/{NOTION_RETRIES} in {wait:.1f}s.")
+
+    async def query_database(self, token: str, database_id: str, query_filter: Dict = None,
+                             rate_limit: RateLimit = None) -> List[Dict]:
+        """Queries a Notion database, following next_cursor until all pages are fetched."""
+        results = []
+        cursor = None
+        while True:
+            kwargs = {"database_id": database_id, "page_size": 100}
+            if query_filter:
+                kwargs["filter"] = query_filter
+            if cursor:
+                kwargs["start_cursor"] = cursor
+            response = await self.call(token, "databases.query", rate_limit, **kwargs)
+            results.extend(response.get("results", []))
+            if not response.get("has_more"):
+                return results
+            cursor = response.get("next_cursor")
+
+    async def retrieve_page(self, token: str, page_id: str, rate_limit: RateLimit = None) -> Dict:
+        return await self.call(token, "pages.retrieve", rate_limit, page_id=page_id)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "retries": self.retries,
+            "rate_limited": self.rate_limited,
+            "errors": self.errors,
+            "throttle_waits": self.throttle_waits,
+            "throttle_wait_seconds": round(self.throttle_wait_seconds, 3),
+            "rate_per_second": NOTION_RATE,
+        }
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+notion_api = NotionAPI()
@@ -1,222 +1,605 @@
 import os
 import json
+import time
+import hashlib
+import asyncio
 import logging
+from contextlib import contextmanager
 from datetime import datetime, timezone
 from urllib.parse import urlparse
 from pathlib import Path
-from notion_client import AsyncClient
-from app.services import file_manager
+from typing import Dict, Any, List, Optional
+from app.services import file_manager, image_processing
+from app.services.notion_api import RateLimit, notion_api
+from app.services.schedule import slide_schedule
+from app.services.video_transcoder import video_transcoder
+from app.services.metrics import SYNC_PAGES, SYNC_PHASE_SECONDS
+from app.services.executors import run_io
+from app.services.shared_state import shared_state
 
 logger = logging.getLogger(__name__)
 
-# Constants for Notion Properties
-PROP_NAME = "Name"
-PROPERTY_DESCRIPTION = "Description"
-PROPERTY_MEDIA = "Media"
-PROPERTY_START = "Start" # Support legacy
-PROPERTY_DATE = "Date" # Standard Notion name
-PROPERTY_END = "End"
-PROPERTY_DURATION = "Duration"
-PROPERTY_ACTIVE = "Active"
-PROPERTY_LAYOUT = "Layout" # New
-PROPERTY_ORDER = "Order" # Sort order
-PROPERTY_UNSPLASH = "Unsplash" # Unsplash URL or ID
+# Default Notion property names; every source can map them to its own columns
+DEFAULT_PROPERTIES = {
+    "name": "Name",
+    "description": "Description",
+    "media": "Media",
+    "start": "Start", # Support legacy
+    "date": "Date", # Standard Notion name
+    "duration": "Duration",
+    "active": "Active",
+    "layout": "Layout",
+    "order": "Order", # Sort order
+    "unsplash": "Unsplash", # Unsplash URL or ID
+    "channels": "Channels", # Multi-select: screens/channels showing the slide (empty = all)
+}
 
 PLAYLIST_FILE = Path("/app/data/playlist.json")
+# Per-page snapshot (last_edited_time, properties digest + parsed slide) used by incremental syncs
+SYNC_STATE_FILE = Path("/app/data/sync_state.json")
+# Optional list of databases: [{"name", "database_id", "token"?, "properties"?}]
+SOURCES_FILE = Path("/app/data/sources.json")
+# Name of the source configured through NOTION_DATABASE_ID
+DEFAULT_SOURCE = "default"
 
-async def sync_notion_data():
+# Incremental syncs can't see deleted/archived pages, so escalate to a full
+# resync when the last one is older than this (seconds).
+FULL_SYNC_INTERVAL = int(os.getenv("FULL_SYNC_INTERVAL", 3600))
+
+class SyncProgress:
+    """Live progress of one sync run, reported by the sync status endpoint."""
+    def __init__(self):
+        self.mode = None
+        self.phase = None
+        self.phase_durations: Dict[str, float] = {}
+        self.pages_total = 0
+        self.pages_processed = 0
+        self.downloads_total = 0
+        self.downloads_pending = 0
+        self.source_errors: Dict[str, str] = {}
+        self.error: Optional[str] = None
+
+    @contextmanager
+    def track(self, phase: str):
+        self.phase = phase
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self.phase_durations[phase] = round(elapsed, 3)
+            SYNC_PHASE_SECONDS.labels(phase).observe(elapsed)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "mode": self.mode,
+            "phase": self.phase,
+            "phase_durations": dict(self.phase_durations),
+            "pages_total": self.pages_total,
+            "pages_processed": self.pages_processed,
+            "downloads_total": self.downloads_total,
+            "downloads_pending": self.downloads_pending,
+            "source_errors": dict(self.source_errors),
+            "error": self.error,
+        }
+
+def _parse_date(value: Optional[str]) -> Optional[datetime]:
+    if not value:
+        return None
+    d = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if d.tzinfo is None:
+         d = d.replace(tzinfo=timezone.utc)
+    return d
+
+# Backoff state survives between syncs, so a throttled source stays throttled
+_rate_limits: Dict[str, RateLimit] = {}
+
+class NotionSource:
+    """One Notion database feeding the playlist, with its own property names."""
+    def __init__(self, name: str, database_id: str, token: str = None, properties: Dict[str, str] = None):
+        self.name = name
+        self.database_id = database_id
+        self.token = token or os.getenv("NOTION_TOKEN")
+        self.properties = {**DEFAULT_PROPERTIES, **(properties or {})}
+        self.rate_limit = _rate_limits.setdefault(name, RateLimit(name))
+
+def load_sources() -> List[NotionSource]:
+    """Sources from sources.json, or the single NOTION_DATABASE_ID database."""
+    if SOURCES_FILE.exists():
+        try:
+            with open(SOURCES_FILE, "r") as f:
+                entries = json.load(f)
+            return [
+                NotionSource(entry.get("name") or entry["database_id"], entry["database_id"],
+                             entry.get("token"), entry.get("properties"))
+                for entry in entries if entry.get("database_id")
+            ]
+        except Exception as e:
+            logger.error(f"Failed to read {SOURCES_FILE}: {e}")
+            return []
+    database_id = os.getenv("NOTION_DATABASE_ID")
+    return [NotionSource(DEFAULT_SOURCE, database_id)] if database_id else []
+
+def load_sync_state() -> Dict[str, Any]:
+    if not SYNC_STATE_FILE.exists():
+        return {}
+    try:
+        with open(SYNC_STATE_FILE, "r") as f:
+            state = json.load(f)
+    except Exception as e:
+        logger.error(f"Failed to read sync state, next sync will be full: {e}")
+        return {}
+
+    # Single-database state (before sources): becomes the default source
+    if "sources" not in state and state.get("database_id"):
+        for record in state.get("pages", {}).values():
+            record.setdefault("source", DEFAULT_SOURCE)
+        state = {
+            "sources": {DEFAULT_SOURCE: {k: state.get(k) for k in ("database_id", "watermark", "last_full_sync")}},
+            "pages": state.get("pages", {}),
+        }
+    return state
+
+def _write_json(path: Path, data: Any, indent: int = None):
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, indent=indent)
+    os.replace(tmp_path, path)
+
+async def save_sync_state(state: Dict[str, Any]):
+    # All pages of all sources: dumped in the I/O pool, not on the loop
+    await run_io(_write_json, SYNC_STATE_FILE, state)
+
+def _properties_digest(page: Dict) -> str:
+    """
+    Fingerprint of a page's properties. Notion-hosted file URLs are signed
+    anew on every query, so only their path counts.
+    """
+    def stable(value):
+        if isinstance(value, dict):
+            if "url" in value and "expiry_time" in value:
+                return urlparse(value["url"]).path
+            return {k: stable(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [stable(v) for v in value]
+        return value
+    data = json.dumps(stable(page.get("properties", {})), sort_keys=True)
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+def parse_page(page: Dict, properties: Dict[str, str] = DEFAULT_PROPERTIES) -> Optional[Dict]:
+    """
+    Converts a Notion page into a slide record, or None if the page is disabled.
+    `properties` maps the fields to the column names of the page's database.
+    The record keeps the time window and the media to download:
+        {"slide": {...}, "start": iso|None, "end": iso|None, "media": {...}|None}
+    """
+    props = page.get("properties", {})
+    prop = lambda key: props.get(properties[key]) or {}
+
+    # Extract basic info
+    title_list = prop("name").get("title", [])
+    title = title_list[0]["plain_text"] if title_list else "Untitled"
+
+    # Check Active Checkbox
+    is_active_checkbox = prop("active").get("checkbox", True)
+    if not is_active_checkbox:
+        logger.debug("Skipping '%s': Active checkbox is unchecked.", title)
+        return None
+
+    # Check Dates (Support 'Date' or 'Start')
+    date_prop = prop("date").get("date") or prop("start").get("date")
+    start_date = None
+    end_date = None
+
+    if date_prop:
+        start_date = _parse_date(date_prop.get("start"))
+        end_date = _parse_date(date_prop.get("end"))
+
+    # Extract Media
+    files = prop("media").get("files", [])
+    media_url = None
+    media_type = "text"
+    media_key = None
+    media_ext = None
+
+    if files:
+        f = files[0]
+        # Notion file objects have 'file' or 'external' keys
+        if "file" in f:
+            media_url = f["file"]["url"]
+        elif "external" in f:
+            media_url = f["external"]["url"]
+
+        if media_url:
+            # Media is indexed by page ID; the stored filename is content-addressed
+            ext = os.path.splitext(urlparse(media_url).path)[1].lower()
+            if not ext:
+                ext = ".jpg" # Default fallback
+
+            media_key = page["id"]
+            media_ext = ext
+
+            # Determine type
+            if ext in ['.mp4', '.mov', '.webm']:
+                media_type = "video"
+            else:
+                media_type = "image"
+
+    # Unsplash Fallback
+    if not media_url:
+        unsplash_val = prop("unsplash").get("url") or prop("unsplash").get("rich_text", [])
+        unsplash_url = None
+        if isinstance(unsplash_val, list) and len(unsplash_val) > 0:
+            unsplash_url = unsplash_val[0].get("plain_text")
+        elif isinstance(unsplash_val, str):
+            unsplash_url = unsplash_val
+
+        if unsplash_url:
+            logger.debug("Processing Unsplash Property: %s", unsplash_url)
+            try:
+                parsed = urlparse(unsplash_url)
+                if "unsplash.com" in parsed.netloc:
+                     # Extract ID from path.
+                     # Formats:
+                     # - /photos/ID
+                     # - /de/fotos/slug-ID
+                     # - /photos/slug-ID
+
+                     path_parts = parsed.path.strip("/").split("/")
+                     if not path_parts:
+                         raise ValueError("Empty path")
+
+                     last_segment = path_parts[-1]
+
+                     # If slugged (contains dashes), usually ID is the last part
+                     # ID usually doesn't contain dashes.
+                     photo_id = last_segment.split("-")[-1]
+
+                     download_url = f"https://unsplash.com/photos/{photo_id}/download"
+                     media_key = f"unsplash_{photo_id}"
+                     media_ext = ".jpg"
+
+                     logger.debug("Unsplash ID: %s | Download URL: %s", photo_id, download_url)
+
+                     media_url = download_url
+                     media_type = "image"
+                else:
+                     logger.warning(f"Ignored non-Unsplash URL: {unsplash_url}")
+            except Exception as e:
+                logger.error(f"Error processing Unsplash url: {e}")
+                media_key = None
+
+    # Extract Duration
+    duration = prop("duration").get("number", 10) or 10
+
+    # Extract Description
+    desc_list = prop("description").get("rich_text", [])
+    description = "".join([t["plain_text"] for t in desc_list])
+
+    # Extract Layout
+    layout_select = prop("layout").get("select")
+    layout = layout_select["name"] if layout_select else "Standard"
+
+    # Extract Order
+    order = prop("order").get("number", 999) or 999
+
+    # Extract Channels
+    channels = [option["name"] for option in prop("channels").get("multi_select", [])]
+
+    # Media fields are filled in once the download succeeded
+    slide = {
+        "id": page["id"],
+        "title": title,
+        "description": description,
+        "type": "text",
+        "src": None,
+        "duration": duration,
+        "layout": layout,
+        "order": order
+    }
+
+    media = None
+    if media_url and media_key:
+        media = {"url": media_url, "key": media_key, "ext": media_ext, "type": media_type}
+
+    return {
+        "last_edited_time": page.get("last_edited_time"),
+        "start": start_date.isoformat() if start_date else None,
+        "end": end_date.isoformat() if end_date else None,
+        "channels": channels,
+        "media": media,
+        "media_failed": False,
+        "slide": slide,
+    }
+
+def resolve_media(record: Dict) -> Dict:
+    """Slide with media fields that depend on later processing (transcoded video, poster)."""
+    slide = record["slide"]
+    media = record.get("media")
+    if not media or media["type"] != "video" or not slide.get("src"):
+        return slide
+    entry = file_manager.media_index.get(media["key"])
+    if not entry or not entry.get("optimized"):
+        return slide
+    # Serve the optimized file once it is ready, the original until then
+    return {**slide, "src": f"/media/{entry['optimized']}", "poster": f"/media/{entry['poster']}"}
+
+def build_playlist(records: Dict[str, Dict]) -> List[Dict]:
+    """
+    Returns all candidate slides with their time window ("start"/"end") and
+    channels, sorted by Order. Which of them are active is decided per request
+    by the schedule, so Start/End take effect without waiting for a sync.
+    """
+    candidates = [
+        {
+            **resolve_media(record),
+            "start": record.get("start"),
+            "end": record.get("end"),
+            "channels": record.get("channels") or [],
+        }
+        for record in records.values()
+    ]
+
+    # Sort by Order
+    candidates.sort(key=lambda x: x["order"])
+    return candidates
+
+# Held while playlist.json and sync_state.json are written together (a sync's
+# write phase) and by rebuild_playlist, so a rebuild never reads the state of
+# before a sync and then overwrites that sync's playlist
+_playlist_lock = asyncio.Lock()
+
+async def write_playlist(candidates: List[Dict]):
+    # Write to playlist.json (in the I/O pool) and hand the candidates to the scheduler
+    await run_io(_write_json, PLAYLIST_FILE, candidates, 2)
+    slide_schedule.load(candidates)
+    # The other workers load the file when they see the change
+    await shared_state.set("playlist", {"written": time.time()})
+
+def _read_json(path: Path) -> Any:
+    with open(path, "r") as f:
+        return json.load(f)
+
+async def _playlist_changed(key: str, change: Dict):
+    try:
+        candidates = await run_io(_read_json, PLAYLIST_FILE)
+    except Exception as e:
+        logger.error(f"Failed to reload playlist: {e}")
+        return
+    slide_schedule.load(candidates)
+
+shared_state.watch("playlist", _playlist_changed)
+
+async def rebuild_playlist():
+    """Rebuilds the playlist from the stored records, without asking Notion (e.g. a video finished transcoding)."""
+    async with _playlist_lock:
+        state = await run_io(load_sync_state)
+        if not state.get("pages"):
+            return
+        await write_playlist(build_playlist(state["pages"]))
+    logger.info("Playlist rebuilt from sync state.")
+
+async def download_media(records: List[Dict], progress: SyncProgress = None):
+    """Downloads the media of the given records concurrently and fills in their slides."""
+    progress = progress or SyncProgress()
+    pending = [record for record in records if record.get("media")]
+    progress.downloads_total = progress.downloads_pending = len(pending)
+    if not pending:
+        return
+
+    async def _download(pool, media):
+        try:
+            return await pool.download(media["url"], media["key"], media["ext"])
+        finally:
+            progress.downloads_pending -= 1
+
+    # Download all media concurrently (bounded per host), then finalize slides
+    async with file_manager.DownloadPool() as pool:
+        results = await asyncio.gather(*(_download(pool, r["media"]) for r in pending))
+
+    for record, result in zip(pending, results):
+        slide = record["slide"]
+        if result:
+            slide["type"] = record["media"]["type"]
+            slide["src"] = f"/media/{result}"
+            record["media_failed"] = False
+        else:
+            # Prevents showing broken image; retried on the next sync
+            logger.error(f"Download failed for {record['media']['key']}, falling back to description-only.")
+            slide["type"] = "text"
+            slide["src"] = None
+            record["media_failed"] = True
+
+async def process_images(records: List[Dict]):
+    """
+    Post-download stage: resolution-matched variants (WebP/AVIF + JPEG) of
+    every image slide, rendered in a process pool. The slide gets a
+    srcset-style list; "src" stays the original as fallback.
+    """
+    pending = [
+        r for r in records
+        if r.get("media") and r["media"]["type"] == "image" and r["slide"]["src"]
+    ]
+
+    async def _process(record):
+        key = record["media"]["key"]
+        entry = file_manager.media_index.get(key)
+        if entry is None:
+            return
+        variants = entry.get("variants")
+        if variants is None or any(not (file_manager.MEDIA_DIR / v["filename"]).exists() for v in variants):
+            variants = await image_processing.create_variants(entry["filename"])
+            if variants is None:
+                return
+            file_manager.media_index.update(key, variants=variants)
+        if variants:
+            record["slide"]["srcset"] = image_processing.srcset(variants)
+
+    await asyncio.gather(*(_process(r) for r in pending))
+
+def _needs_full_sync(source: NotionSource, source_state: Dict[str, Any], now: datetime) -> bool:
+    if source_state.get("database_id") != source.database_id or not source_state.get("watermark"):
+        return True
+    last_full = _parse_date(source_state.get("last_full_sync"))
+    return last_full is None or (now - last_full).total_seconds() > FULL_SYNC_INTERVAL
+
+async def query_source(source: NotionSource, source_state: Dict[str, Any], records: Dict[str, Dict], full: bool) -> List[Dict]:
+    """Pages of one source: all of them (full) or those edited since its watermark."""
+    if full:
+        logger.info(f"Querying Notion source '{source.name}' (full sync)...")
+        return await notion_api.query_database(source.token, source.database_id, rate_limit=source.rate_limit)
+
+    logger.info(f"Querying Notion source '{source.name}' for pages edited since {source_state['watermark']}...")
+    results = await notion_api.query_database(source.token, source.database_id, {
+        "timestamp": "last_edited_time",
+        "last_edited_time": {"on_or_after": source_state["watermark"]},
+    }, rate_limit=source.rate_limit)
+    # Retry pages whose media failed last time (with a freshly signed URL)
+    changed_ids = {page["id"] for page in results}
+    for page_id, record in records.items():
+        if record.get("source") == source.name and record.get("media_failed") and page_id not in changed_ids:
+            results.append(await notion_api.retrieve_page(source.token, page_id, source.rate_limit))
+    return results
+
+async def sync_notion_data(full: bool = False, progress: SyncProgress = None):
     """
     Main sync function.
-    1. Fetch unique block/pages from Notion Database.
-    2. Filter by date/active status.
-    3. Download media.
-    4. Update playlist.json.
+    1. Fetch pages from all Notion sources (databases) concurrently. Incremental
+       syncs only ask for pages edited since the source's last seen
+       last_edited_time; a full sync (on demand, or every FULL_SYNC_INTERVAL)
+       fetches everything and drops pages that no longer exist. A source that
+       fails (after backing off on 429s) keeps its previous slides.
+    2. Parse changed pages into slide records (Active checkbox, time window),
+       using the property mapping of their source.
+    3. Download media of changed pages (concurrently, over one pooled client)
+       and render scaled image variants.
+    4. Rebuild playlist.json (all candidates of all sources with their time
+       windows, ordered by Order) from all records and reload the schedule.
+    Don't call this directly from request handlers; go through sync_jobs so
+    syncs never overlap. Progress is reported into `progress`.
     """
-    token = os.getenv("NOTION_TOKEN")
-    database_id = os.getenv("NOTION_DATABASE_ID")
+    progress = progress or SyncProgress()
+    sources = [source for source in load_sources() if source.token]
 
-    if not token or not database_id:
+    if not sources:
         logger.warning("NOTION_TOKEN or NOTION_DATABASE_ID not set. Skipping sync.")
+        progress.error = "NOTION_TOKEN or NOTION_DATABASE_ID not set"
         return
 
-    client = AsyncClient(auth=token)
-    
     try:
-        logger.info("Querying Notion Database...")
-        query = await client.databases.query(database_id=database_id)
-        results = query.get("results", [])
-        logger.info(f"Notion returned {len(results)} results.")
-        
-        active_slides = []
-        active_filenames = set()
-        
+        state = await run_io(load_sync_state)
         now = datetime.now(timezone.utc)
         logger.info(f"Current UTC time: {now}")
 
-        for page in results:
-            props = page.get("properties", {})
-            
-            # Extract basic info
-            title_list = props.get(PROP_NAME, {}).get("title", [])
-            title = title_list[0]["plain_text"] if title_list else "Untitled"
-            
-            # Check Active Checkbox
-            is_active_checkbox = props.get(PROPERTY_ACTIVE, {}).get("checkbox", True)
-            if not is_active_checkbox:
-                logger.info(f"Skipping '{title}': Active checkbox is unchecked.")
-                continue
-
-            # Check Dates (Support 'Date' or 'Start')
-            date_prop = props.get(PROPERTY_DATE, {}).get("date") or props.get(PROPERTY_START, {}).get("date")
-            start_date = None
-            end_date = None
-            
-            if date_prop:
-                start_str = date_prop.get("start")
-                end_str = date_prop.get("end")
-                if start_str:
-                    d = datetime.fromisoformat(start_str.replace("Z", "+00:00"))
-                    if d.tzinfo is None:
-                         d = d.replace(tzinfo=timezone.utc)
-                    start_date = d
-                if end_str:
-                    d = datetime.fromisoformat(end_str.replace("Z", "+00:00"))
-                    if d.tzinfo is None:
-                         d = d.replace(tzinfo=timezone.utc)
-                    end_date = d
-
-            # Logic: If start_date is set, must be after it. If end_date is set, must be before it.
-            if start_date and now < start_date:
-                logger.info(f"Skipping '{title}': Starts in future ({start_date}).")
-                continue
-            if end_date and now > end_date:
-                logger.info(f"Skipping '{title}': Ended in past ({end_date}).")
-                continue
-
-            # Extract Media
-            files = props.get(PROPERTY_MEDIA, {}).get("files", [])
-            media_url = None
-            media_type = "text"
-            local_filename = None
-
-            if files:
-                f = files[0]
-                # Notion file objects have 'file' or 'external' keys
-                if "file" in f:
-                    media_url = f["file"]["url"]
-                elif "external" in f:
-                    media_url = f["external"]["url"]
-                
-                if media_url:
-                    # Determine filename (use page ID + extension or sanitized name)
-                    # Using page ID is safer for uniqueness
-                    ext = os.path.splitext(urlparse(media_url).path)[1]
-                    if not ext:
-                        ext = ".jpg" # Default fallback
-                    
-                    local_filename = f"{page['id']}{ext}"
-                    
-                    # Download
-                    logger.info(f"Downloading Media: {media_url} -> {local_filename}")
-                    download_success = await file_manager.download_file(media_url, local_filename)
-                    
-                    if download_success:
-                        active_filenames.add(local_filename)
-                        # Determine type
-                        if ext.lower() in ['.mp4', '.mov', '.webm']:
-                            media_type = "video"
-                        else:
-                            media_type = "image"
-                    else:
-                        logger.error(f"Download failed for {local_filename}, falling back to description-only.")
-                        local_filename = None # Prevents showing broken image
-                        media_type = "text"
-            
-            # Unsplash Fallback
-            if not media_url:
-                unsplash_val = props.get(PROPERTY_UNSPLASH, {}).get("url") or props.get(PROPERTY_UNSPLASH, {}).get("rich_text", [])
-                unsplash_url = None
-                if isinstance(unsplash_val, list) and len(unsplash_val) > 0:
-                    unsplash_url = unsplash_val[0].get("plain_text")
-                elif isinstance(unsplash_val, str):
-                    unsplash_url = unsplash_val
-                
-                if unsplash_url:
-                    logger.info(f"Processing Unsplash Property: {unsplash_url}")
-                    try:
-                        parsed = urlparse(unsplash_url)
-                        if "unsplash.com" in parsed.netloc:
-                             # Extract ID from path. 
-                             # Formats: 
-                             # - /photos/ID
-                             # - /de/fotos/slug-ID
-                             # - /photos/slug-ID
-                             
-                             path_parts = parsed.path.strip("/").split("/")
-                             if not path_parts:
-                                 raise ValueError("Empty path")
-                                 
-                             last_segment = path_parts[-1]
-                             
-                             # If slugged (contains dashes), usually ID is the last part
-                             # ID usually doesn't contain dashes.
-                             photo_id = last_segment.split("-")[-1]
-                             
-                             download_url = f"https://unsplash.com/photos/{photo_id}/download"
-                             local_filename = f"unsplash_{photo_id}.jpg"
-                             
-                             logger.info(f"Unsplash ID: {photo_id} | Download URL: {download_url}")
-
-                             result = await file_manager.download_file(download_url, local_filename)
-                             if result:
-                                 active_filenames.add(local_filename)
-                                 media_type = "image"
-                             else:
-                                 logger.error(f"Failed to download Unsplash image: {download_url}")
-                                 local_filename = None # Fallback to text
-                        else:
-                             logger.warning(f"Ignored non-Unsplash URL: {unsplash_url}")
-                    except Exception as e:
-                        logger.error(f"Error processing Unsplash url: {e}")
-                        local_filename = None
-
-            # Extract Duration
-            duration = props.get(PROPERTY_DURATION, {}).get("number", 10) or 10
-            
-            # Extract Description
-            desc_list = props.get(PROPERTY_DESCRIPTION, {}).get("rich_text", [])
-            description = "".join([t["plain_text"] for t in desc_list])
-
-            # Extract Layout
-            layout_select = props.get(PROPERTY_LAYOUT, {}).get("select")
-            layout = layout_select["name"] if layout_select else "Standard"
-
-            # Extract Order
-            order = props.get(PROPERTY_ORDER, {}).get("number", 999) or 999
-
-            slide = {
-                "id": page["id"],
-                "title": title,
-                "description": description,
-                "type": media_type,
-                "src": f"/media/{local_filename}" if local_filename else None,
-                "duration": duration,
-                "layout": layout,
-                "order": order
-            }
-            active_slides.append(slide)
+        source_states: Dict[str, Dict] = state.get("sources", {})
+        records: Dict[str, Dict] = dict(state.get("pages", {}))
+
+        # Slides of sources that were removed from the configuration
+        names = {source.name for source in sources}
+        for page_id in [page_id for page_id, record in records.items() if record.get("source") not in names]:
+            records.pop(page_id)
+
+        modes = {
+            source.name: full or _needs_full_sync(source, source_states.get(source.name, {}), now)
+            for source in sources
+        }
+        if all(modes.values()):
+            progress.mode = "full"
+        else:
+            progress.mode = "incremental" if not any(modes.values()) else "mixed"
+
+        with progress.track("query"):
+            outcomes = await asyncio.gather(*(
+                query_source(source, source_states.get(source.name, {}), records, modes[source.name])
+                for source in sources
+            ), return_exceptions=True)
+        progress.pages_total = sum(len(o) for o in outcomes if not isinstance(o, BaseException))
+        logger.info(f"Notion returned {progress.pages_total} results from {len(sources)} source(s).")
+
+        changed = []
+        new_source_states: Dict[str, Dict] = {}
+        with progress.track("parse"):
+            for source, results in zip(sources, outcomes):
+                source_state = source_states.get(source.name, {})
+                if isinstance(results, BaseException):
+                    # Keep this source's slides and watermark; the next sync retries
+                    logger.error(f"Notion source '{source.name}' failed: {results}")
+                    progress.source_errors[source.name] = str(results)
+                    if source_state:
+                        new_source_states[source.name] = source_state
+                    continue
+
+                source_full = modes[source.name]
+                if source_full:
+                    for page_id in [p for p, r in records.items() if r.get("source") == source.name]:
+                        records.pop(page_id)
 
-        # Sort by Order
-        active_slides.sort(key=lambda x: x["order"])
+                SYNC_PAGES.labels(source.name).inc(len(results))
+                watermark = source_state.get("watermark")
+                for page in results:
+                    progress.pages_processed += 1
+                    edited = page.get("last_edited_time")
+                    if edited and (watermark is None or edited > watermark):
+                        watermark = edited
 
-        # Write to playlist.json
-        with open(PLAYLIST_FILE, "w") as f:
-            json.dump(active_slides, f, indent=2)
-            
-        logger.info(f"Sync complete. {len(active_slides)} active slides found.")
-        
-        # Cleanup
-        file_manager.cleanup_files(active_filenames)
+                    # The on_or_after filter returns the pages at the watermark again.
+                    # last_edited_time is only precise to the minute, so an edit in the
+                    # minute of the last sync keeps it: compare the properties instead
+                    previous = records.get(page["id"])
+                    digest = _properties_digest(page)
+                    if not source_full and previous and previous.get("properties_digest") == digest and not previous.get("media_failed"):
+                        continue
+
+                    record = parse_page(page, source.properties)
+                    if record is None:
+                        records.pop(page["id"], None)
+                        continue
+                    record["source"] = source.name
+                    record["properties_digest"] = digest
+                    records[page["id"]] = record
+                    changed.append(record)
+
+                new_source_states[source.name] = {
+                    "database_id": source.database_id,
+                    "watermark": watermark,
+                    "last_full_sync": now.isoformat() if source_full else source_state.get("last_full_sync"),
+                }
+
+        if len(progress.source_errors) == len(sources):
+            progress.error = "; ".join(f"{name}: {error}" for name, error in progress.source_errors.items())
+            return
+
+        with progress.track("download"):
+            await download_media(changed, progress)
+
+        with progress.track("images"):
+            await process_images(changed)
+
+        # Videos are normalized in the background; the playlist switches when ready
+        for record in changed:
+            if record.get("media") and record["media"]["type"] == "video" and record["slide"]["src"]:
+                video_transcoder.enqueue(record["media"]["key"])
+
+        with progress.track("write"):
+            async with _playlist_lock:
+                candidates = build_playlist(records)
+                await write_playlist(candidates)
+
+                await save_sync_state({
+                    "sources": new_source_states,
+                    "pages": records,
+                })
+
+        logger.info(f"Sync complete ({progress.mode}). {len(changed)} pages updated, {len(candidates)} candidate slides, {len(slide_schedule.active_at())} active now.")
+
+        # Cleanup (media of slides outside their time window is kept)
+        with progress.track("cleanup"):
+            active_media_keys = {
+                r["media"]["key"] for r in records.values()
+                if r.get("media") and not r.get("media_failed")
+            }
+            await file_manager.cleanup_files(active_media_keys)
 
     except Exception as e:
         logger.error(f"Error during Notion sync: {e}")
+        progress.error = str(e)
@@ -0,0 +1,118 @@
+import os
+import hashlib
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+from app.services import file_manager
+from app.services.snapshot import Snapshot
+from app.services.metrics import CACHE_LOOKUPS
+from app.services.executors import run_io
+
+logger = logging.getLogger(__name__)
+
+# Upper bound for background prefetching on the players (kbit/s, 0 = unlimited)
+PREFETCH_RATE_KBPS = int(os.getenv("PREFETCH_RATE_KBPS", 8000))
+# Manifests kept (one per channel and playlist version)
+MANIFEST_CACHE_SIZE = 32
+
+# Hashes of derived files kept (least recently used dropped first)
+HASH_CACHE_SIZE = 4096
+
+# Content hashes of derived files (variants, optimized videos): name -> (size, mtime, sha256).
+# Only touched by build_manifest, which runs one at a time (ManifestCache lock).
+_hashes: "OrderedDict[str, Tuple[int, int, str]]" = OrderedDict()
+
+def _file_info(filename: str, known_hashes: Dict[str, str]) -> Optional[Dict]:
+    path = file_manager.MEDIA_DIR / filename
+    try:
+        stat = path.stat()
+    except OSError:
+        _hashes.pop(filename, None) # deleted by a cleanup
+        return None
+    sha256 = known_hashes.get(filename)
+    if sha256 is None:
+        cached = _hashes.get(filename)
+        if cached is not None and cached[:2] == (stat.st_size, stat.st_mtime_ns):
+            sha256 = cached[2]
+            _hashes.move_to_end(filename)
+        else:
+            digest = hashlib.sha256()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(chunk)
+            sha256 = digest.hexdigest()
+            _hashes[filename] = (stat.st_size, stat.st_mtime_ns, sha256)
+            while len(_hashes) > HASH_CACHE_SIZE:
+                _hashes.popitem(last=False)
+    return {"size": stat.st_size, "hash": sha256}
+
+def known_hashes() -> Dict[str, str]:
+    """sha256 of the synced originals by file name. Call it on the loop: a sync changes the index there."""
+    return {
+        entry["filename"]: entry["sha256"]
+        for entry in file_manager.media_index.entries.values()
+        if entry.get("sha256")
+    }
+
+def build_manifest(slides: List[Dict], known_hashes: Dict[str, str]) -> Dict:
+    """
+    Prefetch manifest of a playlist: per slide (in playback order) its planned
+    start offset within the loop and every media URL a player might load
+    (original, poster, image variants) with byte size and sha256.
+    Blocking (stat + hashing of new files); run it in a thread.
+    """
+    manifest_slides = []
+    offset = 0
+    total = 0
+    for slide in slides:
+        urls = []
+        if slide.get("src"):
+            urls.append((slide["src"], {"role": "src", "type": slide.get("type")}))
+        if slide.get("poster"):
+            urls.append((slide["poster"], {"role": "poster"}))
+        for variant in slide.get("srcset") or []:
+            urls.append((variant["src"], {"role": "variant", "type": variant["type"], "width": variant["width"]}))
+
+        media = []
+        for url, extra in urls:
+            if not url.startswith("/media/"):
+                continue
+            info = _file_info(url[len("/media/"):], known_hashes)
+            if info is None:
+                continue
+            media.append({"url": url, **info, **extra})
+            total += info["size"]
+
+        duration = slide.get("duration") or 10
+        manifest_slides.append({"id": slide.get("id"), "offset": offset, "duration": duration, "media": media})
+        offset += duration
+
+    return {
+        "rate": PREFETCH_RATE_KBPS * 1000 // 8, # bytes/s
+        "loop_duration": offset,
+        "total_bytes": total,
+        "slides": manifest_slides,
+    }
+
+class ManifestCache:
+    """Manifests keyed by the ETag of the playlist snapshot they describe."""
+    def __init__(self):
+        self._manifests: "OrderedDict[str, Snapshot]" = OrderedDict()
+        self._lock = asyncio.Lock()
+
+    async def get(self, playlist: Snapshot) -> Snapshot:
+        manifest = self._manifests.get(playlist.etag)
+        CACHE_LOOKUPS.labels("manifest", "miss" if manifest is None else "hit").inc()
+        if manifest is not None:
+            return manifest
+        async with self._lock:
+            manifest = self._manifests.get(playlist.etag)
+            if manifest is None:
+                manifest = Snapshot(await run_io(build_manifest, playlist.data, known_hashes()))
+                self._manifests[playlist.etag] = manifest
+                while len(self._manifests) > MANIFEST_CACHE_SIZE:
+                    self._manifests.popitem(last=False)
+            return manifest
+
+manifest_cache = ManifestCache()
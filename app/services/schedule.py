@@ -0,0 +1,159 @@
+import json
+import time
+import asyncio
+import logging
+from bisect import bisect_right
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from app.services.snapshot import Snapshot
+from app.services.metrics import CACHE_LOOKUPS
+
+logger = logging.getLogger(__name__)
+
+PLAYLIST_FILE = Path("/app/data/playlist.json")
+
+# Internal fields of a candidate slide that are not sent to players
+INTERNAL_FIELDS = ("start", "end", "channels")
+
+def _timestamp(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+
+def normalize_channel(channel: Optional[str]) -> Optional[str]:
+    """Channel names are case-insensitive; None/empty means "all slides"."""
+    if channel is None:
+        return None
+    channel = channel.strip().lower()
+    return channel or None
+
+# Key of the slides without a channel (served to channels nobody tagged)
+UNTAGGED = ""
+
+class SlideSchedule:
+    """
+    Interval index over the synced candidate slides (playlist.json).
+
+    The time axis is cut at every Start/End boundary. Segment i covers
+    [boundaries[i-1], boundaries[i]) and its active slide list is computed and
+    serialized on first use, so snapshot_at() is a bisect plus a dict lookup
+    (O(log n)).
+    Slides can be limited to channels (screens). The candidate list of every
+    channel is partitioned once per load; a channel sees its own slides plus
+    the untagged ones, and no channel (None) sees everything.
+    run() sleeps until the next boundary and notifies the listeners, so slides
+    switch on time without waiting for the next sync.
+    """
+    def __init__(self):
+        self._slides: Dict[Optional[str], List[Tuple[Optional[float], Optional[float], Dict]]] = {None: [], UNTAGGED: []}
+        self._boundaries: List[float] = []
+        self._segments: Dict[Tuple[Optional[str], int], Snapshot] = {}
+        self._listeners: List[Callable[[], Any]] = []
+        self._changed = asyncio.Event()
+
+    def load(self, candidates: List[Dict]):
+        """Replaces the candidate slides (sorted by Order, with start/end ISO strings)."""
+        slides = []
+        boundaries = set()
+        channels = set()
+        for candidate in candidates:
+            start = _timestamp(candidate.get("start"))
+            end = _timestamp(candidate.get("end"))
+            tags = {normalize_channel(c) for c in candidate.get("channels") or []} - {None}
+            public = {k: v for k, v in candidate.items() if k not in INTERNAL_FIELDS}
+            slides.append((start, end, tags, public))
+            boundaries.update(t for t in (start, end) if t is not None)
+            channels.update(tags)
+
+        by_channel = {None: [(start, end, slide) for start, end, _, slide in slides]}
+        for channel in channels | {UNTAGGED}:
+            by_channel[channel] = [
+                (start, end, slide) for start, end, tags, slide in slides
+                if not tags or channel in tags
+            ]
+
+        # Swap everything at once; readers never see a half-built index
+        self._slides = by_channel
+        self._boundaries = sorted(boundaries)
+        self._segments = {}
+        self._changed.set()
+        logger.info(f"Schedule loaded: {len(slides)} candidate slides, {len(channels)} channels, {len(self._boundaries)} boundaries.")
+
+    def channels(self) -> List[str]:
+        """Channels referenced by at least one slide."""
+        return sorted(c for c in self._slides if c)
+
+    def load_file(self, path: Path = PLAYLIST_FILE):
+        if not path.exists():
+            return
+        try:
+            with open(path, "r") as f:
+                self.load(json.load(f))
+        except Exception as e:
+            logger.error(f"Failed to load playlist for schedule: {e}")
+
+    def _segment(self, ts: float) -> int:
+        return bisect_right(self._boundaries, ts)
+
+    def snapshot_at(self, ts: float = None, channel: str = None) -> Snapshot:
+        """Pre-serialized playlist of `channel` active at `ts` (unix time, default now)."""
+        channel = normalize_channel(channel)
+        if channel not in self._slides:
+            channel = UNTAGGED
+        index = self._segment(time.time() if ts is None else ts)
+        snapshot = self._segments.get((channel, index))
+        CACHE_LOOKUPS.labels("schedule", "miss" if snapshot is None else "hit").inc()
+        if snapshot is None:
+            # Any point inside the segment is representative: its left edge
+            probe = self._boundaries[index - 1] if index > 0 else float("-inf")
+            snapshot = Snapshot([
+                slide for start, end, slide in self._slides[channel]
+                if (start is None or start <= probe) and (end is None or probe < end)
+            ])
+            self._segments[(channel, index)] = snapshot
+        return snapshot
+
+    def active_at(self, ts: float = None, channel: str = None) -> List[Dict]:
+        """Slides active at `ts` (unix time, default now), in playlist order."""
+        return self.snapshot_at(ts, channel).data
+
+    def next_boundary(self, ts: float = None) -> Optional[float]:
+        index = self._segment(time.time() if ts is None else ts)
+        return self._boundaries[index] if index < len(self._boundaries) else None
+
+    def add_listener(self, callback: Callable[[], Any]):
+        """Registers a callback invoked whenever the active set may have changed."""
+        self._listeners.append(callback)
+
+    def _notify(self):
+        for callback in self._listeners:
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f"Schedule listener failed: {e}")
+
+    async def run(self):
+        """Wakes exactly at the next Start/End boundary (or when reloaded)."""
+        while True:
+            self._changed.clear()
+            boundary = self.next_boundary()
+            timeout = None if boundary is None else max(0.0, boundary - time.time())
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout)
+                # Reloaded: candidates changed, re-arm for the new next boundary
+                self._notify()
+                continue
+            except asyncio.TimeoutError:
+                pass
+
+            # Timers may fire a few ms early; never evaluate before the boundary
+            remaining = boundary - time.time()
+            if remaining > 0:
+                await asyncio.sleep(remaining)
+
+            active = self.active_at()
+            logger.info(f"Schedule boundary reached: {len(active)} slides active.")
+            self._notify()
+
+slide_schedule = SlideSchedule()
@@ -1,11 +1,24 @@
+import os
 import json
+import time
+import asyncio
 import logging
 from pathlib import Path
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional, Tuple
+from app.services.snapshot import Snapshot
+from app.services.events import event_hub
+from app.services.schedule import normalize_channel
+from app.services.executors import run_io
+from app.services.shared_state import file_lock, shared_state
 
 logger = logging.getLogger(__name__)
 
 SETTINGS_FILE = Path("/app/data/settings.json")
+# Every written version is also kept here as <version>.json (for rollback and recovery)
+SETTINGS_HISTORY_DIR = Path("/app/data/settings_history")
+SETTINGS_HISTORY = int(os.getenv("SETTINGS_HISTORY", 20))
+# Saves within this many seconds are written to disk as one version
+SETTINGS_WRITE_DELAY = float(os.getenv("SETTINGS_WRITE_DELAY", 0.5))
 
 DEFAULT_SETTINGS = {
     "theme": "dark",
@@ -29,67 +42,285 @@ DEFAULT_SETTINGS = {
     "countdown_title": "Countdown",
     "countdown_show_timer": True,
     "countdown_show_date": True,
+    # Agenda slide (upcoming events of several iCal feeds)
+    "agenda_enabled": False,
+    "agenda_title": "Termine",
+    "agenda_days": 14, # look-ahead
+    "agenda_limit": 8, # max. events on the slide
+    "agenda_duration": 15, # seconds
+    "calendar_feeds": [], # [{"name": ..., "url": ..., "filter": ...}]
     # Appearance
-    "font_scale": 100 # Percentage
+    "font_scale": 100, # Percentage
+    # Per-channel (screen) overrides, e.g. {"lobby": {"theme": "light"}}
+    "channel_overrides": {}
 }
 
+def atomic_write(path: Path, data: bytes):
+    """
+    Replaces `path` with `data` so that a crash leaves either the old or the
+    new file, never a truncated one: temp file, fsync, rename, fsync of the
+    directory (so the rename itself is durable).
+    """
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    try:
+        fd = os.open(path.parent, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass # not supported on every platform/filesystem
+
+def _history_path(version: int) -> Path:
+    return SETTINGS_HISTORY_DIR / f"{version:06d}.json"
+
 class SettingsManager:
+    """
+    Keeps the settings in memory. The file is read once at startup; readers
+    get the merged view (defaults + file + calendar override) from a
+    pre-serialized snapshot rebuilt only when something changes.
+
+    Saves take effect immediately in memory and are written to disk shortly
+    after (SETTINGS_WRITE_DELAY), so a burst of admin saves becomes a single
+    crash-safe write. Every write is a new version in SETTINGS_HISTORY_DIR;
+    the last SETTINGS_HISTORY versions can be restored, and a corrupt
+    settings.json is recovered from the newest readable one.
+
+    With several workers, each written version is announced in the shared
+    state and the other workers reload settings.json; the calendar override
+    is shared the same way.
+    """
     def __init__(self):
-        self._ensure_file()
         self._calendar_state = {}
+        self._stored: Dict[str, Any] = {}
+        self._snapshot: Snapshot = None
+        self._channel_snapshots: Dict[str, Snapshot] = {}
+        self._version = 0 # last version written to disk
+        self._dirty = False
+        self._flush_task: Optional[asyncio.Task] = None
+        self._write_lock = asyncio.Lock()
+        self._ensure_file()
+        shared_state.watch("settings", self._settings_changed)
+        shared_state.watch("calendar", self._calendar_changed, initial=True)
 
     def _ensure_file(self):
-        if not SETTINGS_FILE.exists():
-            self.save_settings(DEFAULT_SETTINGS)
+        self._version = max(self._history_versions(), default=0)
+        if SETTINGS_FILE.exists():
+            self._load()
+        elif self._version:
+            # settings.json lost, but the history survived
+            self._recover()
+        else:
+            self._stored = dict(DEFAULT_SETTINGS)
+            self._rebuild()
+            self._write(self._stored)
+
+    def _history_versions(self) -> List[int]:
+        try:
+            return sorted(int(p.stem) for p in SETTINGS_HISTORY_DIR.glob("*.json") if p.stem.isdigit())
+        except OSError:
+            return []
+
+    def _read_version(self, version: int) -> Optional[Dict[str, Any]]:
+        try:
+            with open(_history_path(version), "r") as f:
+                return json.load(f)
+        except Exception as e:
+            logger.warning(f"Settings version {version} unreadable: {e}")
+            return None
+
+    @staticmethod
+    def _read_file() -> Dict[str, Any]:
+        with open(SETTINGS_FILE, "r") as f:
+            return json.load(f)
+
+    def _load(self):
+        try:
+            self._stored = self._read_file()
+        except Exception as e:
+            logger.error(f"Failed to read settings: {e}")
+            self._recover()
+            return
+        self._rebuild()
+
+    def _recover(self):
+        """Restores the newest readable version from the history (or the defaults)."""
+        for version in reversed(self._history_versions()):
+            entry = self._read_version(version)
+            if entry is not None:
+                logger.warning(f"Settings recovered from version {version} ({entry.get('saved_at')}).")
+                self._stored = entry["settings"]
+                break
+        else:
+            logger.error("No readable settings version found, using defaults.")
+            self._stored = dict(DEFAULT_SETTINGS)
+        self._rebuild()
+        atomic_write(SETTINGS_FILE, self._serialize(self._stored))
+
+    @staticmethod
+    def _serialize(settings: Dict[str, Any]) -> bytes:
+        return json.dumps(settings, indent=2).encode("utf-8")
+
+    def _write(self, settings: Dict[str, Any]):
+        """Writes one new version: history entry first, then settings.json. Blocking."""
+        # Other workers write versions too: number them under a lock, from the files
+        with file_lock(SETTINGS_FILE.with_name("settings.lock")):
+            version = max(self._history_versions(), default=0) + 1
+            SETTINGS_HISTORY_DIR.mkdir(parents=True, exist_ok=True)
+            entry = {"version": version, "saved_at": time.time(), "settings": settings}
+            atomic_write(_history_path(version), json.dumps(entry).encode("utf-8"))
+            atomic_write(SETTINGS_FILE, self._serialize(settings))
+            self._version = version
+            for old in self._history_versions()[:-SETTINGS_HISTORY]:
+                _history_path(old).unlink(missing_ok=True)
+        logger.info(f"Settings saved (version {version}).")
 
-    def update_calendar_cache(self, title: str, start_time: str):
-        """Updates the in-memory calendar state."""
-        self._calendar_state = {
+    async def flush(self):
+        """Writes pending changes now (also called on shutdown)."""
+        async with self._write_lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+            # _stored is replaced, never mutated, so the thread sees a stable dict
+            try:
+                await run_io(self._write, self._stored)
+            except Exception as e:
+                self._dirty = True
+                logger.error(f"Failed to write settings: {e}")
+                raise
+            await shared_state.set("settings", {"version": self._version})
+
+    async def _settings_changed(self, key: str, change: Dict[str, Any]):
+        """Another worker wrote a version: serve it too (a pending save of our own wins)."""
+        async with self._write_lock:
+            if self._dirty or change.get("version") == self._version:
+                return
+            try:
+                stored = await run_io(self._read_file)
+            except Exception as e:
+                logger.error(f"Failed to reload settings: {e}")
+                return
+        if self._dirty:
+            return # saved here while reading
+        self._stored = stored
+        self._version = change.get("version", self._version)
+        self._rebuild()
+        logger.info(f"Settings reloaded (version {self._version}, saved by another worker).")
+
+    async def _flush_later(self):
+        while self._dirty:
+            await asyncio.sleep(SETTINGS_WRITE_DELAY)
+            try:
+                await self.flush()
+            except Exception:
+                return # retried with the next save
+
+    def _schedule_flush(self):
+        self._dirty = True
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # No event loop (scripts, startup): write right away
+            self._dirty = False
+            self._write(self._stored)
+            return
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = loop.create_task(self._flush_later())
+
+    def _rebuild(self):
+        # Merge with defaults to ensure all keys exist
+        settings = {**DEFAULT_SETTINGS, **self._stored}
+        
+        # If mode is calendar and we have state, override
+        if settings.get("countdown_mode") == "calendar" and self._calendar_state:
+            settings["countdown_title"] = self._calendar_state["countdown_title"]
+            settings["countdown_target"] = self._calendar_state["countdown_target"]
+
+        previous = self._snapshot
+        self._snapshot = Snapshot(settings)
+        # One pre-serialized view per channel with overrides; others get the base
+        self._channel_snapshots = {
+            normalize_channel(channel): Snapshot({**settings, **overrides})
+            for channel, overrides in (settings.get("channel_overrides") or {}).items()
+            if normalize_channel(channel) and isinstance(overrides, dict)
+        }
+        if previous is not None and previous.etag != self._snapshot.etag:
+            event_hub.publish("settings-changed", {"etag": self._snapshot.etag})
+
+    async def update_calendar_cache(self, title: str, start_time: str):
+        """Updates the calendar state (of all workers)."""
+        new_state = {
             "countdown_title": title,
             "countdown_target": start_time
         }
-        logger.info(f"Calendar state updated: {title} at {start_time}")
+        if new_state == self._calendar_state:
+            return
+        self._calendar_changed("calendar", new_state)
+        await shared_state.set("calendar", new_state)
+
+    def _calendar_changed(self, key: str, state: Dict[str, str]):
+        if not state or state == self._calendar_state:
+            return
+        self._calendar_state = state
+        self._rebuild()
+        logger.info(f"Calendar state updated: {state['countdown_title']} at {state['countdown_target']}")
+
+    def snapshot(self, channel: str = None) -> Snapshot:
+        """Merged settings, pre-serialized with ETag (served to players)."""
+        return self._channel_snapshots.get(normalize_channel(channel), self._snapshot)
 
     def get_settings(self) -> Dict[str, Any]:
-        try:
-            with open(SETTINGS_FILE, "r") as f:
-                data = json.load(f)
-                # Merge with defaults to ensure all keys exist
-                settings = {**DEFAULT_SETTINGS, **data}
-                
-                # If mode is calendar and we have state, override
-                if settings.get("countdown_mode") == "calendar" and self._calendar_state:
-                    settings["countdown_title"] = self._calendar_state["countdown_title"]
-                    settings["countdown_target"] = self._calendar_state["countdown_target"]
-                    
-                return settings
-        except Exception as e:
-            logger.error(f"Failed to read settings: {e}")
-            return DEFAULT_SETTINGS
+        return dict(self._snapshot.data)
+
+    def export(self) -> bytes:
+        """The stored settings as written to settings.json (for the backup download)."""
+        return self._serialize(self._stored)
 
     def save_settings(self, new_settings: Dict[str, Any]):
-        try:
-            # Load current to merge if exists
-            current = {}
-            if SETTINGS_FILE.exists():
-                # Read raw file, ignoring calendar overrides
-                with open(SETTINGS_FILE, "r") as f:
-                    current = json.load(f)
-            
-            # Merge defaults -> current -> new
-            # We must be careful not to save the "overridden" calendar values into the file permanently
-            # if the user didn't intend to change them.
-            # actually, if the user configures "calendar" mode, the file will store "countdown_mode": "calendar"
-            # and generic title/target. The OVERRIDE happens only on read.
-            
-            updated = {**DEFAULT_SETTINGS, **current, **new_settings}
-            
-            with open(SETTINGS_FILE, "w") as f:
-                json.dump(updated, f, indent=2)
-            logger.info("Settings saved")
-            return updated
-        except Exception as e:
-            logger.error(f"Failed to save settings: {e}")
-            raise e
+        # Merge defaults -> current -> new
+        # self._stored is the raw file content, without calendar overrides:
+        # the calendar values are only applied on read (see _rebuild).
+        updated = {**DEFAULT_SETTINGS, **self._stored, **new_settings}
+        self._stored = updated
+        self._rebuild()
+        self._schedule_flush()
+        return updated
+
+    def _saved_versions(self) -> List[Tuple[int, float]]:
+        """(version, saved_at) of the history files, newest first. Blocking."""
+        versions = []
+        for version in reversed(self._history_versions()):
+            try:
+                versions.append((version, _history_path(version).stat().st_mtime))
+            except OSError:
+                continue
+        return versions
+
+    async def history(self) -> List[Dict[str, Any]]:
+        """Stored versions, newest first: [{"version", "saved_at", "current"}]."""
+        return [
+            {"version": version, "saved_at": saved_at, "current": version == self._version and not self._dirty}
+            for version, saved_at in await run_io(self._saved_versions)
+        ]
+
+    async def get_version(self, version: int) -> Optional[Dict[str, Any]]:
+        entry = await run_io(self._read_version, version)
+        return entry["settings"] if entry else None
+
+    async def rollback(self, version: int) -> Optional[Dict[str, Any]]:
+        """Restores an older version; the restored state is saved as a new version."""
+        settings = await self.get_version(version)
+        if settings is None:
+            return None
+        self._stored = settings
+        self._rebuild()
+        self._schedule_flush()
+        logger.info(f"Settings rolled back to version {version}.")
+        return settings
 
 settings_manager = SettingsManager()
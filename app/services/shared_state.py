@@ -0,0 +1,295 @@
+import os
+import json
+import time
+import fcntl
+import asyncio
+import hashlib
+import inspect
+import logging
+import sqlite3
+import threading
+from contextlib import contextmanager
+from fnmatch import fnmatchcase
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from app.services.executors import run_io
+
+logger = logging.getLogger(__name__)
+
+# Worker processes; uvicorn reads the same variable as the default of --workers
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", 1))
+SHARED_STATE_FILE = Path("/app/data/shared_state.db")
+LEADER_LOCK_FILE = Path("/app/data/leader.lock")
+# How often a worker picks up the changes of the others (seconds)
+SHARED_POLL_INTERVAL = float(os.getenv("SHARED_POLL_INTERVAL", 0.5))
+# How often a follower tries to take over from a vanished leader (seconds)
+LEADER_RETRY_INTERVAL = 2
+# Deleted keys stay in the table this long (seconds), so every worker polls the deletion
+TOMBSTONE_TTL = 60
+
+Watcher = Callable[[str, Any], Optional[Awaitable[None]]]
+
+@contextmanager
+def file_lock(path: Path):
+    """Exclusive lock on `path` across processes (blocking, released with the block)."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+class SharedState:
+    """
+    Key/value state shared by the worker processes (WEB_CONCURRENCY > 1),
+    plus the election of the one worker that runs the background jobs.
+
+    Values are JSON in a SQLite table (WAL mode, so readers never wait for a
+    writer). Every write takes the next number of a global sequence; each
+    worker polls for rows newer than the last one it has seen and hands
+    them to the watchers of the key. A worker's own writes are applied by
+    the writer directly and not dispatched to its watchers again. A deleted
+    key is written as a tombstone (JSON null, so values can't be None) that
+    the other workers drop from their values.
+
+    The leader is whoever holds an flock on LEADER_LOCK_FILE. The kernel
+    releases it when that process dies, and the next follower to retry
+    takes over. A single worker keeps the values in memory only, without
+    table or polling, and is always the leader.
+    """
+    def __init__(self):
+        self.worker_id = str(os.getpid())
+        self.is_leader = False
+        self._values: Dict[str, Any] = {}
+        self._digests: Dict[str, bytes] = {}
+        self._seq = 0
+        self._conn: Optional[sqlite3.Connection] = None
+        self._conn_lock = threading.Lock()
+        self._lock_file = None
+        self._watchers: List[Tuple[str, Watcher, bool]] = []
+        self._defaults: Dict[str, Any] = {}
+        self._leader_callbacks: List[Callable[[], Awaitable[None]]] = []
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def shared(self) -> bool:
+        """True if other worker processes share this state."""
+        return WEB_CONCURRENCY > 1
+
+    def watch(self, pattern: str, callback: Watcher, initial: bool = False):
+        """
+        Calls `callback(key, value)` (sync or async) when another worker
+        changed a key matching `pattern` (fnmatch, e.g. "fleet:*"). With
+        `initial`, it is also called with the values present at start().
+        Deletions are not dispatched.
+        """
+        self._watchers.append((pattern, callback, initial))
+
+    def default(self, key: str, value: Any):
+        """
+        Value `key` starts with unless a worker stored one already. Written by
+        start() only if missing, so all workers agree on the first writer's.
+        """
+        self._defaults[key] = value
+
+    def on_leader(self, callback: Callable[[], Awaitable[None]]):
+        """
+        Registers a coroutine function run once this worker becomes the leader.
+        Awaited by start() (the first sync finishes before the worker serves
+        requests, as with a single process); run as a task on a later takeover.
+        """
+        self._leader_callbacks.append(callback)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self._values.get(key, default)
+
+    def items(self, pattern: str) -> List[Tuple[str, Any]]:
+        return [(key, value) for key, value in self._values.items() if fnmatchcase(key, pattern)]
+
+    async def set(self, key: str, value: Any):
+        """Stores `value` (JSON-serializable, not None) for all workers; a no-op if it didn't change."""
+        self._values[key] = value
+        if self.shared:
+            await run_io(self._write, key, value)
+
+    async def delete(self, key: str):
+        self._values.pop(key, None)
+        if self.shared:
+            await run_io(self._delete, key)
+
+    # Blocking SQLite access (I/O pool); one connection per process, serialized
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            SHARED_STATE_FILE.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(SHARED_STATE_FILE, timeout=10, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            with conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL, seq INTEGER NOT NULL, origin TEXT, updated REAL)")
+                conn.execute("CREATE INDEX IF NOT EXISTS state_seq ON state (seq)")
+                conn.execute("CREATE TABLE IF NOT EXISTS sequence (seq INTEGER NOT NULL)")
+                conn.execute("INSERT INTO sequence SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM sequence)")
+            self._conn = conn
+        return self._conn
+
+    def _write(self, key: str, value: Any):
+        data = json.dumps(value)
+        digest = hashlib.sha1(data.encode("utf-8")).digest()
+        if self._digests.get(key) == digest:
+            return
+        with self._conn_lock:
+            conn = self._connection()
+            with conn:
+                # The counter row is the write lock: sequence numbers are committed in order
+                conn.execute("UPDATE sequence SET seq = seq + 1")
+                conn.execute(
+                    "INSERT OR REPLACE INTO state (key, value, seq, origin, updated) "
+                    "VALUES (?, ?, (SELECT seq FROM sequence), ?, ?)",
+                    (key, data, self.worker_id, time.time()),
+                )
+        self._digests[key] = digest
+
+    def _seed(self, defaults: Dict[str, Any]):
+        with self._conn_lock:
+            conn = self._connection()
+            for key, value in defaults.items():
+                with conn:
+                    # Takes a sequence number even if the key exists (gaps are harmless)
+                    conn.execute("UPDATE sequence SET seq = seq + 1")
+                    conn.execute(
+                        "INSERT OR IGNORE INTO state (key, value, seq, origin, updated) "
+                        "VALUES (?, ?, (SELECT seq FROM sequence), ?, ?)",
+                        (key, json.dumps(value), self.worker_id, time.time()),
+                    )
+
+    def _delete(self, key: str):
+        self._digests.pop(key, None)
+        now = time.time()
+        with self._conn_lock:
+            conn = self._connection()
+            with conn:
+                conn.execute("UPDATE sequence SET seq = seq + 1")
+                conn.execute(
+                    "INSERT OR REPLACE INTO state (key, value, seq, origin, updated) "
+                    "VALUES (?, 'null', (SELECT seq FROM sequence), ?, ?)",
+                    (key, self.worker_id, now),
+                )
+                conn.execute("DELETE FROM state WHERE value = 'null' AND updated < ?", (now - TOMBSTONE_TTL,))
+
+    def _changes(self) -> List[Tuple[str, Any, str]]:
+        """Rows written since the last call (all rows on the first one), decoded; None for a deletion."""
+        with self._conn_lock:
+            rows = self._connection().execute(
+                "SELECT key, value, seq, origin FROM state WHERE seq > ? ORDER BY seq", (self._seq,)
+            ).fetchall()
+        changes = []
+        for key, data, seq, origin in rows:
+            self._seq = seq
+            try:
+                value = json.loads(data)
+            except ValueError as e:
+                logger.error(f"Shared state {key!r} unreadable: {e}")
+                continue
+            if value is None:
+                self._digests.pop(key, None)
+            else:
+                self._digests[key] = hashlib.sha1(data.encode("utf-8")).digest()
+            changes.append((key, value, origin))
+        return changes
+
+    def _try_lead(self) -> bool:
+        if not self.shared:
+            return True
+        if self._lock_file is None:
+            LEADER_LOCK_FILE.parent.mkdir(parents=True, exist_ok=True)
+            self._lock_file = open(LEADER_LOCK_FILE, "a")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        return True
+
+    # Lifecycle
+
+    async def start(self):
+        if self.shared:
+            await run_io(self._seed, self._defaults)
+            for key, value, _ in await run_io(self._changes):
+                self._apply(key, value)
+        else:
+            self._values.update(self._defaults)
+        for pattern, callback, initial in self._watchers:
+            if initial:
+                for key, value in self.items(pattern):
+                    await self._call(callback, key, value)
+
+        if await run_io(self._try_lead):
+            await self._lead(initial=True)
+        else:
+            logger.info(f"Worker {self.worker_id} started as follower.")
+        if self.shared:
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._lock_file is not None:
+            # Closing the file releases the lock right away for a standby worker
+            self._lock_file.close()
+            self._lock_file = None
+        self.is_leader = False
+
+    async def _lead(self, initial: bool):
+        self.is_leader = True
+        if self.shared:
+            logger.info(f"Worker {self.worker_id} is the leader (runs sync and calendar jobs).")
+        for callback in self._leader_callbacks:
+            if initial:
+                await callback()
+            else:
+                asyncio.create_task(callback())
+
+    async def _run(self):
+        last_attempt = time.monotonic()
+        while True:
+            await asyncio.sleep(SHARED_POLL_INTERVAL)
+            try:
+                changes = await run_io(self._changes)
+            except Exception as e:
+                logger.error(f"Reading shared state failed: {e}")
+                continue
+            for key, value, origin in changes:
+                self._apply(key, value)
+                if origin != self.worker_id and value is not None:
+                    await self._dispatch(key, value)
+
+            if not self.is_leader and time.monotonic() - last_attempt >= LEADER_RETRY_INTERVAL:
+                last_attempt = time.monotonic()
+                if await run_io(self._try_lead):
+                    logger.warning(f"Worker {self.worker_id} took over as leader.")
+                    await self._lead(initial=False)
+
+    def _apply(self, key: str, value: Any):
+        if value is None:
+            self._values.pop(key, None)
+        else:
+            self._values[key] = value
+
+    async def _dispatch(self, key: str, value: Any):
+        for pattern, callback, _ in self._watchers:
+            if fnmatchcase(key, pattern):
+                await self._call(callback, key, value)
+
+    @staticmethod
+    async def _call(callback: Watcher, key: str, value: Any):
+        try:
+            result = callback(key, value)
+            if inspect.isawaitable(result):
+                await result
+        except Exception as e:
+            logger.error(f"Shared state watcher for {key!r} failed: {e}")
+
+shared_state = SharedState()
@@ -0,0 +1,35 @@
+import json
+import hashlib
+from typing import Any
+from fastapi import Request, Response
+from app.services.metrics import CONDITIONAL_RESPONSES, route_label
+
+class Snapshot:
+    """
+    A JSON document serialized once, with a strong ETag over its bytes.
+    Producers build a new Snapshot and swap the reference, so readers
+    always see a complete body without any per-request work.
+    """
+    __slots__ = ("data", "body", "etag")
+
+    def __init__(self, data: Any):
+        self.data = data
+        self.body = json.dumps(data, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+        self.etag = '"' + hashlib.sha256(self.body).hexdigest()[:32] + '"'
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """True if the request's If-None-Match lists `etag` (or is "*")."""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    candidates = [c.strip() for c in header.split(",")]
+    return "*" in candidates or etag in candidates
+
+def snapshot_response(request: Request, snapshot: Snapshot) -> Response:
+    """200 with the pre-serialized body, or 304 if the client already has it."""
+    headers = {"ETag": snapshot.etag, "Cache-Control": "no-cache"}
+    if etag_matches(request, snapshot.etag):
+        CONDITIONAL_RESPONSES.labels(route_label(request.scope), "not_modified").inc()
+        return Response(status_code=304, headers=headers)
+    CONDITIONAL_RESPONSES.labels(route_label(request.scope), "full").inc()
+    return Response(content=snapshot.body, media_type="application/json", headers=headers)
@@ -0,0 +1,172 @@
+import time
+import uuid
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from app.services.notion_sync import SyncProgress, sync_notion_data
+from app.services.notion_api import notion_api
+from app.services.metrics import SYNC_RUNS
+from app.services.shared_state import SHARED_POLL_INTERVAL, shared_state
+
+logger = logging.getLogger(__name__)
+
+# Finished jobs kept for the status endpoint
+JOB_HISTORY = 20
+# Seconds between status updates of a running job for the other workers
+STATUS_INTERVAL = 1.0
+# How long a follower waits for the leader to take on its sync request (seconds)
+REQUEST_TIMEOUT = 10
+
+class SyncJob:
+    def __init__(self, full: bool):
+        self.id = uuid.uuid4().hex[:12]
+        self.full = full
+        self.state = "queued" # queued, running, done, failed
+        self.created = time.time()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.progress = SyncProgress()
+        self.task: Optional[asyncio.Task] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        end = self.finished or time.time()
+        return {
+            "job_id": self.id,
+            "full": self.full,
+            "state": self.state,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "duration": round(end - self.started, 3) if self.started else None,
+            **self.progress.to_dict(),
+        }
+
+class SyncJobRunner:
+    """
+    Single-flight runner for Notion syncs. At most one sync runs at a time;
+    a trigger while one is running joins it instead of starting a second one.
+    A full sync requested during an incremental one is queued once and runs
+    right after it (further triggers join the queued job).
+
+    Syncs only run in the leader worker. A follower forwards a trigger as a
+    "sync-request:<id>" key in the shared state and waits until the leader
+    lists the job for it; the leader publishes the jobs ("sync-jobs") every
+    STATUS_INTERVAL while one runs, so sync_status works on every worker.
+    """
+    def __init__(self):
+        self._jobs: "OrderedDict[str, SyncJob]" = OrderedDict()
+        self._running: Optional[SyncJob] = None
+        self._queued: Optional[SyncJob] = None
+        self._requests: "OrderedDict[str, str]" = OrderedDict() # request id -> job id
+        self._publisher: Optional[asyncio.Task] = None
+        shared_state.watch("sync-request:*", self._request_received)
+
+    def trigger(self, full: bool = False) -> SyncJob:
+        running = self._running
+        if running is not None:
+            if running.full or not full:
+                logger.info(f"Sync already running ({running.id}), joining it.")
+                return running
+            if self._queued is None:
+                self._queued = self._start(SyncJob(full=True), after=running)
+            return self._queued
+        self._running = self._start(SyncJob(full=full))
+        return self._running
+
+    async def run(self, full: bool = False) -> SyncJob:
+        """Triggers (or joins) a sync and waits for it to finish."""
+        job = self.trigger(full)
+        await asyncio.shield(job.task)
+        return job
+
+    def get(self, job_id: str = None) -> Optional[SyncJob]:
+        if job_id is None:
+            return next(reversed(self._jobs.values()), None)
+        return self._jobs.get(job_id)
+
+    async def request(self, full: bool = False) -> Optional[Dict[str, Any]]:
+        """
+        trigger() from any worker; returns the job as a dict, or None if no
+        leader took the request on within REQUEST_TIMEOUT.
+        """
+        if shared_state.is_leader:
+            return self.trigger(full).to_dict()
+        request_id = uuid.uuid4().hex[:12]
+        await shared_state.set(f"sync-request:{request_id}", {"full": full})
+        deadline = time.monotonic() + REQUEST_TIMEOUT
+        while time.monotonic() < deadline:
+            await asyncio.sleep(SHARED_POLL_INTERVAL)
+            published = shared_state.get("sync-jobs") or {}
+            job_id = published.get("requests", {}).get(request_id)
+            if job_id is not None:
+                return next((job for job in published["jobs"] if job["job_id"] == job_id), None)
+        return None
+
+    def status(self, job_id: str = None) -> Optional[Dict[str, Any]]:
+        """A job (default: the most recent one) plus the Notion API counters, on any worker."""
+        if shared_state.is_leader:
+            job = self.get(job_id)
+            return {**job.to_dict(), "notion": notion_api.stats()} if job else None
+        published = shared_state.get("sync-jobs") or {}
+        jobs = published.get("jobs") or []
+        job = next((job for job in jobs if job_id in (None, job["job_id"])), None)
+        return {**job, "notion": published.get("notion")} if job else None
+
+    async def _request_received(self, key: str, request: Dict[str, Any]):
+        if not shared_state.is_leader:
+            return
+        job = self.trigger(bool(request.get("full")))
+        logger.info(f"Sync requested by another worker, job {job.id}.")
+        self._requests[key.split(":", 1)[1]] = job.id
+        while len(self._requests) > JOB_HISTORY:
+            self._requests.popitem(last=False)
+        await self._publish()
+        await shared_state.delete(key)
+
+    async def _publish(self):
+        await shared_state.set("sync-jobs", {
+            "jobs": [job.to_dict() for job in reversed(self._jobs.values())],
+            "requests": dict(self._requests),
+            "notion": notion_api.stats(),
+        })
+
+    async def _publish_while_running(self):
+        while self._running is not None:
+            await self._publish()
+            await asyncio.sleep(STATUS_INTERVAL)
+        await self._publish()
+
+    def _start(self, job: SyncJob, after: SyncJob = None) -> SyncJob:
+        self._jobs[job.id] = job
+        while len(self._jobs) > JOB_HISTORY:
+            self._jobs.popitem(last=False)
+        job.task = asyncio.create_task(self._execute(job, after))
+        if shared_state.shared and (self._publisher is None or self._publisher.done()):
+            self._publisher = asyncio.create_task(self._publish_while_running())
+        return job
+
+    async def _execute(self, job: SyncJob, after: Optional[SyncJob]):
+        if after is not None:
+            await asyncio.gather(after.task, return_exceptions=True)
+
+        job.state = "running"
+        job.started = time.time()
+        logger.info(f"Sync job {job.id} started ({'full' if job.full else 'incremental'}).")
+        try:
+            await sync_notion_data(full=job.full, progress=job.progress)
+            job.state = "failed" if job.progress.error else "done"
+        except Exception as e:
+            logger.error(f"Sync job {job.id} crashed: {e}")
+            job.progress.error = str(e)
+            job.state = "failed"
+        finally:
+            job.finished = time.time()
+            SYNC_RUNS.labels(job.progress.mode or "none", job.state).inc()
+            # Hand over to the queued job (if any) before anyone can trigger a new one
+            if self._running is job:
+                self._running, self._queued = self._queued, None
+            logger.info(f"Sync job {job.id} {job.state} in {job.finished - job.started:.2f}s.")
+
+sync_runner = SyncJobRunner()
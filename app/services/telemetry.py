@@ -0,0 +1,320 @@
+import os
+import math
+import time
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, List, Optional
+from app.services.snapshot import Snapshot
+from app.services.schedule import slide_schedule
+from app.services.metrics import SCREENS_ONLINE
+from app.services.shared_state import shared_state
+
+logger = logging.getLogger(__name__)
+
+# Seconds between heartbeats (told to the players in every response)
+TELEMETRY_INTERVAL = int(os.getenv("TELEMETRY_INTERVAL", 15))
+# A screen without heartbeat for this long counts as offline
+TELEMETRY_OFFLINE_AFTER = int(os.getenv("TELEMETRY_OFFLINE_AFTER", 90))
+# Screens tracked at most; the one silent the longest is dropped first
+TELEMETRY_MAX_SCREENS = int(os.getenv("TELEMETRY_MAX_SCREENS", 1000))
+# Per screen ring buffers
+HISTORY_SIZE = 60 # heartbeats
+LOAD_SAMPLES = 100 # media load times
+ERROR_SAMPLES = 20
+# Per report limits (reports come from the network)
+MAX_EVENTS = 200
+MAX_TEXT = 200
+# The fleet overview is rebuilt at most this often (seconds)
+OVERVIEW_TTL = 2.0
+
+def _text(value: Any) -> Optional[str]:
+    if value is None:
+        return None
+    return str(value)[:MAX_TEXT]
+
+def _number(value: Any) -> Optional[float]:
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    # inf/nan would overflow int() or poison the percentiles
+    return number if math.isfinite(number) and number >= 0 else None
+
+def _heartbeat(report: Dict) -> Dict[str, Any]:
+    """
+    Validated copy of a report, built before any screen is touched: a
+    malformed heartbeat is rejected or cleaned as a whole, never half-applied.
+    """
+    heartbeat = {
+        "channel": _text(report.get("channel")) or None,
+        "playlist": _text(report.get("playlist")) or None,
+        "uptime": _number(report.get("uptime")),
+        "slide": None,
+        "load_times": [],
+        "errors": [],
+        "frames_dropped": 0,
+        "frames_total": 0,
+    }
+    slide = report.get("slide")
+    if isinstance(slide, dict):
+        index = _number(slide.get("index"))
+        heartbeat["slide"] = {
+            "id": _text(slide.get("id")),
+            "index": int(index) if index is not None else None,
+            "type": _text(slide.get("type")),
+        }
+    events = report.get("events")
+    for event in (events if isinstance(events, list) else [])[:MAX_EVENTS]:
+        if not isinstance(event, dict):
+            continue
+        kind = event.get("type")
+        if kind == "media_load":
+            ms = _number(event.get("ms"))
+            if ms is not None:
+                heartbeat["load_times"].append(ms)
+        elif kind == "frames":
+            heartbeat["frames_dropped"] += int(_number(event.get("dropped")) or 0)
+            heartbeat["frames_total"] += int(_number(event.get("total")) or 0)
+        elif kind in ("media_error", "error"):
+            heartbeat["errors"].append({
+                "type": kind,
+                "url": _text(event.get("url")),
+                "message": _text(event.get("message")),
+            })
+    return heartbeat
+
+def _percentile(values: List[float], fraction: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+class ScreenState:
+    """Everything known about one player, in fixed-size buffers."""
+    def __init__(self, screen_id: str):
+        self.id = screen_id
+        self.first_seen = time.time()
+        self.last_seen = self.first_seen
+        self.channel: Optional[str] = None
+        self.playlist: Optional[str] = None # ETag of the playlist the player shows
+        self.slide: Optional[Dict] = None
+        self.user_agent: Optional[str] = None
+        self.address: Optional[str] = None
+        self.uptime: Optional[float] = None
+        self.reports = 0
+        self.media_loads = 0
+        self.media_errors = 0
+        self.errors = 0
+        self.frames_dropped = 0
+        self.frames_total = 0
+        self.history: Deque[Dict] = deque(maxlen=HISTORY_SIZE)
+        self.load_times: Deque[float] = deque(maxlen=LOAD_SAMPLES)
+        self.recent_errors: Deque[Dict] = deque(maxlen=ERROR_SAMPLES)
+
+    def apply(self, heartbeat: Dict, now: float):
+        """Takes over a heartbeat validated by _heartbeat() (cannot fail halfway)."""
+        self.last_seen = now
+        self.reports += 1
+        self.channel = heartbeat["channel"]
+        self.playlist = heartbeat["playlist"] or self.playlist
+        self.uptime = heartbeat["uptime"]
+        if heartbeat["slide"] is not None:
+            self.slide = heartbeat["slide"]
+        self.load_times.extend(heartbeat["load_times"])
+        self.media_loads += len(heartbeat["load_times"])
+        self.frames_dropped += heartbeat["frames_dropped"]
+        self.frames_total += heartbeat["frames_total"]
+        for error in heartbeat["errors"]:
+            if error["type"] == "media_error":
+                self.media_errors += 1
+            else:
+                self.errors += 1
+            self.recent_errors.append({"time": now, **error})
+        self.history.append({
+            "time": now,
+            "playlist": self.playlist,
+            "slide": self.slide["id"] if self.slide else None,
+            "loads": len(heartbeat["load_times"]),
+            "errors": len(heartbeat["errors"]),
+            "dropped_frames": heartbeat["frames_dropped"],
+        })
+
+    def summary(self, now: float, current_playlists: Dict[Optional[str], str]) -> Dict[str, Any]:
+        loads = list(self.load_times)
+        return _status({
+            "id": self.id,
+            "channel": self.channel,
+            "last_seen": self.last_seen,
+            "first_seen": self.first_seen,
+            "address": self.address,
+            "user_agent": self.user_agent,
+            "uptime": self.uptime,
+            "slide": self.slide,
+            "playlist": self.playlist,
+            "reports": self.reports,
+            "media_loads": self.media_loads,
+            "media_errors": self.media_errors,
+            "errors": self.errors,
+            "frames_dropped": self.frames_dropped,
+            "frames_total": self.frames_total,
+            "load_ms_p50": _percentile(loads, 0.5),
+            "load_ms_p95": _percentile(loads, 0.95),
+            "last_error": self.recent_errors[-1] if self.recent_errors else None,
+        }, now, current_playlists)
+
+    def detail(self, now: float, current_playlists: Dict[Optional[str], str]) -> Dict[str, Any]:
+        return {
+            **self.summary(now, current_playlists),
+            "history": list(self.history),
+            "recent_errors": list(self.recent_errors),
+        }
+
+def _status(summary: Dict[str, Any], now: float, current_playlists: Dict[Optional[str], str]) -> Dict[str, Any]:
+    """Adds the time and playlist dependent fields (online, playlist_current) to a summary."""
+    expected = current_playlists.get(summary["channel"])
+    return {
+        **summary,
+        "online": now - summary["last_seen"] <= TELEMETRY_OFFLINE_AFTER,
+        "playlist_current": expected is not None and summary["playlist"] == expected,
+    }
+
+class Fleet:
+    """
+    In-memory aggregation of player heartbeats. A report only updates the
+    buffers of its screen (O(events)); nothing is written to disk. The
+    overview for the admin panel is built from the buffers on demand and
+    cached for OVERVIEW_TTL, so many admins polling cost nothing extra.
+
+    With several workers, a screen reports to whichever worker its
+    connection landed on. Every worker publishes the summaries of its
+    screens each TELEMETRY_INTERVAL ("fleet:<worker>"), and the overview
+    merges them (the newest heartbeat of a screen wins). The heartbeat
+    history of a screen is only available on its own worker.
+    """
+    def __init__(self):
+        self._screens: "OrderedDict[str, ScreenState]" = OrderedDict()
+        self._overview: Optional[Snapshot] = None
+        self._overview_built = 0.0
+        self._remote: Dict[str, Dict[str, Any]] = {} # worker key -> {"time", "screens"}
+        self._forgotten: Dict[str, float] = {} # screen id -> when it was forgotten
+        shared_state.watch("fleet:*", self._remote_changed)
+        shared_state.watch("fleet-forget:*", self._forget_changed)
+
+    def __len__(self) -> int:
+        return len(self._screens)
+
+    def online(self) -> int:
+        cutoff = time.time() - TELEMETRY_OFFLINE_AFTER
+        return sum(1 for screen in self._screens.values() if screen.last_seen >= cutoff)
+
+    def report(self, screen_id: str, report: Dict, address: str = None, user_agent: str = None) -> ScreenState:
+        screen_id = _text(screen_id)
+        heartbeat = _heartbeat(report)
+        screen = self._screens.get(screen_id)
+        if screen is None:
+            screen = self._screens[screen_id] = ScreenState(screen_id)
+            logger.info(f"New screen reporting: {screen_id} ({address}).")
+            while len(self._screens) > TELEMETRY_MAX_SCREENS:
+                dropped, _ = self._screens.popitem(last=False)
+                logger.info(f"Screen {dropped} dropped from telemetry (limit {TELEMETRY_MAX_SCREENS}).")
+        else:
+            # Most recently seen last, so the eviction above drops silent screens
+            self._screens.move_to_end(screen_id)
+        screen.address = address
+        screen.user_agent = _text(user_agent)
+        screen.apply(heartbeat, time.time())
+        return screen
+
+    def _current_playlists(self, channels) -> Dict[Optional[str], str]:
+        return {channel: slide_schedule.snapshot_at(channel=channel).etag for channel in set(channels)}
+
+    def _remote_summaries(self, now: float) -> List[Dict[str, Any]]:
+        """Screens published by the other workers (skipping workers gone for TELEMETRY_OFFLINE_AFTER)."""
+        summaries = []
+        for published in self._remote.values():
+            if now - published["time"] > TELEMETRY_OFFLINE_AFTER:
+                continue
+            summaries.extend(
+                summary for summary in published["screens"]
+                if summary["last_seen"] > self._forgotten.get(summary["id"], 0)
+            )
+        return summaries
+
+    def overview(self) -> Snapshot:
+        now = time.time()
+        if self._overview is not None and now - self._overview_built < OVERVIEW_TTL:
+            return self._overview
+        screens = list(self._screens.values())
+        remote = self._remote_summaries(now)
+        current = self._current_playlists([screen.channel for screen in screens] + [s["channel"] for s in remote])
+        merged: Dict[str, Dict[str, Any]] = {}
+        for summary in [_status(s, now, current) for s in remote] + [screen.summary(now, current) for screen in screens]:
+            known = merged.get(summary["id"])
+            if known is None or summary["last_seen"] >= known["last_seen"]:
+                merged[summary["id"]] = summary
+        summaries = sorted(merged.values(), key=lambda s: s["id"])
+        self._overview = Snapshot({
+            "interval": TELEMETRY_INTERVAL,
+            "screens": summaries,
+            "totals": {
+                "screens": len(summaries),
+                "online": sum(1 for s in summaries if s["online"]),
+                "outdated": sum(1 for s in summaries if s["online"] and not s["playlist_current"]),
+                "media_errors": sum(s["media_errors"] for s in summaries),
+                "frames_dropped": sum(s["frames_dropped"] for s in summaries),
+            },
+        })
+        self._overview_built = now
+        return self._overview
+
+    def detail(self, screen_id: str) -> Optional[Dict]:
+        screen = self._screens.get(screen_id)
+        now = time.time()
+        if screen is None:
+            # Reporting to another worker: its summary, without the history
+            remote = [s for s in self._remote_summaries(now) if s["id"] == screen_id]
+            if not remote:
+                return None
+            summary = max(remote, key=lambda s: s["last_seen"])
+            return {
+                **_status(summary, now, self._current_playlists([summary["channel"]])),
+                "history": [],
+                "recent_errors": [summary["last_error"]] if summary["last_error"] else [],
+            }
+        return screen.detail(now, self._current_playlists([screen.channel]))
+
+    async def forget(self, screen_id: str) -> bool:
+        self._overview = None
+        known = self._screens.pop(screen_id, None) is not None
+        if shared_state.shared:
+            known = known or any(s["id"] == screen_id for s in self._remote_summaries(time.time()))
+            self._forgotten[screen_id] = time.time()
+            await shared_state.set(f"fleet-forget:{screen_id}", self._forgotten[screen_id])
+        return known
+
+    def _forget_changed(self, key: str, forgotten: float):
+        screen_id = key.split(":", 1)[1]
+        self._forgotten[screen_id] = forgotten
+        screen = self._screens.get(screen_id)
+        if screen is not None and screen.last_seen <= forgotten:
+            del self._screens[screen_id]
+        self._overview = None
+
+    def _remote_changed(self, key: str, published: Dict[str, Any]):
+        self._remote[key] = published
+        self._overview = None
+
+    async def publish_loop(self):
+        """Publishes the summaries of this worker's screens for the others (several workers only)."""
+        while True:
+            now = time.time()
+            screens = [screen.summary(now, {}) for screen in self._screens.values()]
+            try:
+                await shared_state.set(f"fleet:{shared_state.worker_id}", {"time": now, "screens": screens})
+            except Exception as e:
+                logger.error(f"Publishing the fleet failed: {e}")
+            await asyncio.sleep(TELEMETRY_INTERVAL)
+
+fleet = Fleet()
+SCREENS_ONLINE.set_function(fleet.online)
@@ -0,0 +1,164 @@
+import os
+import shutil
+import asyncio
+import inspect
+import logging
+from pathlib import Path
+from typing import Any, Callable, List, Set
+
+from app.services import file_manager
+from app.services.file_manager import MEDIA_DIR
+
+logger = logging.getLogger(__name__)
+
+# Optional: normalize videos for the players (needs ffmpeg in the container)
+VIDEO_TRANSCODE = os.getenv("VIDEO_TRANSCODE", "false").lower() in ("1", "true", "yes")
+VIDEO_CODEC = os.getenv("VIDEO_CODEC", "h264") # h264 or vp9
+VIDEO_MAX_BITRATE = os.getenv("VIDEO_MAX_BITRATE", "4M")
+VIDEO_MAX_WIDTH = int(os.getenv("VIDEO_MAX_WIDTH", 1920))
+VIDEO_WORKERS = int(os.getenv("VIDEO_WORKERS", 1))
+
+def _bufsize(bitrate: str) -> str:
+    """Rate control buffer of two seconds at the maximum bitrate."""
+    number, unit = bitrate[:-1], bitrate[-1]
+    if unit.isdigit():
+        return str(int(bitrate) * 2)
+    return f"{float(number) * 2:g}{unit}"
+
+def _video_args() -> List[str]:
+    scale = f"scale='min({VIDEO_MAX_WIDTH},iw)':-2"
+    rate = ["-maxrate", VIDEO_MAX_BITRATE, "-bufsize", _bufsize(VIDEO_MAX_BITRATE)]
+    if VIDEO_CODEC == "vp9":
+        return ["-vf", scale, "-c:v", "libvpx-vp9", "-crf", "32", "-b:v", "0", *rate,
+                "-row-mt", "1", "-c:a", "libopus", "-b:a", "128k", "-f", "webm"]
+    # faststart moves the moov atom to the front so playback starts immediately
+    return ["-vf", scale, "-c:v", "libx264", "-preset", "veryfast", "-crf", "23", *rate,
+            "-pix_fmt", "yuv420p", "-c:a", "aac", "-b:a", "128k",
+            "-movflags", "+faststart", "-f", "mp4"]
+
+def _output_ext() -> str:
+    return ".webm" if VIDEO_CODEC == "vp9" else ".mp4"
+
+async def _ffmpeg(args: List[str], target: Path) -> bool:
+    """Runs ffmpeg into a temp file and renames it to `target` on success."""
+    tmp = target.with_name(f".{target.name}.part")
+    process = await asyncio.create_subprocess_exec(
+        "ffmpeg", "-y", "-v", "error", *args, str(tmp),
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    try:
+        _, stderr = await process.communicate()
+    except asyncio.CancelledError:
+        if process.returncode is None:
+            process.kill()
+        # Reap it (no zombie, transport closed) even while the worker is being cancelled
+        await asyncio.shield(process.wait())
+        tmp.unlink(missing_ok=True)
+        raise
+    if process.returncode != 0:
+        tmp.unlink(missing_ok=True)
+        logger.error(f"ffmpeg failed for {target.name}: {stderr.decode(errors='replace')[-500:]}")
+        return False
+    os.replace(tmp, target)
+    return True
+
+class VideoTranscoder:
+    """
+    Background queue that normalizes synced videos with ffmpeg worker
+    processes: capped bitrate/resolution, faststart (H.264) or VP9, plus a
+    poster frame. Results are recorded in the media index as "optimized" and
+    "poster"; listeners are told so the playlist can switch over. Until then
+    players keep getting the original file.
+    """
+    def __init__(self):
+        self.enabled = VIDEO_TRANSCODE
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._queued: Set[str] = set()
+        self._workers: List[asyncio.Task] = []
+        self._listeners: List[Callable[[], Any]] = []
+
+    @property
+    def pending(self) -> int:
+        return len(self._queued)
+
+    def add_listener(self, callback: Callable[[], Any]):
+        self._listeners.append(callback)
+
+    def start(self):
+        if not self.enabled:
+            return
+        if shutil.which("ffmpeg") is None:
+            logger.warning("VIDEO_TRANSCODE is enabled but ffmpeg was not found. Serving videos as uploaded.")
+            self.enabled = False
+            return
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(VIDEO_WORKERS)]
+        logger.info(f"Video transcoder started ({VIDEO_WORKERS} workers, {VIDEO_CODEC}, max {VIDEO_MAX_BITRATE} / {VIDEO_MAX_WIDTH}px).")
+
+    def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        self._workers = []
+
+    def needs_transcode(self, key: str) -> bool:
+        entry = file_manager.media_index.get(key)
+        if not self.enabled or entry is None:
+            return False
+        return not all(
+            entry.get(field) and (MEDIA_DIR / entry[field]).exists()
+            for field in ("optimized", "poster")
+        )
+
+    def enqueue(self, key: str):
+        """Queues a video media key; ignored if disabled, done or already queued."""
+        if key in self._queued or not self.needs_transcode(key):
+            return
+        self._queued.add(key)
+        self._queue.put_nowait(key)
+
+    async def _worker(self):
+        while True:
+            key = await self._queue.get()
+            try:
+                if await self._transcode(key):
+                    for callback in self._listeners:
+                        result = callback()
+                        if inspect.isawaitable(result):
+                            await result
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Transcoding {key} failed: {e}")
+            finally:
+                self._queued.discard(key)
+                self._queue.task_done()
+
+    async def _transcode(self, key: str) -> bool:
+        entry = file_manager.media_index.get(key)
+        if entry is None:
+            return False
+        source = MEDIA_DIR / entry["filename"]
+        stem = Path(entry["filename"]).stem
+        optimized = MEDIA_DIR / f"{stem}_opt{_output_ext()}"
+        poster = MEDIA_DIR / f"{stem}_poster.jpg"
+
+        logger.info(f"Transcoding {entry['filename']} -> {optimized.name}")
+        if not optimized.exists() and not await _ffmpeg(["-i", str(source), *_video_args()], optimized):
+            return False
+        if not poster.exists() and not await _ffmpeg([
+            "-i", str(source), "-vf", f"thumbnail,scale='min({VIDEO_MAX_WIDTH},iw)':-2",
+            "-frames:v", "1", "-q:v", "3", "-f", "image2",
+        ], poster):
+            return False
+
+        # The entry may have been replaced while ffmpeg was running
+        current = file_manager.media_index.get(key)
+        if current is None or current["filename"] != entry["filename"]:
+            file_manager.media_index.orphans |= {optimized.name, poster.name}
+            return False
+        file_manager.media_index.update(key, optimized=optimized.name, poster=poster.name)
+        await file_manager.media_index.save_async()
+        logger.info(f"Video {key} optimized: {optimized.name} ({optimized.stat().st_size} bytes, was {source.stat().st_size})")
+        return True
+
+video_transcoder = VideoTranscoder()
@@ -0,0 +1,103 @@
+import os
+import sys
+import time
+import asyncio
+import hashlib
+import logging
+import threading
+import traceback
+from typing import Dict, Optional
+from app.services.metrics import EVENT_LOOP_LAG, EVENT_LOOP_LAG_MAX, EVENT_LOOP_STALLS
+
+logger = logging.getLogger(__name__)
+
+# How often the loop stamps its heartbeat (seconds)
+LOOP_PROBE_INTERVAL = 0.1
+# Loop blocked longer than this (seconds): log the stack of the blocking code (0 = off)
+LOOP_WATCHDOG_THRESHOLD = float(os.getenv("LOOP_WATCHDOG_THRESHOLD", 0.25))
+# The same stack is logged in full at most once per this many seconds
+STACK_LOG_INTERVAL = 60
+# Innermost frames kept in the log
+STACK_DEPTH = 25
+
+class LoopWatchdog:
+    """
+    Finds code that blocks the event loop, while it is blocking.
+
+    A task on the loop wakes up every LOOP_PROBE_INTERVAL, stamps a heartbeat
+    and records how late it woke up (signage_event_loop_lag_seconds). A daemon
+    thread watches the heartbeat: once it is older than the threshold, the
+    loop thread is still inside the blocking call, so its current stack is
+    logged. That names the culprit (a file write, a parse, a json.dump)
+    instead of only showing that the loop stalled.
+    """
+    def __init__(self, threshold: float = LOOP_WATCHDOG_THRESHOLD, interval: float = LOOP_PROBE_INTERVAL):
+        self.threshold = threshold
+        self.interval = interval
+        self._heartbeat = time.monotonic()
+        self._loop_thread: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+        self._logged_stacks: Dict[str, float] = {}
+
+    def start(self):
+        self._loop_thread = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._task = asyncio.get_running_loop().create_task(self._probe())
+        if self.threshold > 0:
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+            self._thread.start()
+            logger.info(f"Event loop watchdog active (threshold {self.threshold * 1000:.0f} ms).")
+
+    def stop(self):
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _probe(self):
+        loop = asyncio.get_running_loop()
+        worst = 0.0
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self._heartbeat = time.monotonic()
+            lag = max(0.0, loop.time() - started - self.interval)
+            EVENT_LOOP_LAG.observe(lag)
+            if lag > worst:
+                worst = lag
+                EVENT_LOOP_LAG_MAX.set(lag)
+            if self.threshold > 0 and lag >= self.threshold:
+                EVENT_LOOP_STALLS.inc()
+                logger.warning(f"Event loop was blocked for {lag * 1000:.0f} ms.")
+
+    def _watch(self):
+        reported = None # heartbeat of the stall whose stack was logged
+        while not self._stopped.wait(self.threshold / 2):
+            heartbeat = self._heartbeat
+            blocked = time.monotonic() - heartbeat
+            if blocked < self.threshold + self.interval or heartbeat == reported:
+                continue
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is None:
+                continue
+            reported = heartbeat
+            self._log_stack(frame, blocked)
+
+    def _log_stack(self, frame, blocked: float):
+        stack = "".join(traceback.format_stack(frame)[-STACK_DEPTH:])
+        fingerprint = hashlib.sha1(stack.encode()).hexdigest()
+        now = time.monotonic()
+        last = self._logged_stacks.get(fingerprint)
+        if last is not None and now - last < STACK_LOG_INTERVAL:
+            summary = traceback.extract_stack(frame)[-1]
+            logger.warning(f"Event loop blocked for {blocked * 1000:.0f} ms so far, again in {summary.filename}:{summary.lineno} ({summary.name}).")
+            return
+        if len(self._logged_stacks) > 100:
+            self._logged_stacks.clear()
+        self._logged_stacks[fingerprint] = now
+        logger.warning(f"Event loop blocked for {blocked * 1000:.0f} ms so far, currently at:\n{stack}")
+
+loop_watchdog = LoopWatchdog()
@@ -1,9 +1,9 @@
 const CACHE_NAME = 'ds-cache-v1';
 
 // Assets to pre-cache
+// (addAll fails as a whole if one of these is missing)
 const PRECACHE_URLS = [
   '/',
-  '/static/manifest.json', // If exists
   '/api/settings'
 ];
 
@@ -27,15 +27,33 @@ self.addEventListener('activate', event => {
 });
 
 self.addEventListener('fetch', event => {
+  // Only GETs can be cached (the Cache API rejects POST, e.g. the heartbeats)
+  if (event.request.method !== 'GET') {
+    return;
+  }
+
   const url = new URL(event.request.url);
 
+  // 0. Event stream: never intercept (long-lived, must not be cached)
+  if (url.pathname === '/api/events') {
+    return;
+  }
+
   // 1. Media Files: Cache First, fallback to Network
+  // File names are content hashes, so a cached copy never goes stale.
   if (url.pathname.startsWith('/media/')) {
+     const range = event.request.headers.get('range');
      event.respondWith(
        caches.open(CACHE_NAME).then(cache => {
-         return cache.match(event.request).then(response => {
-           return response || fetch(event.request).then(networkResponse => {
-             cache.put(event.request, networkResponse.clone());
+         return cache.match(url.pathname).then(response => {
+           if (response) {
+             return range ? rangeResponse(response, range) : response;
+           }
+           return fetch(event.request).then(networkResponse => {
+             // Only complete bodies are cached; 206 parts can't be reused
+             if (networkResponse.status === 200) {
+               cache.put(url.pathname, networkResponse.clone());
+             }
              return networkResponse;
            });
          });
@@ -64,9 +82,228 @@ self.addEventListener('fetch', event => {
   );
 });
 
-// Listen for "SKIP_WAITING" message (triggered by Refresh button)
+// Answers a video seek (Range: bytes=a-b) from a fully cached file.
+// A Blob slice is served from the cache's storage without copying the file into memory
+function rangeResponse(response, rangeHeader) {
+  return response.blob().then(blob => {
+    const size = blob.size;
+    const match = /^bytes=(\d*)-(\d*)$/.exec(rangeHeader.trim());
+    let start = 0;
+    let end = size - 1;
+    if (match && match[1] !== '') {
+      start = parseInt(match[1], 10);
+      if (match[2] !== '') end = Math.min(parseInt(match[2], 10), size - 1);
+    } else if (match && match[2] !== '') {
+      start = Math.max(0, size - parseInt(match[2], 10));
+    } else {
+      return new Response(blob, { status: 200, headers: response.headers });
+    }
+    if (start >= size || end < start) {
+      return new Response(null, { status: 416, headers: { 'Content-Range': `bytes */${size}` } });
+    }
+    const headers = new Headers(response.headers);
+    headers.set('Content-Range', `bytes ${start}-${end}/${size}`);
+    headers.set('Content-Length', String(end - start + 1));
+    return new Response(blob.slice(start, end + 1), { status: 206, statusText: 'Partial Content', headers });
+  });
+}
+
+// --- Background prefetch (driven by the player with the server's manifest) ---
+let prefetchQueue = [];
+let prefetchRate = 0; // bytes per second, 0 = unlimited
+let prefetchRunning = null;
+
+const sleep = ms => new Promise(resolve => setTimeout(resolve, ms));
+
+// Downloads a file no faster than `rate` bytes/s
+async function fetchPaced(url, rate) {
+  const response = await fetch(url);
+  if (response.status !== 200 || !rate || !response.body) return response;
+  const reader = response.body.getReader();
+  const chunks = [];
+  const started = Date.now();
+  let received = 0;
+  for (;;) {
+    const { done, value } = await reader.read();
+    if (done) break;
+    chunks.push(value);
+    received += value.length;
+    const ahead = received / rate * 1000 - (Date.now() - started);
+    if (ahead > 0) await sleep(ahead);
+  }
+  return new Response(new Blob(chunks), { status: 200, statusText: 'OK', headers: response.headers });
+}
+
+async function runPrefetch() {
+  // A running bundle download brings most of the queue along
+  if (bundleRunning) await bundleRunning;
+  const cache = await caches.open(CACHE_NAME);
+  while (prefetchQueue.length > 0) {
+    const item = prefetchQueue.shift();
+    if (await cache.match(item.url)) continue;
+    try {
+      const response = await fetchPaced(item.url, prefetchRate);
+      if (response.status === 200) await cache.put(item.url, response);
+    } catch (e) {
+      // Offline or aborted: the next manifest retries it
+    }
+  }
+  prefetchRunning = null;
+}
+
+// Drops cached media that is no longer part of any playlist
+async function evictMedia(keep) {
+  const cache = await caches.open(CACHE_NAME);
+  const requests = await cache.keys();
+  await Promise.all(requests
+    .filter(request => {
+      const path = new URL(request.url).pathname;
+      return path.startsWith('/media/') && !keep.has(path);
+    })
+    .map(request => cache.delete(request)));
+}
+
+// --- Cold start: whole playlist as one tar from /api/bundle ---
+const BUNDLE_MIN_MISSING = 3; // below that, single requests are just as good
+const BUNDLE_ATTEMPTS = 5;
+const MEDIA_TYPES = {
+  jpg: 'image/jpeg', jpeg: 'image/jpeg', png: 'image/png', gif: 'image/gif',
+  webp: 'image/webp', avif: 'image/avif', svg: 'image/svg+xml',
+  mp4: 'video/mp4', webm: 'video/webm', mov: 'video/quicktime'
+};
+let bundleRunning = null;
+
+// Incremental reader for the (uncompressed, USTAR) bundle stream
+class TarReader {
+  constructor(onFile) {
+    this.onFile = onFile;
+    this.buffer = new Uint8Array(0);
+    this.member = null; // { name, size, chunks, received }
+    this.skip = 0;      // padding after a member
+    this.done = false;
+  }
+
+  static text(bytes) {
+    const end = bytes.indexOf(0);
+    return new TextDecoder().decode(end === -1 ? bytes : bytes.subarray(0, end));
+  }
+
+  async push(chunk) {
+    let data = chunk;
+    while (data.length > 0 && !this.done) {
+      if (this.skip > 0) {
+        const n = Math.min(this.skip, data.length);
+        this.skip -= n;
+        data = data.subarray(n);
+      } else if (this.member) {
+        const m = this.member;
+        const n = Math.min(m.size - m.received, data.length);
+        m.chunks.push(data.slice(0, n));
+        m.received += n;
+        data = data.subarray(n);
+        if (m.received === m.size) {
+          this.member = null;
+          this.skip = (512 - m.size % 512) % 512;
+          await this.onFile(m.name, new Blob(m.chunks));
+        }
+      } else {
+        const n = Math.min(512 - this.buffer.length, data.length);
+        const header = new Uint8Array(this.buffer.length + n);
+        header.set(this.buffer);
+        header.set(data.subarray(0, n), this.buffer.length);
+        this.buffer = header;
+        data = data.subarray(n);
+        if (header.length < 512) break;
+        this.buffer = new Uint8Array(0);
+        const name = TarReader.text(header.subarray(0, 100));
+        if (!name) { this.done = true; break; } // end-of-archive block
+        const prefix = TarReader.text(header.subarray(345, 500));
+        const size = parseInt(TarReader.text(header.subarray(124, 136)).trim() || '0', 8);
+        this.member = { name: prefix ? `${prefix}/${name}` : name, size, chunks: [], received: 0 };
+        if (size === 0) {
+          this.member = null;
+          await this.onFile(prefix ? `${prefix}/${name}` : name, new Blob([]));
+        }
+      }
+    }
+  }
+}
+
+// Downloads the missing media of the playlist as one bundle, resuming after
+// network errors with Range/If-Range from the last byte received.
+async function runBundle(query) {
+  const cache = await caches.open(CACHE_NAME);
+  const manifest = await (await fetch('/api/prefetch' + query)).json();
+  const have = [];
+  let missing = 0;
+  const seen = new Set();
+  for (const slide of manifest.slides) {
+    for (const media of slide.media) {
+      if (seen.has(media.url)) continue;
+      seen.add(media.url);
+      if (await cache.match(media.url)) have.push(media.hash.slice(0, 16));
+      else missing++;
+    }
+  }
+  if (missing < BUNDLE_MIN_MISSING) return;
+
+  let reader = null;
+  let offset = 0;
+  let etag = null;
+  for (let attempt = 0; attempt < BUNDLE_ATTEMPTS; attempt++) {
+    const headers = { 'Content-Type': 'application/json' };
+    if (offset > 0 && etag) {
+      headers['Range'] = `bytes=${offset}-`;
+      headers['If-Range'] = etag;
+    }
+    try {
+      const response = await fetch('/api/bundle' + query, { method: 'POST', headers, body: JSON.stringify({ have }) });
+      if (response.status !== 200 && response.status !== 206) throw new Error(`bundle: HTTP ${response.status}`);
+      if (response.status === 200 || !reader) {
+        // Fresh (or changed) bundle: start over
+        offset = 0;
+        reader = new TarReader(async (name, blob) => {
+          if (!name.startsWith('media/')) return;
+          const file = name.slice('media/'.length);
+          const type = MEDIA_TYPES[file.split('.').pop().toLowerCase()] || 'application/octet-stream';
+          await cache.put('/media/' + file, new Response(blob, {
+            status: 200, headers: { 'Content-Type': type, 'Content-Length': String(blob.size) }
+          }));
+        });
+      }
+      etag = response.headers.get('ETag');
+      const body = response.body.getReader();
+      for (;;) {
+        const { done, value } = await body.read();
+        if (done) break;
+        offset += value.length;
+        await reader.push(value);
+      }
+      return;
+    } catch (e) {
+      console.warn('Bundle download interrupted, resuming', e);
+      await sleep(Math.min(30000, 1000 * 2 ** attempt));
+    }
+  }
+}
+
 self.addEventListener('message', event => {
+  // "SKIP_WAITING" is triggered by the Refresh button
   if (event.data && event.data.type === 'SKIP_WAITING') {
     self.skipWaiting();
   }
+  // Sent once by a player on start; only downloads if a lot is missing
+  if (event.data && event.data.type === 'COLD_START' && !bundleRunning) {
+    bundleRunning = runBundle(event.data.query || '')
+      .catch(e => console.warn('Bundle download failed', e))
+      .finally(() => { bundleRunning = null; });
+    event.waitUntil(bundleRunning);
+  }
+  if (event.data && event.data.type === 'PREFETCH') {
+    // A newer manifest replaces whatever is still queued
+    prefetchQueue = event.data.items || [];
+    prefetchRate = event.data.rate || 0;
+    if (!prefetchRunning) prefetchRunning = runPrefetch();
+    event.waitUntil(Promise.all([evictMedia(new Set(event.data.keep || [])), prefetchRunning]));
+  }
 });
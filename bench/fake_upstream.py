@@ -0,0 +1,226 @@
+"""
+Local stand-in for the services a sync talks to, in one FastAPI app:
+
+    POST /v1/databases/{id}/query   Notion query with pagination (start_cursor,
+                                    page_size) and the last_edited_time filter
+    GET  /v1/pages/{id}             Notion page
+    GET  /media/{name}              deterministic media bytes (ETag, 304)
+    GET  /calendar.ics              iCal feed with single and recurring events
+    GET  /_stats, POST /_reset      request counters
+    POST /_edit?count=N             marks N pages as edited (for incremental syncs)
+
+Latency, payload sizes, bandwidth and 429 injection come from UpstreamConfig.
+Runs in its own process (see start_upstream) so it never competes with the
+code under test for the event loop.
+"""
+import time
+import asyncio
+import hashlib
+import multiprocessing
+from collections import Counter
+from dataclasses import asdict, dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+
+import httpx
+import uvicorn
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+
+CHUNK = 64 * 1024
+EPOCH = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+@dataclass
+class UpstreamConfig:
+    pages: int = 100
+    media_every: int = 1 # every n-th page has a media file (0 = none)
+    media_size: int = 200 * 1024 # bytes
+    media_ext: str = "dat" # "jpg" serves a real JPEG (exercises image processing)
+    media_rate_kbps: int = 0 # per download, 0 = unlimited
+    latency_ms: float = 0 # added to every response
+    rate_limit_every: int = 0 # every n-th Notion request answers 429 (0 = never)
+    retry_after: float = 0.2 # seconds, sent with the 429
+    calendar_events: int = 500
+    calendar_recurring: int = 50
+
+def _iso(moment: datetime) -> str:
+    return moment.isoformat().replace("+00:00", "Z")
+
+def _jpeg(size: int) -> bytes:
+    # Noise compresses badly, so the dimensions roughly control the file size
+    import os
+    from io import BytesIO
+    from PIL import Image
+    side = max(64, int((size / 1.5) ** 0.5))
+    buffer = BytesIO()
+    Image.frombytes("RGB", (side, side), os.urandom(side * side * 3)).save(buffer, "JPEG", quality=90)
+    return buffer.getvalue()
+
+def build_calendar(events: int, recurring: int) -> bytes:
+    now = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    lines = ["BEGIN:VCALENDAR", "VERSION:2.0", "PRODID:-//bench//EN"]
+    for i in range(events):
+        start = now + timedelta(hours=7 * i - 24 * 30) # a month back to a few years ahead
+        lines += [
+            "BEGIN:VEVENT",
+            f"UID:event-{i}@bench",
+            f"SUMMARY:Event {i}",
+            f"DTSTART:{start.strftime('%Y%m%dT%H%M%SZ')}",
+            f"DTEND:{(start + timedelta(hours=1)).strftime('%Y%m%dT%H%M%SZ')}",
+        ]
+        if i < recurring:
+            lines.append("RRULE:FREQ=WEEKLY;COUNT=100" if i % 2 else "RRULE:FREQ=DAILY")
+        lines.append("END:VEVENT")
+    lines.append("END:VCALENDAR")
+    return "\r\n".join(lines).encode("utf-8")
+
+def create_app(config: UpstreamConfig, base_url: str) -> FastAPI:
+    app = FastAPI()
+    stats: Counter = Counter()
+    edited: Dict[int, datetime] = {}
+    jpeg: Optional[bytes] = _jpeg(config.media_size) if config.media_ext == "jpg" else None
+    calendar = build_calendar(config.calendar_events, config.calendar_recurring)
+
+    def edited_time(index: int) -> datetime:
+        return edited.get(index, EPOCH + timedelta(minutes=index))
+
+    def page(index: int) -> Dict:
+        properties = {
+            "Name": {"title": [{"plain_text": f"Slide {index}"}]},
+            "Description": {"rich_text": [{"plain_text": f"Benchmark slide number {index}"}]},
+            "Active": {"checkbox": True},
+            "Duration": {"number": 10},
+            "Order": {"number": index},
+            "Media": {"files": []},
+        }
+        if config.media_every and index % config.media_every == 0:
+            url = f"{base_url}/media/{index}.{config.media_ext}"
+            properties["Media"]["files"] = [{"name": f"{index}", "external": {"url": url}}]
+        return {
+            "object": "page",
+            "id": f"00000000-0000-0000-0000-{index:012d}",
+            "last_edited_time": _iso(edited_time(index)),
+            "properties": properties,
+        }
+
+    async def delay():
+        if config.latency_ms:
+            await asyncio.sleep(config.latency_ms / 1000)
+
+    def rate_limited() -> Optional[Response]:
+        stats["notion_requests"] += 1
+        if config.rate_limit_every and stats["notion_requests"] % config.rate_limit_every == 0:
+            stats["notion_429"] += 1
+            return JSONResponse(
+                {"object": "error", "status": 429, "code": "rate_limited", "message": "Rate limited (bench)"},
+                status_code=429, headers={"Retry-After": str(config.retry_after)},
+            )
+        return None
+
+    @app.post("/v1/databases/{database_id}/query")
+    async def query(database_id: str, request: Request):
+        await delay()
+        limited = rate_limited()
+        if limited:
+            return limited
+        stats["notion_query"] += 1
+        body = await request.json()
+        indexes: List[int] = list(range(config.pages))
+        since = ((body.get("filter") or {}).get("last_edited_time") or {}).get("on_or_after")
+        if since:
+            cutoff = datetime.fromisoformat(since.replace("Z", "+00:00"))
+            indexes = [i for i in indexes if edited_time(i) >= cutoff]
+        start = int(body.get("start_cursor") or 0)
+        size = min(int(body.get("page_size") or 100), 100)
+        chunk = indexes[start:start + size]
+        more = start + size < len(indexes)
+        return {
+            "object": "list",
+            "results": [page(i) for i in chunk],
+            "has_more": more,
+            "next_cursor": str(start + size) if more else None,
+        }
+
+    @app.get("/v1/pages/{page_id}")
+    async def retrieve(page_id: str):
+        await delay()
+        limited = rate_limited()
+        if limited:
+            return limited
+        stats["notion_page"] += 1
+        return page(int(page_id.rsplit("-", 1)[-1]))
+
+    @app.get("/media/{name}")
+    async def media(name: str, request: Request):
+        await delay()
+        etag = '"' + hashlib.md5(f"{name}:{config.media_size}".encode()).hexdigest() + '"'
+        if request.headers.get("if-none-match") == etag:
+            stats["media_304"] += 1
+            return Response(status_code=304, headers={"ETag": etag})
+        stats["media"] += 1
+        if jpeg is not None:
+            body = jpeg
+        else:
+            # Unique per name (different content hash), cheap to produce
+            seed = hashlib.sha256(name.encode()).digest()
+            body = None
+        size = len(body) if body is not None else config.media_size
+        stats["media_bytes"] += size
+
+        async def stream():
+            block = body if body is not None else (seed * (CHUNK // len(seed)))
+            sent = 0
+            started = time.perf_counter()
+            while sent < size:
+                part = block[sent:sent + CHUNK] if body is not None else block[:min(CHUNK, size - sent)]
+                sent += len(part)
+                yield part
+                if config.media_rate_kbps:
+                    ahead = sent * 8 / (config.media_rate_kbps * 1000) - (time.perf_counter() - started)
+                    if ahead > 0:
+                        await asyncio.sleep(ahead)
+
+        return StreamingResponse(stream(), media_type="application/octet-stream",
+                                 headers={"ETag": etag, "Content-Length": str(size)})
+
+    @app.get("/calendar.ics")
+    async def ical():
+        await delay()
+        stats["calendar"] += 1
+        return Response(calendar, media_type="text/calendar")
+
+    @app.get("/_stats")
+    async def get_stats():
+        return dict(stats)
+
+    @app.post("/_reset")
+    async def reset():
+        stats.clear()
+        return {}
+
+    @app.post("/_edit")
+    async def edit(count: int = 1):
+        now = datetime.now(timezone.utc)
+        for index in range(0, config.pages, max(1, config.pages // max(count, 1)))[:count]:
+            edited[index] = now
+        return {"edited": count}
+
+    return app
+
+def _serve(config: Dict, port: int):
+    base_url = f"http://127.0.0.1:{port}"
+    uvicorn.run(create_app(UpstreamConfig(**config), base_url), host="127.0.0.1", port=port, log_level="warning")
+
+def start_upstream(config: UpstreamConfig, port: int) -> multiprocessing.Process:
+    """Starts the fake upstream in a child process and waits until it answers."""
+    process = multiprocessing.Process(target=_serve, args=(asdict(config), port), daemon=True)
+    process.start()
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/_stats", timeout=1)
+            return process
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("Fake upstream did not start")
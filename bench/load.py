@@ -0,0 +1,421 @@
+"""
+Load test of the player-facing API: N simulated screens doing what index.html does.
+
+    python -m bench.load --players 200 --duration 60             # local server + fake upstream
+    python -m bench.load --players 200 --sync                     # ... while full syncs run
+    python -m bench.load --url http://10.0.0.5:8000 --players 50  # an existing installation
+
+Every player loads the page, settings, version and playlist, keeps the event
+stream open, plays the slides (each media file is fetched once, afterwards the
+service worker has it), revalidates the playlist after each round and the
+version every 5 minutes, and sends a heartbeat every 15 s (like the player,
+with jitter). --speed divides all of these intervals, so fewer connections
+produce the request rate of a larger fleet.
+
+Reported: latency p50/p99/max and errors per endpoint, throughput, the event-
+loop lag of the server (from its /metrics) and of the load generator itself
+(if that one is saturated, the latencies are too pessimistic).
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import subprocess
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from collections import Counter, defaultdict
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+
+from bench.fake_upstream import UpstreamConfig, start_upstream
+from bench.run import RESULTS_DIR, LoopLagMonitor, _free_port, _git_commit, point_data_dir
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+# Player intervals (seconds), as in index.html
+VERSION_INTERVAL = 300
+HEARTBEAT_INTERVAL = 15
+FIRST_HEARTBEAT = 5
+
+def _percentile(ordered: List[float], fraction: float) -> float:
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+class LoadStats:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Counter = Counter()
+        self.not_modified: Counter = Counter()
+        self.failures: Counter = Counter() # "<endpoint> <status or exception>"
+        self.bytes = 0
+        self.duration = 0.0
+
+    async def request(self, client: httpx.AsyncClient, label: str, method: str, url: str, **kwargs) -> Optional[httpx.Response]:
+        started = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+        except httpx.HTTPError as e:
+            self.errors[label] += 1
+            self.failures[f"{label} {type(e).__name__}"] += 1
+            return None
+        self.latencies[label].append(time.perf_counter() - started)
+        self.bytes += len(response.content)
+        if response.status_code == 304:
+            self.not_modified[label] += 1
+        elif response.status_code >= 400:
+            self.errors[label] += 1
+            self.failures[f"{label} {response.status_code}"] += 1
+        return response
+
+    def merge(self, other: "LoadStats"):
+        for label, values in other.latencies.items():
+            self.latencies[label].extend(values)
+        self.errors.update(other.errors)
+        self.not_modified.update(other.not_modified)
+        self.failures.update(other.failures)
+        self.bytes += other.bytes
+        self.duration = max(self.duration, other.duration)
+
+    def report(self, duration: float) -> Dict[str, Any]:
+        endpoints = {}
+        for label in sorted(set(self.latencies) | set(self.errors)):
+            ordered = sorted(self.latencies[label]) or [0.0]
+            endpoints[label] = {
+                "requests": len(self.latencies[label]),
+                "errors": self.errors[label],
+                "not_modified": self.not_modified[label],
+                "p50_ms": round(_percentile(ordered, 0.5) * 1000, 1),
+                "p99_ms": round(_percentile(ordered, 0.99) * 1000, 1),
+                "max_ms": round(ordered[-1] * 1000, 1),
+            }
+        total = sum(len(values) for values in self.latencies.values())
+        return {
+            "requests": total,
+            "errors": sum(self.errors.values()),
+            "failures": dict(self.failures.most_common(10)),
+            "requests_per_second": round(total / duration, 1),
+            "mbytes_per_second": round(self.bytes / duration / 1e6, 2),
+            "endpoints": endpoints,
+        }
+
+class Player:
+    """One simulated screen."""
+    def __init__(self, index: int, base_url: str, stats: LoadStats, args):
+        self.screen = f"load-{index:05d}"
+        # Own connections like a browser (at most 6 per host), the event stream included
+        self.client = httpx.AsyncClient(base_url=base_url, limits=httpx.Limits(max_connections=6), timeout=30)
+        self.stats = stats
+        self.speed = args.speed
+        self.events = args.events
+        self.query = f"?channel={args.channel}" if args.channel else ""
+        self.channel = args.channel
+        self.etags: Dict[str, str] = {}
+        self.cached_media = set()
+        self.playlist: List[Dict] = []
+        self.playlist_etag: Optional[str] = None
+        self.playlist_dirty = True
+        self.started = time.monotonic()
+
+    async def get(self, label: str, url: str) -> Optional[httpx.Response]:
+        # fetch() in the browser revalidates no-cache responses with the stored ETag
+        headers = {"If-None-Match": self.etags[url]} if url in self.etags else {}
+        response = await self.stats.request(self.client, label, "GET", url, headers=headers)
+        if response is not None and response.status_code == 200 and "etag" in response.headers:
+            self.etags[url] = response.headers["etag"]
+        return response
+
+    async def sleep(self, seconds: float):
+        await asyncio.sleep(seconds / self.speed)
+
+    async def load_playlist(self):
+        response = await self.get("playlist", "/api/playlist" + self.query)
+        if response is not None and response.status_code == 200:
+            self.playlist = response.json()
+            self.playlist_etag = response.headers.get("etag")
+        self.playlist_dirty = False
+
+    async def version_loop(self):
+        while True:
+            await self.get("version", "/api/system/version")
+            await self.sleep(VERSION_INTERVAL)
+            self.playlist_dirty = True
+
+    async def heartbeat_loop(self):
+        await self.sleep(FIRST_HEARTBEAT)
+        while True:
+            slide = self.playlist[0] if self.playlist else {}
+            await self.stats.request(self.client, "telemetry", "POST", "/api/telemetry", json={
+                "screen": self.screen,
+                "channel": self.channel,
+                "playlist": self.playlist_etag,
+                "slide": {"id": slide.get("id"), "index": 0, "type": slide.get("type")},
+                "uptime": time.monotonic() - self.started,
+                "events": [],
+            })
+            await self.sleep(HEARTBEAT_INTERVAL * (0.8 + random.random() * 0.4))
+
+    async def event_stream(self):
+        while True:
+            try:
+                started = time.perf_counter()
+                async with self.client.stream("GET", "/api/events", timeout=None) as response:
+                    self.stats.latencies["events_connect"].append(time.perf_counter() - started)
+                    async for line in response.aiter_lines():
+                        if line.startswith("event: playlist-changed"):
+                            self.playlist_dirty = True
+            except httpx.HTTPError as e:
+                self.stats.errors["events_connect"] += 1
+                self.stats.failures[f"events_connect {type(e).__name__}"] += 1
+            await asyncio.sleep(3)
+
+    async def play(self):
+        while True:
+            if self.playlist_dirty:
+                await self.load_playlist()
+            if not self.playlist:
+                await self.sleep(10)
+                continue
+            for slide in self.playlist:
+                for url in (slide.get("src"), slide.get("poster")):
+                    if url and url.startswith("/media/") and url not in self.cached_media:
+                        # First display: the service worker fetches and keeps it
+                        response = await self.get("media", url)
+                        if response is not None and response.status_code == 200:
+                            self.cached_media.add(url)
+                await self.sleep(float(slide.get("duration") or 10))
+            # index.html re-reads the playlist at the end of a round when told to
+            self.playlist_dirty = self.playlist_dirty or not self.events
+
+    async def run(self, ramp: float):
+        async with self.client:
+            await asyncio.sleep(random.uniform(0, ramp))
+            await self.get("page", "/")
+            await self.get("settings", "/api/settings" + self.query)
+            tasks = [self.version_loop(), self.heartbeat_loop(), self.play()]
+            if self.events:
+                tasks.append(self.event_stream())
+            await asyncio.gather(*tasks)
+
+async def sync_loop(client: httpx.AsyncClient, durations: List[float]):
+    """Keeps full syncs running back to back (what --sync measures against)."""
+    while True:
+        response = await client.post("/api/trigger_sync", params={"full": "true"})
+        job = response.json()["job_id"]
+        while True:
+            await asyncio.sleep(0.5)
+            status = (await client.get("/api/sync_status", params={"job_id": job})).json()
+            if status["state"] in ("done", "failed"):
+                durations.append(status["duration"] or 0.0)
+                break
+
+def _lag_histogram(text: str) -> Dict[str, float]:
+    from prometheus_client.parser import text_string_to_metric_families
+    values = {}
+    for family in text_string_to_metric_families(text):
+        if family.name == "signage_event_loop_lag_seconds":
+            for sample in family.samples:
+                if sample.name.endswith("_bucket"):
+                    values[sample.labels["le"]] = sample.value
+                elif sample.name.endswith("_count"):
+                    values["count"] = sample.value
+        elif family.name == "signage_event_loop_lag_max_seconds":
+            values["max"] = family.samples[0].value
+    return values
+
+async def server_lag(client: httpx.AsyncClient) -> Optional[Dict[str, float]]:
+    try:
+        response = await client.get("/metrics")
+        return _lag_histogram(response.text) if response.status_code == 200 else None
+    except httpx.HTTPError:
+        return None
+
+def lag_report(before: Optional[Dict], after: Optional[Dict]) -> Dict[str, Any]:
+    if not before or not after or "count" not in after:
+        return {"available": False}
+    delta = {key: after.get(key, 0) - before.get(key, 0) for key in after if key != "max"}
+    probes = delta["count"]
+    buckets = sorted(((float(le), count) for le, count in delta.items() if le not in ("count", "+Inf")))
+    p99 = next((le for le, count in buckets if probes and count >= probes * 0.99), None)
+    over = lambda limit: int(probes - next((count for le, count in buckets if le == limit), probes))
+    return {
+        "available": True,
+        "probes": int(probes),
+        "p99_upper_bound_ms": round(p99 * 1000, 1) if p99 is not None else None,
+        "over_100ms": over(0.1),
+        "over_1s": over(1.0),
+        "max_since_start_ms": round(after.get("max", 0) * 1000, 1),
+    }
+
+async def run_players(base_url: str, args, first: int, count: int) -> Tuple[LoadStats, Dict[str, float]]:
+    """Runs players first..first+count for the test duration; returns their stats and this loop's lag."""
+    stats = LoadStats()
+    monitor = LoopLagMonitor()
+    monitor.start()
+    ramp = args.ramp if args.ramp is not None else min(10.0, args.duration / 4)
+    tasks = [asyncio.create_task(Player(first + i, base_url, stats, args).run(ramp)) for i in range(count)]
+    started = time.perf_counter()
+    await asyncio.sleep(args.duration)
+    stats.duration = time.perf_counter() - started
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return stats, await monitor.stop()
+
+def _run_shard(base_url: str, args, first: int, count: int) -> Tuple[LoadStats, Dict[str, float]]:
+    return asyncio.run(run_players(base_url, args, first, count))
+
+async def run_load(base_url: str, args) -> Dict[str, Any]:
+    async with httpx.AsyncClient(base_url=base_url, timeout=30) as client:
+        before = await server_lag(client)
+        sync_durations: List[float] = []
+        sync_task = asyncio.create_task(sync_loop(client, sync_durations)) if args.sync else None
+
+        if args.processes <= 1:
+            shards = [await run_players(base_url, args, 0, args.players)]
+        else:
+            # One Python process tops out at a few hundred requests/s: split the fleet
+            size = -(-args.players // args.processes)
+            loop = asyncio.get_running_loop()
+            with ProcessPoolExecutor(args.processes) as pool:
+                shards = await asyncio.gather(*(
+                    loop.run_in_executor(pool, _run_shard, base_url, args, first, min(size, args.players - first))
+                    for first in range(0, args.players, size)
+                ))
+        if sync_task is not None:
+            sync_task.cancel()
+            await asyncio.gather(sync_task, return_exceptions=True)
+        after = await server_lag(client)
+
+    stats = LoadStats()
+    for shard_stats, _ in shards:
+        stats.merge(shard_stats)
+    client_lag = {key: max(lag[key] for _, lag in shards) for key in shards[0][1]}
+    duration = stats.duration
+
+    return {
+        "players": args.players,
+        "duration_s": round(duration, 1),
+        "speed": args.speed,
+        "processes": args.processes,
+        **stats.report(duration),
+        "server_loop_lag": lag_report(before, after),
+        "client_loop_lag": client_lag,
+        "syncs": {"completed": len(sync_durations), "durations_s": sync_durations} if args.sync else None,
+    }
+
+def serve(port: int, pages: int, media_size: int):
+    """Runs the app with a fake upstream and a temp data dir (in its own process)."""
+    from bench.run import KB
+    upstream_port = _free_port()
+    upstream = start_upstream(UpstreamConfig(pages=pages, media_size=media_size * KB), upstream_port)
+    os.environ.update({
+        "NOTION_TOKEN": "bench-token",
+        "NOTION_DATABASE_ID": "bench-database",
+        "NOTION_BASE_URL": f"http://127.0.0.1:{upstream_port}",
+        "DOWNLOAD_HOST_LIMITS": "",
+        "SYNC_INTERVAL": "86400", # only --sync triggers syncs
+    })
+    try:
+        with tempfile.TemporaryDirectory(prefix="signage-load-") as data_dir:
+            point_data_dir(Path(data_dir))
+            import uvicorn
+            from app import main
+            from app.services.media_server import CachedStaticFiles
+            for route in main.app.routes:
+                if getattr(route, "name", None) == "media":
+                    route.app = CachedStaticFiles(directory=str(Path(data_dir) / "media"))
+            uvicorn.run(main.app, host="127.0.0.1", port=port, log_level="warning")
+    finally:
+        upstream.terminate()
+
+def start_server(args) -> Tuple[subprocess.Popen, str]:
+    port = _free_port()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "bench.load", "--serve", str(port), "--pages", str(args.pages), "--media-size", str(args.media_size)],
+        cwd=REPO_ROOT,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 300 # startup includes the initial sync
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("Local server exited during startup")
+        try:
+            if httpx.get(f"{base_url}/api/system/version", timeout=1).status_code == 200:
+                return process, base_url
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    process.terminate()
+    raise RuntimeError("Local server did not start")
+
+def print_report(result: Dict[str, Any]):
+    print(f"{result['players']} players for {result['duration_s']}s (speed x{result['speed']}): "
+          f"{result['requests']} requests, {result['requests_per_second']} req/s, "
+          f"{result['mbytes_per_second']} MB/s, {result['errors']} errors")
+    if result["failures"]:
+        print("failures: " + ", ".join(f"{kind} x{count}" for kind, count in result["failures"].items()))
+    print(f"{'endpoint':16} {'requests':>9} {'errors':>7} {'304':>7} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for label, e in result["endpoints"].items():
+        print(f"{label:16} {e['requests']:9} {e['errors']:7} {e['not_modified']:7} "
+              f"{e['p50_ms']:9.1f} {e['p99_ms']:9.1f} {e['max_ms']:9.1f}")
+    lag = result["server_loop_lag"]
+    if lag["available"]:
+        print(f"server event loop: {lag['probes']} probes, p99 <= {lag['p99_upper_bound_ms']} ms, "
+              f"{lag['over_100ms']} blocked > 100 ms, {lag['over_1s']} > 1 s, max {lag['max_since_start_ms']} ms")
+    else:
+        print("server event loop: no signage_event_loop_lag_seconds in /metrics")
+    client = result["client_loop_lag"]
+    print(f"load generator loop: p99 {client['loop_lag_p99_ms']} ms, max {client['loop_lag_max_ms']} ms")
+    if client["loop_lag_p99_ms"] > 50:
+        print("WARNING: the load generator itself is saturated; latencies above are too high. "
+              "Use more --processes, or fewer players with a higher --speed.")
+    if result["syncs"] is not None:
+        print(f"syncs during the run: {result['syncs']['completed']} {result['syncs']['durations_s']}")
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description="Simulates a fleet of players against the signage API.")
+    parser.add_argument("--url", help="server to test (default: start a local one with a fake upstream)")
+    parser.add_argument("--players", type=int, default=100)
+    parser.add_argument("--duration", type=float, default=60, help="seconds")
+    parser.add_argument("--speed", type=float, default=1.0, help="divides the player intervals (10 = ten times the requests)")
+    parser.add_argument("--processes", type=int, default=1, help="load generator processes the players are split across")
+    parser.add_argument("--ramp", type=float, help="seconds over which players start (default: min(10, duration/4))")
+    parser.add_argument("--channel", help="channel the players show")
+    parser.add_argument("--no-events", dest="events", action="store_false", help="players poll instead of keeping /api/events open")
+    parser.add_argument("--sync", action="store_true", help="run full syncs back to back during the test")
+    parser.add_argument("--pages", type=int, default=200, help="local server: Notion pages")
+    parser.add_argument("--media-size", type=int, default=200, help="local server: KB per media file")
+    parser.add_argument("--no-save", action="store_true", help="don't store the results")
+    parser.add_argument("--serve", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.serve:
+        serve(args.serve, args.pages, args.media_size)
+        return
+
+    server = None
+    base_url = args.url
+    if base_url is None:
+        print(f"Starting local server ({args.pages} pages, initial sync)...")
+        server, base_url = start_server(args)
+    try:
+        result = asyncio.run(run_load(base_url.rstrip("/"), args))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    result.update({"url": args.url or "local", "sync": args.sync, "commit": _git_commit(), "timestamp": time.time()})
+    print_report(result)
+    if not args.no_save:
+        RESULTS_DIR.mkdir(exist_ok=True)
+        path = RESULTS_DIR / f"load-{time.strftime('%Y%m%d-%H%M%S')}-{result['commit']}.json"
+        with open(path, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"Results stored in {path}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,323 @@
+"""
+Benchmarks of the sync pipeline against a local fake upstream (bench/fake_upstream.py).
+
+    python -m bench.run                      # all scenarios
+    python -m bench.run sync_500 calendar    # selected ones
+    python -m bench.run --list
+
+Every scenario runs in a fresh Python process (so peak RSS is its own) with
+its data directory in a temp dir. Reported per scenario: wall time, peak RSS,
+upstream request counts, Notion client counters and event-loop lag. Results
+are stored in bench/results/<time>-<commit>.json and compared with the
+previous run; slowdowns above --threshold are flagged.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import resource
+import subprocess
+import tempfile
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from bench.fake_upstream import UpstreamConfig, start_upstream
+
+RESULTS_DIR = Path(__file__).parent / "results"
+KB = 1024
+MB = 1024 * KB
+
+@dataclass
+class Scenario:
+    kind: str # sync, incremental, download, host_budget, cleanup, calendar
+    upstream: UpstreamConfig = field(default_factory=UpstreamConfig)
+    env: Dict[str, str] = field(default_factory=dict)
+    edits: int = 0 # pages edited before an incremental sync
+    description: str = ""
+
+SCENARIOS: Dict[str, Scenario] = {
+    "sync_10": Scenario("sync", UpstreamConfig(pages=10), description="Small database, full sync"),
+    "sync_500": Scenario("sync", UpstreamConfig(pages=500, media_size=100 * KB), description="500 pages, media on every page"),
+    "sync_5000": Scenario(
+        "sync", UpstreamConfig(pages=5000, media_every=10, media_size=50 * KB),
+        description="5000 pages (50 queries), media on every 10th",
+    ),
+    "sync_incremental_500": Scenario(
+        "incremental", UpstreamConfig(pages=500, media_size=100 * KB), edits=25,
+        description="Incremental sync after 25 of 500 pages changed",
+    ),
+    "sync_slow_upstream": Scenario(
+        "sync", UpstreamConfig(pages=100, latency_ms=300, media_rate_kbps=8000),
+        description="300 ms latency per request, media at 8 Mbit/s",
+    ),
+    "sync_rate_limited": Scenario(
+        "sync", UpstreamConfig(pages=1000, media_every=0, rate_limit_every=4),
+        env={"NOTION_BACKOFF": "0.2"}, description="Every 4th Notion request answers 429",
+    ),
+    "sync_images": Scenario(
+        "sync", UpstreamConfig(pages=20, media_ext="jpg", media_size=2 * MB),
+        description="20 real JPEGs through the image variant stage",
+    ),
+    "download_large": Scenario(
+        "download", UpstreamConfig(pages=4, media_size=64 * MB),
+        description="4 x 64 MB through the download pool",
+    ),
+    "download_host_budget": Scenario(
+        "host_budget", UpstreamConfig(pages=12, media_size=128 * KB, media_rate_kbps=1000),
+        env={"DOWNLOAD_CONCURRENCY": "6", "DOWNLOAD_HOST_LIMITS": "127.0.0.1=4"},
+        description="12 throttled downloads on a capped host + 1 on another host (fails if starved)",
+    ),
+    "cleanup_5000": Scenario("cleanup", UpstreamConfig(pages=5000), description="cleanup_files over 5000 index entries"),
+    "calendar": Scenario(
+        "calendar", UpstreamConfig(calendar_events=2000, calendar_recurring=200),
+        description="fetch_next_event on 2000 events (200 recurring)",
+    ),
+}
+
+class LoopLagMonitor:
+    """Measures how late a periodic timer fires: time the loop was blocked."""
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.samples: List[float] = []
+        self._task: Optional[asyncio.Task] = None
+        self._sleeping_since = time.perf_counter()
+
+    async def _run(self):
+        while True:
+            self._sleeping_since = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, time.perf_counter() - self._sleeping_since - self.interval))
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> Dict[str, float]:
+        # A stall right before stop() hasn't been sampled yet
+        overdue = time.perf_counter() - self._sleeping_since - self.interval
+        if overdue > 0:
+            self.samples.append(overdue)
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        ordered = sorted(self.samples) or [0.0]
+        return {
+            "loop_lag_max_ms": round(ordered[-1] * 1000, 1),
+            "loop_lag_p99_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000, 1),
+            "loop_lag_over_100ms": sum(1 for s in ordered if s > 0.1),
+        }
+
+def _peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(peak / (MB if sys.platform == "darwin" else KB), 1)
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def point_data_dir(data_dir: Path):
+    """Redirects every /app/data path of the app modules into `data_dir`."""
+    from app.services import file_manager, image_processing, notion_sync, schedule, settings_manager, shared_state, video_transcoder
+    media = data_dir / "media"
+    media.mkdir(parents=True)
+    file_manager.MEDIA_DIR = image_processing.MEDIA_DIR = video_transcoder.MEDIA_DIR = media
+    file_manager.MEDIA_INDEX_FILE = file_manager.media_index.path = data_dir / "media_index.json"
+    file_manager.media_index.entries = {}
+    file_manager.media_index.orphans = set()
+    file_manager.media_index.needs_sweep = False
+    notion_sync.PLAYLIST_FILE = schedule.PLAYLIST_FILE = data_dir / "playlist.json"
+    notion_sync.SYNC_STATE_FILE = data_dir / "sync_state.json"
+    notion_sync.SOURCES_FILE = data_dir / "sources.json"
+    settings_manager.SETTINGS_FILE = data_dir / "settings.json"
+    settings_manager.SETTINGS_HISTORY_DIR = data_dir / "settings_history"
+    shared_state.SHARED_STATE_FILE = data_dir / "shared_state.db"
+    shared_state.LEADER_LOCK_FILE = data_dir / "leader.lock"
+
+async def _run_scenario(scenario: Scenario, base_url: str, data_dir: Path) -> Dict[str, Any]:
+    import httpx
+    from app.services import calendar_service, file_manager, notion_sync
+    from app.services.notion_api import notion_api
+
+    upstream = httpx.AsyncClient(base_url=base_url)
+    extra: Dict[str, Any] = {}
+
+    # Untimed preparation
+    if scenario.kind == "incremental":
+        await notion_sync.sync_notion_data(full=True)
+        await upstream.post("/_edit", params={"count": scenario.edits})
+    elif scenario.kind == "cleanup":
+        for i in range(scenario.upstream.pages):
+            name = f"{i:020x}.dat"
+            (file_manager.MEDIA_DIR / name).write_bytes(b"x")
+            file_manager.media_index.put(f"key-{i}", {"filename": name, "source": name})
+        file_manager.media_index.save()
+    await upstream.post("/_reset")
+
+    monitor = LoopLagMonitor()
+    monitor.start()
+    started = time.perf_counter()
+
+    if scenario.kind in ("sync", "incremental"):
+        progress = notion_sync.SyncProgress()
+        await notion_sync.sync_notion_data(full=scenario.kind == "sync", progress=progress)
+        extra["progress"] = progress.to_dict()
+    elif scenario.kind == "download":
+        async with file_manager.DownloadPool() as pool:
+            results = await asyncio.gather(*(
+                pool.download(f"{base_url}/media/{i}.{scenario.upstream.media_ext}", f"key-{i}", ".dat")
+                for i in range(scenario.upstream.pages)
+            ))
+        extra["downloaded"] = sum(1 for r in results if r)
+    elif scenario.kind == "host_budget":
+        # "localhost" is the same upstream under a host name without a limit
+        other_url = base_url.replace("127.0.0.1", "localhost")
+        async with file_manager.DownloadPool() as pool:
+            capped = [
+                asyncio.create_task(pool.download(f"{base_url}/media/{i}.dat", f"key-{i}", ".dat"))
+                for i in range(scenario.upstream.pages)
+            ]
+            await asyncio.sleep(0.05) # the capped queue is waiting first
+            other_started = time.perf_counter()
+            await pool.download(f"{other_url}/media/other.dat", "key-other", ".dat")
+            extra["other_host_s"] = round(time.perf_counter() - other_started, 3)
+            await asyncio.gather(*capped)
+        throttled = scenario.upstream.media_size * 8 / (scenario.upstream.media_rate_kbps * 1000)
+        if extra["other_host_s"] > throttled * 1.5:
+            raise RuntimeError(
+                f"Download on a host with spare budget took {extra['other_host_s']}s "
+                f"behind the capped host's queue (one throttled download: {throttled:.2f}s)"
+            )
+    elif scenario.kind == "cleanup":
+        keep = {f"key-{i}" for i in range(0, scenario.upstream.pages, 2)}
+        await file_manager.cleanup_files(keep)
+        extra["files_left"] = len(list(file_manager.MEDIA_DIR.iterdir()))
+    elif scenario.kind == "calendar":
+        title, start = await calendar_service.fetch_next_event(f"{base_url}/calendar.ics")
+        extra["next_event"] = title
+        extra["indexed_events"] = len(calendar_service.get_feed(f"{base_url}/calendar.ics").events)
+    else:
+        raise ValueError(f"Unknown scenario kind: {scenario.kind}")
+
+    wall = time.perf_counter() - started
+    lag = await monitor.stop()
+    requests = (await upstream.get("/_stats")).json()
+    await upstream.aclose()
+    await notion_api.close()
+    await calendar_service.close()
+
+    return {
+        "wall_s": round(wall, 3),
+        "peak_rss_mb": _peak_rss_mb(),
+        **lag,
+        "requests": requests,
+        "notion": notion_api.stats(),
+        **extra,
+    }
+
+def run_child(name: str) -> Dict[str, Any]:
+    """Runs one scenario in this process (called in a fresh interpreter)."""
+    scenario = SCENARIOS[name]
+    port = _free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    upstream = start_upstream(scenario.upstream, port)
+    try:
+        # Read at import time by the app modules
+        os.environ.update({
+            "NOTION_TOKEN": "bench-token",
+            "NOTION_DATABASE_ID": "bench-database",
+            "NOTION_BASE_URL": base_url,
+            "DOWNLOAD_HOST_LIMITS": "",
+            **scenario.env,
+        })
+        baseline = _peak_rss_mb()
+        with tempfile.TemporaryDirectory(prefix="signage-bench-") as data_dir:
+            point_data_dir(Path(data_dir))
+            result = asyncio.run(_run_scenario(scenario, base_url, Path(data_dir)))
+        from app.services import image_processing
+        image_processing.shutdown()
+        result["baseline_rss_mb"] = baseline
+        return result
+    finally:
+        upstream.terminate()
+
+def _git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True, stderr=subprocess.DEVNULL).strip()
+    except Exception:
+        return "unknown"
+
+def _previous_results() -> Optional[Dict[str, Any]]:
+    files = [f for f in sorted(RESULTS_DIR.glob("*.json")) if not f.name.startswith("load-")]
+    if not files:
+        return None
+    with open(files[-1]) as f:
+        return json.load(f)
+
+def _compare(name: str, current: Dict, previous: Optional[Dict], threshold: float) -> str:
+    before = (previous or {}).get("scenarios", {}).get(name)
+    if not before or "wall_s" not in before or "wall_s" not in current:
+        return ""
+    change = (current["wall_s"] - before["wall_s"]) / before["wall_s"] if before["wall_s"] else 0.0
+    flag = "  << REGRESSION" if change > threshold else ""
+    return f" ({change:+.0%} vs {previous.get('commit')}){flag}"
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description="Sync/download benchmarks against a local fake upstream.")
+    parser.add_argument("scenarios", nargs="*", help="scenario names (default: all)")
+    parser.add_argument("--list", action="store_true", help="list scenarios and exit")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--threshold", type=float, default=0.2, help="wall time increase flagged as regression (default 0.2)")
+    parser.add_argument("--no-save", action="store_true", help="don't store the results")
+    args = parser.parse_args(argv)
+
+    if args.child:
+        print(json.dumps(run_child(args.child)))
+        return
+    if args.list:
+        for name, scenario in SCENARIOS.items():
+            print(f"{name:24} {scenario.description}")
+        return
+
+    names = args.scenarios or list(SCENARIOS)
+    unknown = [n for n in names if n not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(unknown)}")
+
+    previous = _previous_results()
+    results = {"commit": _git_commit(), "timestamp": time.time(), "python": sys.version.split()[0], "scenarios": {}}
+    for name in names:
+        proc = subprocess.run(
+            [sys.executable, "-m", "bench.run", "--child", name],
+            capture_output=True, text=True,
+        )
+        if proc.returncode != 0:
+            print(f"{name:24} FAILED\n{proc.stderr[-2000:]}")
+            results["scenarios"][name] = {"error": proc.stderr[-2000:]}
+            continue
+        result = json.loads(proc.stdout.strip().splitlines()[-1])
+        results["scenarios"][name] = result
+        requests = result["requests"]
+        print(
+            f"{name:24} {result['wall_s']:8.2f}s  rss {result['peak_rss_mb']:7.1f} MB  "
+            f"lag max {result['loop_lag_max_ms']:6.1f} ms  "
+            f"notion {requests.get('notion_requests', 0):5} (429: {requests.get('notion_429', 0)})  "
+            f"media {requests.get('media', 0):5} (304: {requests.get('media_304', 0)})"
+            f"{_compare(name, result, previous, args.threshold)}"
+        )
+
+    if not args.no_save:
+        RESULTS_DIR.mkdir(exist_ok=True)
+        path = RESULTS_DIR / f"{time.strftime('%Y%m%d-%H%M%S')}-{results['commit']}.json"
+        with open(path, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results stored in {path}")
+
+if __name__ == "__main__":
+    main()